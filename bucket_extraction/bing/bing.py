@@ -1,6 +1,5 @@
-import grequests
-import csv
-from .. import getBucketsFromText
+from .. import extractBuckets
+from ..utils.paged_extract import PagedSource, extractPaged
 import random
 import string
 import os
@@ -13,61 +12,55 @@ headers = {"Ocp-Apim-Subscription-Key": subscription_key}
 NUM_SEARCHES = 100
 NUM_THREADS = 10
 SEED_LENGTH = 3
-OUTPUT_NAME = "./data/extraction/bing/buckets_output.txt"
+# Bing returns at most 50 results per request.
+PAGE_SIZE = 50
+# Productive searches are followed this deep.
+MAX_OFFSET = 1000
+# A page must find this many new buckets for the next page of its search to be fetched.
+MIN_NEW = 5
+PLATFORMS = ["s3.amazonaws.com", "storage.googleapis.com", "oss.aliyuncs.com"]
+OUTPUT_DIRECTORY = "./data/extraction/bing/"
 
-def exception(request, exception):
-    print("Error: {}: {}".format(request.url, exception))
+class BingSource(PagedSource):
+    """
+    Web searches for a random string on a storage platform's domain.
+    """
 
-def getBucketsFromBing():
+    name = "bing"
+    pageSize = PAGE_SIZE
+    legacyFiles = {"buckets_output.txt": None}
 
-    try:
-        with open(OUTPUT_NAME, "r") as  f:
-            buckets = set(line.strip() for line in f)
-    except Exception as e:
-        buckets = set()
+    def __init__(self, numSearches=NUM_SEARCHES):
+        super().__init__(OUTPUT_DIRECTORY, maxOffset=MAX_OFFSET, minNew=MIN_NEW)
+        self.numSearches = numSearches
 
-    initLen = len(buckets)
+    def seeds(self):
+        for i in range(0, self.numSearches):
+            rand = ''.join(random.choice(string.ascii_lowercase) for _ in range(SEED_LENGTH))
+            platform = random.choice(PLATFORMS)
+            yield "site:" + platform + " \"" + rand + "\"", 0
 
-    reqs = []
+    def request(self, seed, offset):
+        return {
+            "url": search_url,
+            "headers": headers,
+            "params": {
+                "q": seed,
+                "responseFilter": "Webpages",
+                "count": self.pageSize,
+                "offset": offset
+            },
+        }
 
-    for i in range(0, NUM_SEARCHES):
-        rand = ''.join(random.choice(string.ascii_lowercase) for _ in range(SEED_LENGTH))
-        platform = random.choice(["s3.amazonaws.com", "storage.googleapis.com", "oss.aliyuncs.com"])
-        reqs.append(grequests.get(
-            search_url,
-            headers=headers,
-            params={
-                    "q": "site:" + platform + " \"" + rand + "\"",
-                    "responseFilter": "Webpages",
-                    "count": 50,
-                    "offset": 0
-                    },
-            stream=False
-            ))
+    def parse(self, response):
+        pages = response.json().get("webPages", {}).get("value", [])
+        buckets = []
+        for page in pages:
+            buckets.extend(extractBuckets(page.get("snippet", "") + "\n" + page.get("url", "")))
+        return buckets, len(pages)
 
-    results = grequests.map(reqs, exception_handler=exception, size=NUM_THREADS)
-
-    for result in results:
-        if result is None:
-            continue
-        
-        result.close()
-
-        if result.status_code != 200:
-            print(result)
-            continue
-
-        parsed = result.json()
-        if "webPages" in parsed and "value" in parsed["webPages"]:
-            for page in parsed["webPages"]["value"]:
-                if "snippet" in page:
-                    buckets = buckets.union(getBucketsFromText(page["snippet"]))
-                    buckets = buckets.union(getBucketsFromText(page["url"]))
-
-    numAdded = len(buckets) - initLen
-    ratio = numAdded / NUM_SEARCHES
+def getBucketsFromBing(numSearches=NUM_SEARCHES, numThreads=None):
+    newByProvider = extractPaged(BingSource(numSearches), numThreads=numThreads or NUM_THREADS)
+    numAdded = sum(newByProvider.values())
+    ratio = numAdded / numSearches
     print("Discovered {} new buckets. ({} buckets / search)".format(numAdded, ratio))
-    print("Wrote buckets to " + OUTPUT_NAME)
-
-    with open(OUTPUT_NAME, 'w+') as f:
-        f.write("\n".join(buckets))
@@ -1,7 +1,11 @@
 import requests
 import json
-from .. import getBucketsFromText
+from .. import extractBuckets
+from ..utils.rate_limit import RateLimiter, backoff
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import os
+import threading
+import time
 
 API_ENDPOINTS = [("https://api.dnsdb.info/lookup/rrset/name/", "rrname"), ("https://api.dnsdb.info/lookup/rdata/name/", "rdata")]
 regions = ["us-east-2", "us-east-1", "us-west-1", "us-west-2", "af-south-1", "ap-east-1", "ap-south-1", "ap-northeast-3", "ap-northeast-2", "ap-southeast-1", "ap-southeast-2", "ap-northeast-1", "ca-central-1", "cn-north-1", "cn-northwest-1", "eu-central-1", "eu-west-1", "eu-west-2", "eu-south-1", "eu-west-3", "eu-north-1", "me-south-1", "sa-east-1", "us-gov-east-1", "us-gov-west-1"]
@@ -10,51 +14,206 @@ API_KEY = os.getenv("FARSIGHT_API_KEY")
 OUTPUT_NAME = "./data/extraction/farsight/"
 
 api_limit = 1000000
+# DNSDB does not page past this offset.
+max_offset = 4000000
+# Save progress every this many rows.
+checkpoint_every = 10000
+# DNSDB keys allow a limited number of concurrent connections and queries per second.
+num_threads = 10
+requests_per_second = 5
+max_retries = 5
+# Seconds without data before a request is abandoned and retried.
+timeout = 300
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# The burst follows the API's limit, not the number of threads.
+rate_limiter = RateLimiter(requests_per_second, burst=requests_per_second)
+sessions = threading.local()
 
 def lookupFile(file, type):
-    files = []
+    domains = []
     with open(file, 'r') as f:
         for line in f:
             text = line.strip()
             if "{region}" in text:
-                all_regions = []
                 for region in regions:
-                    all_regions.append(text.replace("{region}", region))
-                files.append(all_regions)
-            else:
-                files.append([text])
-    for endpoint_list in files:
-        lookup(endpoint_list, type + "/")
-
-def lookup(endpoints, directory=""):
-    all_domains = set()
-    for domain in endpoints:
-        for endpoint_pair in API_ENDPOINTS:
-            (endpoint, field_name) = endpoint_pair
-            offset = 0
-            while True:
-                url = "{}*.{}?limit={}&offset={}".format(endpoint, domain, api_limit, offset)
-                print("Fetching " + url)
-                headers = {'Accept': 'application/json', 'X-API-Key': API_KEY}
-                resp = requests.get(url, headers=headers)
-                if resp.status_code != 200:
-                    break
-                split = resp.text.split("\n")
-                for line in split:
-                    if line.strip() == "":
-                        continue
-                    resp_json = json.loads(line)
-                    if field_name in resp_json:
-                        dns_val = resp_json[field_name]
-                        if dns_val[-1] == ".":
-                            dns_val = dns_val[:-1]
-                        all_domains.add(dns_val)
-                print(len(split))
-                if len(split) < api_limit or offset >= 4000000:
-                    break
-                offset += api_limit
-    out = './data/extraction/farsight/' + directory + domain + ".txt"
-    with open(out, 'w+') as f:
-        f.write("\n".join(all_domains))
-    print("Wrote buckets to " + out)
+                    domains.append(text.replace("{region}", region))
+            elif text:
+                domains.append(text)
+    lookup(domains, type + "/")
+
+def getSession():
+    """
+    :return: the requests session of the current thread, created on first use.
+    """
+    session = getattr(sessions, "session", None)
+    if session is None:
+        session = sessions.session = requests.Session()
+        session.headers.update({'Accept': 'application/json', 'X-API-Key': API_KEY})
+    return session
+
+class Checkpoint:
+    """
+    Progress of the lookup of a domain: the endpoints that are done, and how many rows
+    of the others have been written. Saved next to the output file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.completed = set()
+        self.offsets = {}
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                state = json.load(f)
+            self.completed = set(state["completed"])
+            self.offsets = state["offsets"]
+
+    def save(self, endpoint, offset, done=False):
+        if done:
+            self.completed.add(endpoint)
+            self.offsets.pop(endpoint, None)
+        else:
+            self.offsets[endpoint] = offset
+        tmpPath = self.path + ".tmp"
+        with open(tmpPath, 'w') as f:
+            json.dump({"completed": sorted(self.completed), "offsets": self.offsets}, f)
+        os.replace(tmpPath, self.path)
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+class DomainOutput:
+    """
+    The output file of a domain, shared by the workers looking it up on each endpoint.
+    Names are only written once, and the checkpoint is saved after the names it covers.
+    """
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.seen = set()
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                self.seen.update(line.strip() for line in f)
+        self.file = open(path, 'a')
+        self.checkpoint = Checkpoint(path + ".checkpoint")
+        self.lock = threading.Lock()
+        self.written = 0
+
+    def write(self, endpoint, names, offset):
+        """
+        :param names: DNS names that contain a bucket.
+        :param offset: the number of rows of the endpoint read once these names are written.
+        """
+        with self.lock:
+            new = []
+            for name in names:
+                if name not in self.seen:
+                    self.seen.add(name)
+                    new.append(name)
+            if new:
+                self.file.write("".join(name + "\n" for name in new))
+                self.written += len(new)
+            self.file.flush()
+            self.checkpoint.save(endpoint, offset)
+
+    def finish(self, endpoint):
+        with self.lock:
+            self.checkpoint.save(endpoint, None, done=True)
+
+    def close(self):
+        """
+        :return: True if every endpoint is done, in which case the checkpoint is removed.
+        """
+        self.file.close()
+        done = all(endpoint in self.checkpoint.completed for endpoint, _ in API_ENDPOINTS)
+        if done:
+            self.checkpoint.remove()
+        return done
+
+def lookupEndpoint(endpoint, field_name, domain, output):
+    """
+    Stream every page of the records of a domain on one endpoint into its output,
+    retrying with backoff when the request fails or is throttled.
+    :return: True if every record was read, False if the lookup should be resumed later.
+    """
+    offset = output.checkpoint.offsets.get(endpoint, 0)
+    attempt = 0
+    while offset <= max_offset:
+        url = "{}*.{}?limit={}&offset={}".format(endpoint, domain, api_limit, offset)
+        rate_limiter.acquire()
+        rows = 0
+        names = []
+        try:
+            with getSession().get(url, stream=True, timeout=timeout) as resp:
+                status = resp.status_code
+                if status == 200:
+                    for line in resp.iter_lines(chunk_size=1 << 16):
+                        if not line.strip():
+                            continue
+                        dns_val = json.loads(line).get(field_name)
+                        rows += 1
+                        if dns_val:
+                            dns_val = dns_val.rstrip(".")
+                            if extractBuckets(dns_val):
+                                names.append(dns_val)
+                        if rows % checkpoint_every == 0:
+                            output.write(endpoint, names, offset + rows)
+                            names = []
+        except (requests.RequestException, ValueError) as e:
+            # The rows read before the connection broke are kept, the retry starts after them.
+            status = e
+        if rows or names:
+            output.write(endpoint, names, offset + rows)
+        offset += rows
+        if status == 200:
+            attempt = 0
+            if rows < api_limit:
+                return True
+            continue
+        if status == 404:
+            # No (more) results.
+            return True
+        attempt = 1 if rows else attempt + 1
+        retryable = isinstance(status, Exception) or status in RETRY_STATUSES
+        if not retryable or attempt > max_retries:
+            print("COULDNT FETCH", url, status)
+            return False
+        delay = backoff(attempt)
+        if status == 429:
+            rate_limiter.pause(delay)
+        print("Retrying {} in {:.1f}s ({})".format(url, delay, status))
+        time.sleep(delay)
+    return True
 
+def lookup(domains, directory=""):
+    """
+    Look up every domain on every endpoint concurrently, within the rate limit, and append the
+    names that contain a bucket to ./data/extraction/farsight/<directory><domain>.txt, without repeats.
+    Progress is checkpointed per domain, so an interrupted lookup resumes where it stopped.
+    :param domains: the domains to look up, e.g. s3.us-east-1.amazonaws.com.
+    """
+    outputs = {domain: DomainOutput(OUTPUT_NAME + directory + domain + ".txt") for domain in dict.fromkeys(domains)}
+    tasks = [
+        (endpoint, field_name, domain)
+        for domain, output in outputs.items()
+        for endpoint, field_name in API_ENDPOINTS
+        if endpoint not in output.checkpoint.completed
+    ]
+    with ThreadPoolExecutor(num_threads) as pool:
+        futures = {pool.submit(lookupEndpoint, *task, outputs[task[2]]): task for task in tasks}
+        for numDone, future in enumerate(as_completed(futures), 1):
+            endpoint, _, domain = futures[future]
+            try:
+                done = future.result()
+            except Exception as e:
+                print("Error: {} {}: {}".format(endpoint, domain, e))
+                done = False
+            if done:
+                outputs[domain].finish(endpoint)
+            print("{}/{} {}{}: {}".format(numDone, len(tasks), endpoint, domain, "done" if done else "failed"))
+    for domain, output in outputs.items():
+        complete = output.close()
+        print("Wrote {} buckets to {}{}".format(
+            output.written, output.path, "" if complete else " (incomplete, run again to resume)"))
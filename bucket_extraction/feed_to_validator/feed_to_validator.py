@@ -1,12 +1,165 @@
-from pystalk import BeanstalkClient
+"""
+Feed an extraction file (one name, domain or URL per line) to the validator.
+The file is streamed in batches. Each line is normalized to jobs: bucket domains (e.g. from
+Farsight or VirusTotal dumps) are kept whole, so that the validator only probes their host, and
+anything else becomes a bare bucket name, which it probes on every host. Jobs whose bucket name
+breaks the providers' naming rules are dropped, and the rest are deduplicated, both within the
+run and against the validator's results: a domain is skipped once its host answered for the name,
+and a bare name once every host did. What is left goes through the pipelined producer.
+"""
+from glob import glob
+import os
+import re
+import sys
+import tempfile
 import time
 
-beanstalk_client = BeanstalkClient('127.0.0.1', 11301)
+from bucket_extraction import HOST_SUFFIXES, extractBucketPositions
+from bucket_extraction.utils.bucket_index import BucketIndex, hashNames, tailBuckets
+from bucket_generation.producer import BeanstalkProducer
+from bucket_generation.validity import ValidityFilter
+
+beanstalk_client = BeanstalkProducer('127.0.0.1', 11301)
+
+BATCH_BYTES = 1 << 20
+# Where the index of the host and name pairs in the validator's results is kept between runs.
+VALIDATED_INDEX = "./data/validation_hosts.seen"
+VALIDATED_FILES = ["public.txt", "private.txt", "no_such_bucket.txt"]
+# The listener's acceptedHosts, which are also the directories of its results. A job containing
+# one of them is only probed on it, anything else on all of them.
+ACCEPTED_HOSTS = ["s3.amazonaws.com", "storage.googleapis.com", "aliyuncs.com"]
+# The name on a line that does not hold a bucket domain (those are found with extractBuckets),
+# optionally followed by ",<anything>".
+BARE_NAME = re.compile(
+    r'^(?![^\n,]*(?:' + "|".join(re.escape(suffix) for suffix in HOST_SUFFIXES) + r'))'
+    r'[ \t]*([^\s,](?:[^\n,]*[^\s,])?)[ \t\r]*(?:,[^\n]*)?$',
+    re.MULTILINE,
+)
+# The rest of a bucket domain from where its bucket name starts, up to the end of the host.
+HOSTED_DOMAIN = re.compile(r'[\w.-]*?(?:' + "|".join(re.escape(suffix) for suffix in HOST_SUFFIXES) + r')')
+
+def normalizeJobs(text):
+    """
+    :param text: lines of an extraction file: bucket names, optionally followed by ",<anything>",
+        or text containing bucket domains or URLs.
+    :return: a list of (job, bucket name) pairs, lowercase. The job is the bucket's domain if the
+        text names one (bucket.host, including regional endpoints), otherwise its name: path-style
+        URLs only give the name.
+    """
+    text = text.lower()
+    jobs = [(name, name) for name in BARE_NAME.findall(text)]
+    for position, _, bucket in extractBucketPositions(text):
+        if position >= 5 and text.startswith(".com/", position - 5):
+            jobs.append((bucket, bucket))
+        else:
+            jobs.append((HOSTED_DOMAIN.match(text, position).group(0), bucket))
+    return jobs
+
+def validatedKeys(job, name):
+    """
+    :param job: a job, as given by normalizeJobs.
+    :param name: its bucket name.
+    :return: the keys of the validator's results that together answer the job: the one of the host
+        it names, or one per host for a bare name. Empty if the listener cannot answer it that way.
+    """
+    for host in ACCEPTED_HOSTS:
+        if host in job:
+            return [host + "/" + name]
+    if job != name:
+        return []
+    # The listener replaces the dots of a bare name with hyphens on Alibaba.
+    return [host + "/" + (name.replace(".", "-") if host == "aliyuncs.com" else name) for host in ACCEPTED_HOSTS]
+
+class ValidatedIndex(BucketIndex):
+    """
+    The index of the validator's results, keyed "<host>/<bucket name>" by the host that answered.
+    """
+
+    def refresh(self):
+        numNew = 0
+        for path in self.sources:
+            host = os.path.basename(os.path.dirname(path))
+            offset = self.meta["sources"].get(path, 0)
+            for names, offset in tailBuckets(path, offset):
+                numNew += len(self.addNew([host + "/" + name for name in names]))
+                self.meta["sources"][path] = offset
+        self.sync()
+        return numNew
+
+def getValidatedIndex():
+    """
+    The index of the validator's public, private and no_such_bucket results on every accepted host,
+    caught up with whatever was appended to them since the last run.
+    """
+    sources = sorted(path for host in ACCEPTED_HOSTS for f in VALIDATED_FILES for path in glob(f"./data/validation/{host}/{f}"))
+    return ValidatedIndex(VALIDATED_INDEX, sources=sources)
+
+class FeedProgress:
+    """
+    Counts of what happened to the names of the file, printed on one line with an ETA.
+    """
+
+    def __init__(self, totalBytes, interval=1.0):
+        self.totalBytes = totalBytes
+        self.interval = interval
+        self.start = self.lastPrint = time.time()
+        self.bytesRead = 0
+        self.lines = 0
+        self.sent = 0
+        self.invalid = 0
+        self.repeated = 0
+        self.validated = 0
+
+    def update(self, bytesRead, final=False):
+        self.bytesRead = bytesRead
+        now = time.time()
+        if not final and now - self.lastPrint < self.interval:
+            return
+        self.lastPrint = now
+        elapsed = max(now - self.start, 1e-9)
+        rate = self.bytesRead / elapsed
+        eta = (self.totalBytes - self.bytesRead) / rate if rate else 0
+        sys.stdout.write(
+            f"\r{self.bytesRead / max(self.totalBytes, 1):6.1%} {self.lines} lines ({self.lines / elapsed:.0f}/s): "
+            f"{self.sent} sent, {self.validated} already validated, {self.repeated} repeated, "
+            f"{self.invalid} invalid, ETA {eta:.0f}s "
+        )
+        if final:
+            sys.stdout.write(f"\nDone in {elapsed:.0f}s\n")
+        sys.stdout.flush()
 
 def feedToValidator(file, label):
-    with open(file, 'r') as f:
-        lines = list(f)
-    for line in lines:
-        line = line.strip()
-        print('CAND:', line)
-        beanstalk_client.put_job("extraction/" + label + "," + line)
+    """
+    :param file: the extraction file to feed.
+    :param label: the source label; jobs are logged by the validator under extraction/<label>.
+    """
+    validated = getValidatedIndex()
+    validity = ValidityFilter()
+    progress = FeedProgress(os.path.getsize(file))
+    prefix = "extraction/" + label + ","
+    with tempfile.TemporaryDirectory() as seenDirectory, open(file, 'rb') as f:
+        # Names fed in this run. It is not kept: a name is only skipped next time once validated.
+        seen = BucketIndex(seenDirectory, initialCapacity=int(1e6))
+        for lines in iter(lambda: f.readlines(BATCH_BYTES), []):
+            jobs = normalizeJobs(b''.join(lines).decode('utf-8', errors='ignore'))
+            bucketOf = dict(jobs)
+            valid = [job for (job, _), isValid in zip(jobs, validity.check([name for _, name in jobs])) if isValid]
+            # A domain and the bare name are different jobs: the bare name is probed on every host.
+            unique = seen.addNew(valid)
+            new = []
+            if unique:
+                keys = [validatedKeys(job, bucketOf[job]) for job in unique]
+                isValidated = iter(validated.containsHashes(hashNames([key for jobKeys in keys for key in jobKeys])).tolist())
+                # A job is only skipped once every host it is probed on has answered.
+                new = [job for job, jobKeys in zip(unique, keys) if not jobKeys or not all([next(isValidated) for _ in jobKeys])]
+            for job in new:
+                beanstalk_client.put_job(prefix + job)
+            progress.lines += len(lines)
+            progress.invalid += len(jobs) - len(valid)
+            progress.repeated += len(valid) - len(unique)
+            progress.validated += len(unique) - len(new)
+            progress.sent += len(new)
+            progress.update(f.tell())
+    beanstalk_client.flush()
+    progress.update(progress.totalBytes, final=True)
+    print(validity.summary())
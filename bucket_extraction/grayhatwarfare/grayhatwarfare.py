@@ -1,29 +1,48 @@
-import requests
-import json
+from ..utils.extract_utils import AZURE, DIGITALOCEAN, GCS, S3
+from ..utils.paged_extract import PagedSource, extractPaged
 import os
 
-def getGrayhatWarfare():
-    buckets = []
-    num_buckets = 100000
-    current = 0
-    chunk_size = 50000
-
-    access_token = os.getenv("GRAYHAT_ACCESS_TOKEN")
-
-    while current < num_buckets:
-      resp = requests.get("https://buckets.grayhatwarfare.com/api/v1/buckets/" + str(current) + "/" + str(chunk_size) + "?access_token=" + access_token)
-      resp_json = json.loads(resp.text)
-      for bucket in resp_json["buckets"]:
-        if bucket["type"] == "aws":
-          buckets.append(bucket["bucket"])
-      print(len(resp_json["buckets"]))
-    
-      current += chunk_size
-    out = './data/extraction/grayhatwarfare/grayhatwarfare.txt'
-    with open(out, 'w+') as f:
-        for b in buckets:
-            f.write(b + '\n')
-    print("Wrote buckets to " + out)
-            
+NUM_BUCKETS = 100000
+CHUNK_SIZE = 50000
+NUM_THREADS = 4
+OUTPUT_DIRECTORY = './data/extraction/grayhatwarfare/'
+# GrayHatWarfare bucket types, and the provider names used by the rest of the pipeline.
+PROVIDERS = {"aws": S3, "gcp": GCS, "azure": AZURE, "dos": DIGITALOCEAN}
+
+class GrayhatWarfareSource(PagedSource):
+    """
+    The GrayHatWarfare bucket listing. Every page is known in advance, so all are fetched at once.
+    """
+
+    name = "grayhatwarfare"
+    pageSize = CHUNK_SIZE
+    # Only AWS buckets used to be kept.
+    legacyFiles = {"grayhatwarfare.txt": S3}
+
+    def __init__(self, numBuckets=NUM_BUCKETS):
+        super().__init__(OUTPUT_DIRECTORY)
+        self.numBuckets = numBuckets
+        self.access_token = os.getenv("GRAYHAT_ACCESS_TOKEN")
+
+    def seeds(self):
+        for current in range(0, self.numBuckets, self.pageSize):
+            yield "buckets", current
+
+    def request(self, seed, offset):
+        return {
+            "url": "https://buckets.grayhatwarfare.com/api/v1/buckets/" + str(offset) + "/" + str(self.pageSize),
+            "params": {"access_token": self.access_token},
+        }
+
+    def parse(self, response):
+        buckets = response.json()["buckets"]
+        return [(PROVIDERS.get(bucket["type"], bucket["type"]), bucket["bucket"]) for bucket in buckets], len(buckets)
+
+    def nextOffset(self, seed, offset, numResults, numNew):
+        return None
+
+def getGrayhatWarfare(numBuckets=NUM_BUCKETS, numThreads=None):
+    extractPaged(GrayhatWarfareSource(numBuckets), numThreads=numThreads or NUM_THREADS)
+
 if __name__ == "__main__":
-  getGrayhatWarfare()
\ No newline at end of file
+  getGrayhatWarfare()
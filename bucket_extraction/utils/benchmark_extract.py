@@ -0,0 +1,43 @@
+"""
+Compare the throughput of the bucket extractors on a file, in MB/s.
+    python -m bucket_extraction.utils.benchmark_extract <file> [<file> ...]
+Use e.g. final_output/all_platforms_all.txt or a data/generation/<generator>.txt file.
+"""
+import argparse
+import os
+import time
+
+from bucket_extraction.utils.extract_utils import (
+    extractBuckets, extractFromFile, getBucketsFromText, getBucketsFromTextLegacy,
+)
+
+
+def timeExtractor(path, extract):
+    start = time.perf_counter()
+    numBuckets = extract(path)
+    elapsed = time.perf_counter() - start
+    return os.path.getsize(path) / 1e6 / elapsed, numBuckets
+
+def perLine(getBuckets):
+    def extract(path):
+        with open(path, 'r', errors='ignore') as f:
+            return sum(len(getBuckets(line)) for line in f)
+    return extract
+
+EXTRACTORS = {
+    "legacy getBucketsFromText, per line": perLine(getBucketsFromTextLegacy),
+    "getBucketsFromText, per line": perLine(getBucketsFromText),
+    "extractBuckets, per line": perLine(extractBuckets),
+    "extractFromFile": lambda path: sum(1 for _ in extractFromFile(path)),
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the bucket extractors.')
+    parser.add_argument("files", nargs="+", help="Text files to extract buckets from.")
+    args = parser.parse_args()
+    for path in args.files:
+        print(f"{path} ({os.path.getsize(path) / 1e6:.1f} MB)")
+        for name, extract in EXTRACTORS.items():
+            throughput, numBuckets = timeExtractor(path, extract)
+            print(f"    {name:<40}{throughput:>8.1f} MB/s {numBuckets:>12} buckets")
@@ -0,0 +1,308 @@
+"""
+Compact, persistent dedup index for bucket names.
+This is the Python counterpart of the listener's bloom filter (bucket_validation/bloom): a scalable
+bloom filter whose bit arrays are memory-mapped files, so memory stays bounded and a restart
+only has to map the files back in and read whatever was appended to its source files since.
+Shared by the extractors and the generators; bucket_generation.dedup re-exports it.
+"""
+import hashlib
+import json
+import math
+import os
+
+import numpy as np
+
+from bucket_extraction.utils.extract_utils import extractBuckets
+
+
+def hashNames(names):
+    """
+    Hash names into two independent 64-bit values for double hashing, vectorized over the batch.
+    Names are packed into 64-byte rows and mixed eight bytes at a time; longer names fall back to blake2b.
+    :param names: a list of strings.
+    :return: a (len(names), 2) uint64 array.
+    """
+    encoded = [name.encode('utf-8') for name in names]
+    lengths = np.fromiter(map(len, encoded), dtype=np.uint64, count=len(encoded))
+    rows = np.array(encoded, dtype='S64').view('<u8').reshape(len(encoded), 8)
+    with np.errstate(over='ignore'):
+        h = _mix(lengths)
+        for i in range(8):
+            h = _mix(h ^ rows[:, i])
+        for i in np.flatnonzero(lengths > 64):
+            h[i] = int.from_bytes(hashlib.blake2b(encoded[i], digest_size=8).digest(), 'little')
+        return np.stack([h, _mix(h ^ np.uint64(0x9e3779b97f4a7c15))], axis=1)
+
+def _mix(h):
+    # The splitmix64 finalizer.
+    h = (h ^ (h >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+    h = (h ^ (h >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+    return h ^ (h >> np.uint64(31))
+
+
+class BloomFilter:
+    """
+    Fixed-capacity blocked bloom filter over a memory-mapped bit array.
+    All the bits of a name fall in one 512-bit block (a cache line), so a lookup costs
+    a single random memory access no matter how many hash functions are used.
+    """
+
+    BLOCK_BITS = 512 # 2 ** 9
+    WORDS_PER_BLOCK = BLOCK_BITS // 64
+
+    def __init__(self, path, capacity, errorRate):
+        self.path = path
+        self.capacity = int(capacity)
+        self.errorRate = errorRate
+        bitsPerName, self.numHashes = blockedBloomParameters(errorRate, self.BLOCK_BITS)
+        self.numBlocks = int(math.ceil(self.capacity * bitsPerName / self.BLOCK_BITS))
+        numWords = self.numBlocks * self.WORDS_PER_BLOCK
+        if not os.path.exists(path) or os.path.getsize(path) == 0:
+            # A sparse file: untouched pages cost neither disk nor memory.
+            with open(path, 'wb') as f:
+                f.truncate(numWords * 8)
+        elif os.path.getsize(path) != numWords * 8:
+            raise ValueError(f"{path} was created with a different capacity or error rate.")
+        self.words = np.memmap(path, dtype=np.uint64, mode='r+', shape=(numWords,))
+        # A plain view of the same pages: indexing through the memmap subclass is much slower.
+        self.bits = self.words.view(np.ndarray)
+        # One odd multiplier per hash function; the top bits of key * salt pick a bit in the block.
+        with np.errstate(over='ignore'):
+            self.salts = (_mix(np.arange(1, self.numHashes + 1, dtype=np.uint64)) | np.uint64(1)).astype(np.uint32)
+
+    def positions(self, hashes):
+        """
+        :param hashes: the output of hashNames.
+        :return: (word indices, bit masks), both of shape (len(hashes), numHashes).
+        """
+        blocks = (hashes[:, 0] % np.uint64(self.numBlocks)).astype(np.intp)
+        keys = hashes[:, 1].astype(np.uint32)
+        with np.errstate(over='ignore'):
+            offsets = (keys[:, None] * self.salts) >> np.uint32(32 - 9)
+        wordIndices = blocks[:, None] * self.WORDS_PER_BLOCK + (offsets >> np.uint32(6))
+        masks = np.left_shift(np.uint64(1), (offsets & np.uint32(63)).astype(np.uint64))
+        return wordIndices, masks
+
+    def containsPositions(self, positions):
+        wordIndices, masks = positions
+        return np.all(self.bits[wordIndices] & masks, axis=1)
+
+    def addPositions(self, positions):
+        wordIndices, masks = positions
+        # Unlike a fancy-indexed |=, this applies every mask of a repeated word.
+        np.bitwise_or.at(self.bits, wordIndices.ravel(), masks.ravel())
+
+    def contains(self, hashes):
+        """
+        :param hashes: the output of hashNames.
+        :return: a boolean array, True where the name is (probably) in the filter.
+        """
+        return self.containsPositions(self.positions(hashes))
+
+    def add(self, hashes):
+        self.addPositions(self.positions(hashes))
+
+    def testAndAdd(self, hashes):
+        """
+        Add hashes to the filter.
+        :return: a boolean array, True where the name was not in the filter yet.
+        """
+        wordIndices, masks = self.positions(hashes)
+        new = ~self.containsPositions((wordIndices, masks))
+        self.addPositions((wordIndices[new], masks[new]))
+        return new
+
+    def flush(self):
+        self.words.flush()
+
+
+def blockedBloomParameters(errorRate, blockBits):
+    """
+    Blocked bloom filters need more bits than classic ones to reach the same error rate,
+    because names are unevenly spread over blocks. Grow the classic size until the
+    Poisson approximation of the blocked error rate reaches the target.
+    :return: (bits per name, number of hash functions).
+    """
+    bitsPerName = -math.log(errorRate) / math.log(2) ** 2
+    while True:
+        namesPerBlock = blockBits / bitsPerName
+        bestRate, bestHashes = min(
+            (_blockedErrorRate(namesPerBlock, numHashes, blockBits), numHashes)
+            for numHashes in range(1, 32)
+        )
+        if bestRate <= errorRate:
+            return bitsPerName, bestHashes
+        bitsPerName *= 1.05
+
+def _blockedErrorRate(namesPerBlock, numHashes, blockBits):
+    rate = 0
+    probability = math.exp(-namesPerBlock)
+    for j in range(int(namesPerBlock * 4) + 20):
+        if j > 0:
+            probability *= namesPerBlock / j
+        rate += probability * (1 - (1 - 1 / blockBits) ** (numHashes * j)) ** numHashes
+    return rate
+
+
+class ScalableBloomFilter:
+    """
+    A chain of bloom filters: once the newest one reaches capacity, a new one twice as large
+    and with half the error rate is added, which keeps the overall error rate bounded.
+    State lives in `directory`: one bit file per filter plus meta.json.
+    """
+
+    def __init__(self, directory, initialCapacity=int(1e7), errorRate=1e-6):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.metaPath = os.path.join(directory, "meta.json")
+        self.meta = {"initialCapacity": initialCapacity, "errorRate": errorRate, "counts": [], "sources": {}}
+        if os.path.exists(self.metaPath):
+            with open(self.metaPath, 'r') as f:
+                self.meta = json.load(f)
+        self.filters = []
+        for i in range(len(self.meta["counts"])):
+            self.filters.append(self._openFilter(i))
+        if not self.filters:
+            self._grow()
+
+    def _openFilter(self, i):
+        return BloomFilter(
+            os.path.join(self.directory, f"filter{i}.bits"),
+            self.meta["initialCapacity"] * 2 ** i,
+            self.meta["errorRate"] / 2 ** (i + 1),
+        )
+
+    def _grow(self):
+        self.filters.append(self._openFilter(len(self.filters)))
+        self.meta["counts"].append(0)
+
+    def containsHashes(self, hashes):
+        found = np.zeros(len(hashes), dtype=bool)
+        for bloom in self.filters:
+            if found.all():
+                break
+            missing = ~found
+            found[missing] = bloom.contains(hashes[missing])
+        return found
+
+    def addHashes(self, hashes):
+        """
+        Add hashes that are not in the filter yet.
+        """
+        start = 0
+        while start < len(hashes):
+            room = self.filters[-1].capacity - self.meta["counts"][-1]
+            if room <= 0:
+                self._grow()
+                continue
+            chunk = hashes[start:start + room]
+            self.filters[-1].add(chunk)
+            self.meta["counts"][-1] += len(chunk)
+            start += len(chunk)
+
+    def __len__(self):
+        return sum(self.meta["counts"])
+
+    def sync(self):
+        """
+        Flush the bit arrays and atomically rewrite the metadata.
+        """
+        for bloom in self.filters:
+            bloom.flush()
+        tmpPath = self.metaPath + ".tmp"
+        with open(tmpPath, 'w') as f:
+            json.dump(self.meta, f)
+        os.replace(tmpPath, self.metaPath)
+
+
+class BucketIndex(ScalableBloomFilter):
+    """
+    Set-like dedup store for bucket names.
+    Besides names added directly, it follows append-only source files (e.g. a generator's
+    data/generation/{name}.txt written by the listener) and remembers how far it has read them.
+    """
+
+    SYNC_EVERY = 100000
+
+    def __init__(self, directory, sources=(), **kwargs):
+        super().__init__(directory, **kwargs)
+        self.sources = list(sources)
+        self.unsynced = 0
+        self.refresh()
+
+    def __contains__(self, name):
+        return bool(self.containsHashes(hashNames([name]))[0])
+
+    def add(self, name):
+        self.update([name])
+
+    def update(self, names):
+        self.addNew(names)
+
+    def addNew(self, names):
+        """
+        Add names to the index.
+        :param names: an iterable of bucket names.
+        :return: the names that were not in the index yet, in order and without repeats.
+        """
+        names = list(dict.fromkeys(names))
+        if not names:
+            return []
+        hashes = hashNames(names)
+        new = ~self.containsHashes(hashes)
+        self.addHashes(hashes[new])
+        self.unsynced += int(new.sum())
+        if self.unsynced >= self.SYNC_EVERY:
+            self.sync()
+        return [name for name, isNew in zip(names, new) if isNew]
+
+    def __ior__(self, names):
+        self.update(names)
+        return self
+
+    def refresh(self):
+        """
+        Add the names appended to the source files since the last refresh.
+        :return: the number of new names.
+        """
+        numNew = 0
+        for path in self.sources:
+            offset = self.meta["sources"].get(path, 0)
+            for names, offset in tailBuckets(path, offset):
+                numNew += len(self.addNew(names))
+                self.meta["sources"][path] = offset
+        self.sync()
+        return numNew
+
+    def sync(self):
+        super().sync()
+        self.unsynced = 0
+
+
+def tailBuckets(path, offset=0, chunkSize=1 << 24):
+    """
+    Read the bucket names appended to a file past a byte offset.
+    Only complete lines are consumed, since the writer may be halfway through one.
+    :param path: an append-only text file, e.g. one written by the listener.
+    :param offset: the byte offset to start reading from.
+    :return: a generator of (names, offset) pairs, where offset is where the next read should start.
+    """
+    try:
+        f = open(path, 'rb')
+    except FileNotFoundError:
+        return
+    with f:
+        if os.fstat(f.fileno()).st_size < offset:
+            offset = 0 # The file was truncated or replaced, start over.
+        f.seek(offset)
+        remainder = b''
+        while True:
+            chunk = f.read(chunkSize)
+            if not chunk:
+                break
+            chunk = remainder + chunk
+            end = chunk.rfind(b'\n') + 1
+            remainder = chunk[end:]
+            offset += end
+            names = [bucket for _, bucket in extractBuckets(chunk[:end].decode('utf-8', errors='ignore'))]
+            yield names, offset
@@ -0,0 +1,117 @@
+"""
+Extract bucket names from huge text files (passive DNS dumps, VirusTotal results, corpora)
+on every core. Files are split into byte ranges aligned on line boundaries, each range is
+scanned by a worker process, and the workers' sets are merged as they come back, appending
+names not seen before to the output file.
+
+    python -m bucket_extraction.utils.bulk_extract <file> [<file> ...] -o buckets_output.txt
+"""
+import argparse
+import multiprocessing
+import os
+import time
+
+from bucket_extraction.utils.extract_utils import extractBuckets
+
+RANGE_SIZE = 1 << 26 # 64MB per task
+READ_SIZE = 1 << 24
+
+
+def splitRanges(path, rangeSize=RANGE_SIZE):
+    """
+    Split a file into byte ranges that start at the beginning of a line and end after a newline.
+    :return: a list of (path, start, end) triples covering the whole file.
+    """
+    size = os.path.getsize(path)
+    ranges = []
+    with open(path, 'rb') as f:
+        start = 0
+        while start < size:
+            end = start + rangeSize
+            if end >= size:
+                end = size
+            else:
+                f.seek(end)
+                f.readline() # Move the boundary past the end of the line it falls in.
+                end = f.tell()
+            ranges.append((path, start, end))
+            start = end
+    return ranges
+
+def extractRange(task):
+    """
+    :param task: a (path, start, end) triple from splitRanges.
+    :return: ((path, start, end), set of the bucket names in the range).
+    """
+    path, start, end = task
+    buckets = set()
+    with open(path, 'rb') as f:
+        f.seek(start)
+        position = start
+        remainder = b''
+        while position < end:
+            chunk = f.read(min(READ_SIZE, end - position))
+            if not chunk:
+                break
+            position += len(chunk)
+            chunk = remainder + chunk
+            cut = chunk.rfind(b'\n') + 1 if position < end else len(chunk)
+            remainder = chunk[cut:]
+            buckets.update(
+                bucket for _, bucket in extractBuckets(chunk[:cut].decode('utf-8', errors='ignore'))
+            )
+        if remainder:
+            buckets.update(bucket for _, bucket in extractBuckets(remainder.decode('utf-8', errors='ignore')))
+    return task, buckets
+
+def extractFiles(paths, outputPath=None, processes=None, rangeSize=RANGE_SIZE, verbose=True):
+    """
+    Extract the bucket names of every file in parallel.
+    :param paths: the files to read.
+    :param outputPath: if set, new names are appended to this file (one per line) as ranges finish.
+        Names it already contains are not written again.
+    :param processes: the number of worker processes, defaults to the number of cores.
+    :return: the set of bucket names found.
+    """
+    processes = processes or os.cpu_count()
+    # Smaller files are still split so that every worker gets a few ranges.
+    rangeSize = max(min(rangeSize, sum(os.path.getsize(path) for path in paths) // (4 * processes)), 1 << 20)
+    tasks = [task for path in paths for task in splitRanges(path, rangeSize)]
+    totalBytes = sum(end - start for _, start, end in tasks)
+    buckets = set()
+    if outputPath and os.path.exists(outputPath):
+        with open(outputPath, 'r') as f:
+            buckets.update(line.strip() for line in f)
+    output = open(outputPath, 'a') if outputPath else None
+    doneBytes = 0
+    startTime = time.time()
+    try:
+        with multiprocessing.Pool(processes) as pool:
+            for (_, start, end), rangeBuckets in pool.imap_unordered(extractRange, tasks):
+                new = rangeBuckets - buckets
+                buckets |= new
+                if output is not None and new:
+                    output.write("".join(f"{bucket}\n" for bucket in new))
+                    output.flush()
+                doneBytes += end - start
+                if verbose:
+                    elapsed = time.time() - startTime
+                    print(
+                        f"{doneBytes / 1e6:.0f}/{totalBytes / 1e6:.0f} MB, {len(buckets)} buckets, "
+                        f"{doneBytes / 1e6 / max(elapsed, 1e-9):.1f} MB/s",
+                        flush=True,
+                    )
+    finally:
+        if output is not None:
+            output.close()
+    return buckets
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Extract bucket names from large files on all cores.')
+    parser.add_argument("files", nargs="+", help="Text files to extract buckets from.")
+    parser.add_argument("-o", "--output", type=str, help="Append new bucket names to this file.")
+    parser.add_argument("-p", "--processes", type=int, help="Number of worker processes.")
+    args = parser.parse_args()
+    buckets = extractFiles(args.files, outputPath=args.output, processes=args.processes)
+    print(f"Found {len(buckets)} buckets.")
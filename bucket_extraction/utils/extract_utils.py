@@ -1,21 +1,167 @@
 """
 Scrape a given site's source for buckets.
+
+All providers are matched in a single pass. Virtual-hosted names (bucket.s3.amazonaws.com) are
+found by scanning the reversed text, so that each pattern starts with a literal host suffix the
+regex engine can skip to instead of trying a bucket name at every character. Path-style URLs
+(s3.amazonaws.com/bucket) are anchored at the start of a line and scanned forwards.
 """
 import requests
 import re
-    
+
+S3 = "s3"
+GCS = "gcs"
+DIGITALOCEAN = "digitalocean"
+OSS = "oss"
+WASABI = "wasabi"
+# Not matched in text, but sources like GrayHatWarfare list Azure containers.
+AZURE = "azure"
+
+# The per-provider regexes getBucketsFromText used to try one after the other.
+LEGACY_REGEXES = [r'([\w\d_\.-]+)\.s3[\w\d-]*\.amazonaws\.com',
+                  r'([\w\d_\.-]+)\.storage\.googleapis\.com',
+                  r'([\w\d_\.-]+)\.[\w\d\.-]*\.cdn\.digitaloceanspaces\.com',
+                  r'([\w\d_-]+)\.oss[\w\d-]*\.aliyuncs\.com',
+                  r'^[^.]*s3[\w\d-]*\.amazonaws\.com\/([\w\d_.-]+)',
+                  r'^[^.]*s3[\w\d\.-]*\.wasabisys\.com\/([\w\d_.-]+)',
+                  r'^[^.]*storage\.googleapis\.com\/([\w\d_.-]+)',
+                  r'^[^.]*oss[\w\d_-]*\.aliyuncs\.com\/([\w\d_.-]+)']
+
+# Each capture group is one of LEGACY_REGEXES, reversed. The bucket is captured reversed too.
+# S3 also matches the dotted regional endpoints (bucket.s3.us-east-1.amazonaws.com).
+VIRTUAL_HOSTED = re.compile(
+    r'moc\.(?:'
+    r'swanozama\.(?:\d-(?:[a-z]+-)+[a-z]{2}\.)?[\w-]*3s\.([\w.-]+)'
+    r'|sipaelgoog\.egarots\.([\w.-]+)'
+    r'|secapsnaecolatigid\.ndc\.[\w.-]*?\.([\w.-]+)'
+    r'|scnuyila\.[\w-]*sso\.([\w-]+)'
+    r')'
+)
+# The remaining LEGACY_REGEXES, in the same order, without matching across lines.
+PATH_STYLE = re.compile(
+    r'^[^.\n]*(?:'
+    r's3[\w-]*(?:\.[a-z]{2}(?:-[a-z]+)+-\d)?\.amazonaws\.com/([\w.-]+)'
+    r'|s3[\w.-]*\.wasabisys\.com/([\w.-]+)'
+    r'|storage\.googleapis\.com/([\w.-]+)'
+    r'|oss[\w-]*\.aliyuncs\.com/([\w.-]+)'
+    r')',
+    re.MULTILINE,
+)
+VIRTUAL_HOSTED_PROVIDERS = [S3, GCS, DIGITALOCEAN, OSS]
+PATH_STYLE_PROVIDERS = [S3, WASABI, GCS, OSS]
+# Every match contains one of these, so text without any of them can be skipped.
+HOST_SUFFIXES = ("amazonaws.com", "googleapis.com", "digitaloceanspaces.com", "aliyuncs.com", "wasabisys.com")
+
+def _scan(text):
+    """
+    :param text: lowercase text.
+    :return: a list of (position, legacy regex index, bucket) triples, in order of appearance.
+    """
+    length = len(text)
+    matches = []
+    for groups in VIRTUAL_HOSTED.finditer(text[::-1]):
+        index = groups.lastindex
+        matches.append((length - groups.end(index), index - 1, groups.group(index)[::-1]))
+    matches.reverse()
+    if '.com/' in text:
+        pathMatches = [
+            (groups.start(groups.lastindex), groups.lastindex + 3, groups.group(groups.lastindex))
+            for groups in PATH_STYLE.finditer(text)
+        ]
+        if pathMatches:
+            matches = sorted(matches + pathMatches)
+    return matches
+
+def _mayContainBuckets(text):
+    return any(suffix in text for suffix in HOST_SUFFIXES)
+
+def extractBuckets(text):
+    """
+    Find every bucket in the text, whatever its provider.
+    :param text: any text, e.g. a line of a file or a page snippet.
+    :return: a list of (provider, bucket) pairs in order of appearance.
+    """
+    text = text.lower()
+    if not _mayContainBuckets(text):
+        return []
+    return [
+        (VIRTUAL_HOSTED_PROVIDERS[index] if index < 4 else PATH_STYLE_PROVIDERS[index - 4], bucket)
+        for _, index, bucket in _scan(text)
+    ]
+
+def extractBucketPositions(text):
+    """
+    extractBuckets, with where each bucket starts in the text.
+    :return: a list of (position, provider, bucket) triples in order of appearance.
+    """
+    text = text.lower()
+    if not _mayContainBuckets(text):
+        return []
+    return [
+        (position, VIRTUAL_HOSTED_PROVIDERS[index] if index < 4 else PATH_STYLE_PROVIDERS[index - 4], bucket)
+        for position, index, bucket in _scan(text)
+    ]
+
 def getBucketsFromText(text):
-    regexes = [r'([\w\d_\.-]+)\.s3[\w\d-]*\.amazonaws\.com',
-               r'([\w\d_\.-]+)\.storage\.googleapis\.com',
-               r'([\w\d_\.-]+)\.[\w\d\.-]*\.cdn\.digitaloceanspaces\.com',
-               r'([\w\d_-]+)\.oss[\w\d-]*\.aliyuncs\.com',
-               r'^[^.]*s3[\w\d-]*\.amazonaws\.com\/([\w\d_.-]+)',
-               r'^[^.]*s3[\w\d\.-]*\.wasabisys\.com\/([\w\d_.-]+)',
-               r'^[^.]*storage\.googleapis\.com\/([\w\d_.-]+)',
-               r'^[^.]*oss[\w\d_-]*\.aliyuncs\.com\/([\w\d_.-]+)']
-    for regex in regexes:
+    """
+    Find the buckets of the first provider pattern (in LEGACY_REGEXES order) that matches the text.
+    Prefer extractBuckets, which does not drop the buckets of other providers.
+    :return: a list of bucket names, or an empty set if there are none.
+    """
+    text = text.lower()
+    if not _mayContainBuckets(text):
+        return set()
+    matches = _scan(text)
+    if not matches:
+        return set()
+    first = min(index for _, index, _ in matches)
+    return [bucket for _, index, bucket in matches if index == first]
+
+def getBucketsFromTextLegacy(text):
+    """
+    The original implementation of getBucketsFromText, kept as a reference for benchmarks.
+    """
+    for regex in LEGACY_REGEXES:
         found = re.findall(regex, text.lower())
         if len(found) > 0:
             return found
     return set()
 
+def extractFromLines(lines, batchSize=10000):
+    """
+    Find every bucket in an iterable of lines, scanning them in batches.
+    :param lines: an iterable of strings.
+    :return: a generator of (provider, bucket) pairs.
+    """
+    batch = []
+    for line in lines:
+        batch.append(line)
+        if len(batch) >= batchSize:
+            yield from extractBuckets("\n".join(batch))
+            batch = []
+    if batch:
+        yield from extractBuckets("\n".join(batch))
+
+def extractFromFile(path, chunkSize=1 << 24):
+    """
+    Find every bucket in a file, reading it in chunks that end on a line boundary.
+    :param path: the path of a text file.
+    :param chunkSize: the number of bytes to read at once.
+    :return: a generator of (provider, bucket) pairs.
+    """
+    with open(path, 'rb') as f:
+        remainder = b''
+        while True:
+            chunk = f.read(chunkSize)
+            if not chunk:
+                break
+            chunk = remainder + chunk
+            end = chunk.rfind(b'\n') + 1
+            if end == 0:
+                # A single line longer than the chunk, keep reading.
+                remainder = chunk
+                continue
+            remainder = chunk[end:]
+            yield from extractBuckets(chunk[:end].decode('utf-8', errors='ignore'))
+        if remainder:
+            yield from extractBuckets(remainder.decode('utf-8', errors='ignore'))
@@ -0,0 +1,214 @@
+"""
+Paged extraction from HTTP search APIs (Bing, GrayHatWarfare).
+A source turns seeds (e.g. search queries) into page requests and pages into (provider, bucket)
+pairs. Pages are fetched concurrently, seeds whose pages keep yielding new buckets are walked
+deeper, and new names are appended to one file per provider, deduplicated with an on-disk index.
+"""
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import requests
+
+from bucket_extraction.utils.rate_limit import backoff
+from bucket_extraction.utils.bucket_index import BucketIndex
+
+MAX_RETRIES = 5
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class PagedSource:
+    """
+    A paged HTTP source. Subclasses set name and pageSize, and implement seeds, request and parse.
+    :param directory: where the per-provider output files are written.
+    :param maxOffset: seeds are not walked past this offset.
+    :param minNew: a page must yield at least this many new buckets for its seed to be walked deeper.
+    """
+
+    name = None
+    pageSize = 50
+    # Bucket files written by earlier versions of the source, in its directory, one name per line:
+    # {file name: the provider of its buckets, or None if they were mixed}.
+    legacyFiles = {}
+
+    def __init__(self, directory, maxOffset=0, minNew=1):
+        self.directory = directory
+        self.maxOffset = maxOffset
+        self.minNew = minNew
+
+    def seeds(self):
+        """
+        :return: an iterable of (seed, offset) pairs to start from.
+        """
+        raise NotImplementedError
+
+    def request(self, seed, offset):
+        """
+        :return: the keyword arguments of requests.get for the page of the seed at the offset.
+        """
+        raise NotImplementedError
+
+    def parse(self, response):
+        """
+        :return: (a list of (provider, bucket) pairs, the number of results on the page).
+        """
+        raise NotImplementedError
+
+    def nextOffset(self, seed, offset, numResults, numNew):
+        """
+        :return: the offset of the next page of the seed, or None to stop walking it.
+        """
+        nextOffset = offset + self.pageSize
+        if numResults >= self.pageSize and numNew >= self.minNew and nextOffset < self.maxOffset:
+            return nextOffset
+        return None
+
+
+class ProviderOutput:
+    """
+    The append-only bucket files of a source, one per provider: <directory>/<provider>.txt.
+    Each file has a BucketIndex in <directory>/.seen/<provider> that remembers how far it has
+    read the file, so a restart only reads what was appended since.
+    :param legacyFiles: {file name: provider or None} of the files buckets were written to before
+        the output was split by provider. The index of that provider (of every provider for None)
+        is seeded with them once, so they are not written out again.
+    """
+
+    def __init__(self, directory, legacyFiles=None):
+        self.directory = directory
+        self.legacyFiles = {os.path.join(directory, name): provider for name, provider in (legacyFiles or {}).items()}
+        os.makedirs(directory, exist_ok=True)
+        self.indexes = {}
+        self.files = {}
+
+    def path(self, provider):
+        return os.path.join(self.directory, provider + ".txt")
+
+    def _open(self, provider):
+        path = self.path(provider)
+        index = self.indexes[provider] = BucketIndex(os.path.join(self.directory, ".seen", provider))
+        for legacyPath, legacyProvider in self.legacyFiles.items():
+            if legacyProvider not in (None, provider) or legacyPath in index.meta["sources"]:
+                continue
+            if not os.path.exists(legacyPath):
+                continue
+            with open(legacyPath, 'rb') as f:
+                index.addNew(line.strip().decode('utf-8', errors='ignore') for line in f if line.strip())
+                index.meta["sources"][legacyPath] = f.tell()
+        offset = index.meta["sources"].get(path, 0)
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                if os.fstat(f.fileno()).st_size < offset:
+                    offset = 0 # The file was truncated or replaced, start over.
+                f.seek(offset)
+                lines = f.readlines()
+            if lines and not lines[-1].endswith(b'\n'):
+                lines[-1] += b'\n'
+                with open(path, 'ab') as f:
+                    f.write(b'\n')
+            index.addNew(line.strip().decode('utf-8', errors='ignore') for line in lines if line.strip())
+        self.files[provider] = open(path, 'a')
+        index.meta["sources"][path] = self.files[provider].tell()
+        return index
+
+    def add(self, pairs):
+        """
+        :param pairs: (provider, bucket) pairs.
+        :return: the number of buckets per provider that were not in its file yet.
+        """
+        byProvider = {}
+        for provider, bucket in pairs:
+            byProvider.setdefault(provider, []).append(bucket)
+        numNew = {}
+        for provider, buckets in byProvider.items():
+            index = self.indexes.get(provider) or self._open(provider)
+            new = index.addNew(buckets)
+            if new:
+                f = self.files[provider]
+                f.write("".join(bucket + "\n" for bucket in new))
+                f.flush()
+                index.meta["sources"][self.path(provider)] = f.tell()
+            numNew[provider] = len(new)
+        return numNew
+
+    def close(self):
+        for provider, index in self.indexes.items():
+            self.files[provider].close()
+            index.sync()
+
+
+sessions = threading.local()
+
+def fetchPage(source, seed, offset, rateLimiter=None):
+    """
+    Fetch and parse a page, retrying with backoff when the request fails or is throttled.
+    :return: the result of source.parse, or None if the page could not be fetched.
+    """
+    session = getattr(sessions, "session", None)
+    if session is None:
+        session = sessions.session = requests.Session()
+    for attempt in range(1, MAX_RETRIES + 1):
+        if rateLimiter is not None:
+            rateLimiter.acquire()
+        try:
+            with session.get(timeout=60, **source.request(seed, offset)) as resp:
+                status = resp.status_code
+                if status == 200:
+                    return source.parse(resp)
+        except (requests.RequestException, ValueError) as e:
+            status = e
+        if not isinstance(status, Exception) and status not in RETRY_STATUSES:
+            break
+        delay = backoff(attempt)
+        if status == 429 and rateLimiter is not None:
+            rateLimiter.pause(delay)
+        time.sleep(delay)
+    print("Error: {} {} at offset {}: {}".format(source.name, seed, offset, status))
+    return None
+
+def extractPaged(source, numThreads=10, rateLimiter=None):
+    """
+    Fetch the pages of every seed of the source concurrently, walking productive seeds deeper,
+    and append new buckets to the source's per-provider files.
+    :param source: a PagedSource.
+    :param numThreads: the number of pages fetched at once.
+    :param rateLimiter: an optional RateLimiter shared by the workers.
+    :return: the number of new buckets per provider.
+    """
+    output = ProviderOutput(source.directory, source.legacyFiles)
+    numPages = 0
+    newByProvider = {}
+    startTime = time.time()
+    with ThreadPoolExecutor(numThreads) as pool:
+        inFlight = {
+            pool.submit(fetchPage, source, seed, offset, rateLimiter): (seed, offset)
+            for seed, offset in source.seeds()
+        }
+        try:
+            while inFlight:
+                finished, _ = wait(inFlight, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    seed, offset = inFlight.pop(future)
+                    numPages += 1
+                    page = future.result()
+                    if page is None:
+                        continue
+                    pairs, numResults = page
+                    added = output.add(pairs)
+                    for provider, numNew in added.items():
+                        newByProvider[provider] = newByProvider.get(provider, 0) + numNew
+                    numNew = sum(added.values())
+                    nextOffset = source.nextOffset(seed, offset, numResults, numNew)
+                    if nextOffset is not None:
+                        inFlight[pool.submit(fetchPage, source, seed, nextOffset, rateLimiter)] = (seed, nextOffset)
+                if numPages % 10 == 0 or not inFlight:
+                    print("{}: {} pages, {} new buckets, {:.0f}s".format(
+                        source.name, numPages, sum(newByProvider.values()), time.time() - startTime), flush=True)
+        finally:
+            for future in inFlight:
+                future.cancel()
+            output.close()
+    for provider, numNew in sorted(newByProvider.items()):
+        print("Wrote {} new buckets to {}".format(numNew, output.path(provider)))
+    return newByProvider
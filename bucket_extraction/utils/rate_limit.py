@@ -0,0 +1,55 @@
+"""
+Rate limiting and retries shared by the API scrapers, so that concurrent workers stay within a quota.
+"""
+import random
+import threading
+import time
+
+
+class RateLimiter:
+    """
+    A thread-safe token bucket: tokens are added at a steady rate up to a maximum burst,
+    and each request takes one, waiting for it if the bucket is empty.
+    :param rate: the number of requests allowed per second on average.
+    :param burst: the number of requests that can be made at once after being idle.
+    """
+
+    def __init__(self, rate, burst=1):
+        assert rate > 0 and burst >= 1, "Rate must be positive and burst at least 1."
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        """
+        Take the tokens, then wait until the bucket would have had them. Tokens are reserved
+        in the order callers arrive, so a waiting thread cannot be overtaken by later ones.
+        :return: the number of seconds spent waiting.
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= tokens
+            wait = max(0.0, -self.tokens / self.rate)
+        if wait:
+            time.sleep(wait)
+        return wait
+
+    def pause(self, seconds):
+        """
+        Stop handing out tokens for a while, e.g. after the server answered 429.
+        """
+        with self.lock:
+            self.tokens = min(self.tokens, 0) - seconds * self.rate
+            self.last = time.monotonic()
+
+def backoff(attempt, base=1.0, cap=60.0):
+    """
+    Seconds to wait before retrying: exponential in the attempt number, with full jitter
+    so that workers that failed together do not retry together.
+    :param attempt: the number of attempts that already failed, starting at 1.
+    """
+    return random.uniform(0, min(cap, base * 2 ** (attempt - 1)))
@@ -1,18 +1,30 @@
 import requests
 import subprocess
-import grequests
-from .. import getBucketsFromText
+from .. import extractBuckets
+from ..utils.rate_limit import RateLimiter, backoff
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 import os
+import threading
+import time
 
 S3_IP_URL = "https://ip-ranges.amazonaws.com/ip-ranges.json"
 API_KEY = os.getenv("VIRUSTOTAL_API_KEY")
 IP_LOOKUP_ENDPOINT = "https://www.virustotal.com/vtapi/v2/ip-address/report"
-BATCH_SEARCH = 100
 NUM_THREADS = 10
+# The public API allows 4 lookups a minute, raise this to match a premium key.
+REQUESTS_PER_MINUTE = 4
+MAX_RETRIES = 5
+# Seconds between two saves of the results and of the position in the IP file.
+FLUSH_INTERVAL = 5
 OUTPUT_NAME = "./data/extraction/virustotal/buckets_output.txt"
+DOMAINS_OUTPUT = "./data/extraction/virustotal/domains_output.txt"
+LIVE_IPS = "./data/extraction/virustotal/live_ips.txt"
+REMAINING_IPS = "./data/extraction/virustotal/rem_ips.txt"
 
-def exception(request, exception):
-    print("Error: {}: {}".format(request.url, exception))
+# No burst: any more would go over the quota within the first minute, whatever the thread count.
+rate_limiter = RateLimiter(REQUESTS_PER_MINUTE / 60, burst=1)
+sessions = threading.local()
 
 # Fetches CIDR ranges of all S3 IPs from Amazon
 def getS3IPs():
@@ -30,58 +42,197 @@ def runZmap():
     with open("./data/extraction/virustotal/all_ips.txt", "r") as f:
         cidrs = f.read().splitlines()
     print(" ".join(cidrs))
-    command = "sudo zmap -i ens8 --probe-module=icmp_echoscan -B 10M -o ./data/extraction/virustotal/live_ips.txt " + " ".join(cidrs)
+    command = "sudo zmap -i ens8 --probe-module=icmp_echoscan -B 10M -o " + LIVE_IPS + " " + " ".join(cidrs)
     subprocess.call(command, shell=True)
-    subprocess.call("cp ./data/extraction/virustotal/live_ips.txt ./data/extraction/virustotal/rem_ips.txt", shell=True)
+    subprocess.call("cp " + LIVE_IPS + " " + REMAINING_IPS, shell=True)
+    # Lookups start over on the new scan.
+    IPCursor(REMAINING_IPS).reset()
 
-def lookup(num):
-    with open("./data/extraction/virustotal/rem_ips.txt", "r") as f:
-        ips = f.read().splitlines()
-
-    domains = set()
-    with open("./data/extraction/virustotal/domains_output.txt", "r") as  f:
-        domains = set(line.strip() for line in f)
-    buckets = set()
-    with open(OUTPUT_NAME, "r") as  f:
-        buckets = set(line.strip() for line in f)
-    while num > 0:
-        numSearches = min(num, BATCH_SEARCH)
-        num -= numSearches
-        reqs = []
-        for i in range(0, numSearches):
-            ip = ips.pop(0)
-            reqs.append(grequests.get(
-                IP_LOOKUP_ENDPOINT,
-                params={
-                        "apikey": API_KEY,
-                        "ip": ip
-                        },
-                stream=False))
-
-        results = grequests.map(reqs, exception_handler=exception, size=NUM_THREADS)
-        for result in results:
-            if result is None:
-                print("Error: null response")
-                continue
-            parsed = result.json()
-            if ("response_code" in parsed and parsed["response_code"] == "0") or "resolutions" not in parsed:
-                result.close()
+class StopLookup(Exception):
+    """
+    Raised when lookups cannot go on, e.g. when the API quota is used up.
+    """
+
+class IPCursor:
+    """
+    Reads an IP file line by line from a saved byte offset. IPs can be looked up out of order:
+    the saved offset only moves past an IP once it and every IP before it are done.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.offsetPath = path + ".offset"
+        self.offset = 0
+        if os.path.exists(self.offsetPath):
+            with open(self.offsetPath, 'r') as f:
+                self.offset = int(f.read().strip() or 0)
+        self.file = None
+        self.pending = deque()
+
+    def __iter__(self):
+        """
+        :return: a generator of (ip, entry) pairs, where entry is passed to done once the IP is looked up.
+        """
+        with open(self.path, 'rb') as self.file:
+            self.file.seek(self.offset)
+            for line in self.file:
+                entry = [self.file.tell(), False]
+                self.pending.append(entry)
+                ip = line.strip().decode()
+                if ip:
+                    yield ip, entry
+                else:
+                    self.done(entry)
+
+    def done(self, entry):
+        entry[1] = True
+        while self.pending and self.pending[0][1]:
+            self.offset = self.pending.popleft()[0]
+
+    def save(self):
+        tmpPath = self.offsetPath + ".tmp"
+        with open(tmpPath, 'w') as f:
+            f.write(str(self.offset))
+        os.replace(tmpPath, self.offsetPath)
+
+    def reset(self):
+        self.offset = 0
+        self.pending.clear()
+        if os.path.exists(self.offsetPath):
+            os.remove(self.offsetPath)
+
+class LookupResults:
+    """
+    The domains and buckets found so far, appended to their files without repeats.
+    """
+
+    def __init__(self, domainsPath=DOMAINS_OUTPUT, bucketsPath=OUTPUT_NAME):
+        self.domains = readLines(domainsPath)
+        self.buckets = readLines(bucketsPath)
+        self.domainsFile = open(domainsPath, 'a')
+        self.bucketsFile = open(bucketsPath, 'a')
+        self.newBuckets = 0
+
+    def add(self, hostnames):
+        for hostname in hostnames:
+            if hostname in self.domains:
                 continue
-            for res in parsed["resolutions"]:
-                if "hostname" in res and res["hostname"] is not None:
-                    domains.add(res["hostname"])
-                    buckets = buckets.union(getBucketsFromText(res["hostname"]))
-            result.close()
+            self.domains.add(hostname)
+            self.domainsFile.write(hostname + "\n")
+            for _, bucket in extractBuckets(hostname):
+                if bucket not in self.buckets:
+                    self.buckets.add(bucket)
+                    self.bucketsFile.write(bucket + "\n")
+                    self.newBuckets += 1
+
+    def flush(self):
+        for f in (self.domainsFile, self.bucketsFile):
+            f.flush()
+            os.fsync(f.fileno())
+
+    def close(self):
+        self.flush()
+        self.domainsFile.close()
+        self.bucketsFile.close()
 
-    with open(OUTPUT_NAME, 'w+') as f:
-        f.write("\n".join(buckets))
+def readLines(path):
+    if not os.path.exists(path):
+        return set()
+    with open(path, 'r') as f:
+        return set(line.strip() for line in f if line.strip())
 
-    with open("./bucket_extraction/virustotal/domains_output.txt", 'w+') as f:
-        f.write("\n".join(domains))
+def getSession():
+    session = getattr(sessions, "session", None)
+    if session is None:
+        session = sessions.session = requests.Session()
+    return session
 
-    with open("./bucket_extraction/virustotal/rem_ips.txt", "w+") as f:
-        f.write("\n".join(ips))
+def lookupIP(ip):
+    """
+    :return: the hostnames the IP resolved to.
+    :raises StopLookup: if the key is rejected, or the quota is still exceeded after every retry.
+    """
+    for attempt in range(1, MAX_RETRIES + 1):
+        rate_limiter.acquire()
+        try:
+            with getSession().get(IP_LOOKUP_ENDPOINT, params={"apikey": API_KEY, "ip": ip}, timeout=60) as resp:
+                status = resp.status_code
+                if status == 200:
+                    parsed = resp.json()
+                    return [res["hostname"] for res in parsed.get("resolutions", ()) if res.get("hostname")]
+        except (requests.RequestException, ValueError) as e:
+            status = e
+        if status == 403:
+            raise StopLookup("API key rejected")
+        # 204 means the request rate or the quota is exceeded.
+        if not isinstance(status, Exception) and status not in (204, 429) and status < 500:
+            print("Error: {}: {}".format(ip, status))
+            return []
+        delay = backoff(attempt, base=60 / REQUESTS_PER_MINUTE, cap=600)
+        if status in (204, 429):
+            rate_limiter.pause(delay)
+        print("Retrying {} in {:.0f}s ({})".format(ip, delay, status))
+        time.sleep(delay)
+    raise StopLookup("{} failed {} times, last with {}".format(ip, MAX_RETRIES, status))
 
-    print("Wrote buckets to " + OUTPUT_NAME)
+def lookup(num):
+    """
+    Look up the next num IPs of rem_ips.txt on VirusTotal, and append the domains they resolved
+    to and the buckets in them to domains_output.txt and buckets_output.txt.
+    Results and the position in rem_ips.txt are saved every few seconds, so a crash or a quota
+    stop loses little work, and the next run carries on from there.
+    """
+    cursor = IPCursor(REMAINING_IPS)
+    results = LookupResults()
+    inFlight = {}
+    lastFlush = time.time()
+    numDone = 0
+    stopped = None
+
+    def save():
+        # Results go to disk before the offset that covers them.
+        results.flush()
+        cursor.save()
 
+    def collect(futures):
+        nonlocal numDone, stopped
+        for future in futures:
+            entry = inFlight.pop(future)
+            if future.cancelled():
+                continue
+            try:
+                results.add(future.result())
+            except StopLookup as e:
+                stopped = stopped or e
+                continue
+            cursor.done(entry)
+            numDone += 1
 
+    pool = ThreadPoolExecutor(NUM_THREADS)
+    try:
+        for ip, entry in cursor:
+            if num <= 0 or stopped:
+                break
+            num -= 1
+            while len(inFlight) >= 2 * NUM_THREADS:
+                finished, _ = wait(inFlight, timeout=FLUSH_INTERVAL, return_when=FIRST_COMPLETED)
+                collect(finished)
+                if time.time() - lastFlush > FLUSH_INTERVAL:
+                    save()
+                    lastFlush = time.time()
+                    print("Looked up {} IPs, {} new buckets".format(numDone, results.newBuckets))
+            inFlight[pool.submit(lookupIP, ip)] = entry
+        while inFlight:
+            finished, _ = wait(inFlight, timeout=FLUSH_INTERVAL, return_when=FIRST_COMPLETED)
+            collect(finished)
+            if stopped:
+                for future in inFlight:
+                    future.cancel()
+            save()
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+        save()
+        results.close()
+    if stopped:
+        print("Stopped: {}".format(stopped))
+    print("Looked up {} IPs, wrote {} new buckets to {}".format(numDone, results.newBuckets, OUTPUT_NAME))
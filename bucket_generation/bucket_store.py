@@ -0,0 +1,402 @@
+"""
+A columnar store of every bucket the validator found, in ./data/store.
+One row per bucket domain, with its provider, whether it is public, the source whose job found
+it (e.g. "generation/pcfg" or "extraction/bing") and when it was first seen. Each column is a
+flat binary file mapped with numpy, and the domains are kept once in a newline-separated heap
+the rows point into, so queries like "public buckets found by pcfg after T" are vectorized over
+the columns and only the matching names are ever decoded.
+
+The store is caught up incrementally from the validator's output: the visibility files in
+data/validation/<host>/ give the rows, and the per-source logs the listener writes
+(data/generation/<name>.txt, data/extraction/<label>.txt) tell which source found them.
+
+    python -m bucket_generation.bucket_store [--public] [--source generation/pcfg] [--after T]
+"""
+import argparse
+from glob import glob
+import json
+import mmap
+import os
+import random
+import time
+
+import numpy as np
+
+from bucket_generation.dedup import hashNames
+from bucket_generation.final_output import bucketSpans
+
+STORE_DIRECTORY = "./data/store"
+VALIDATION_DIRECTORY = "./data/validation"
+# The listener logs each job's result to ./data/<source label>.txt.
+SOURCE_DIRECTORIES = ["./data/generation", "./data/extraction"]
+VISIBILITIES = {"public.txt": True, "private.txt": False}
+UNKNOWN = ""
+
+COLUMNS = {
+    # Where the domain is in the heap, and where its bucket is in the domain.
+    "offset": "<u8",
+    "length": "<u2",
+    "bucketStart": "<u2",
+    "bucketLength": "<u2",
+    "domainHash": "<u8",
+    "bucketHash": "<u8",
+    # Indices into the store's labels of that column, 0 being UNKNOWN.
+    "provider": "u1",
+    "source": "<u2",
+    "public": "?",
+    "firstSeen": "<i8",
+}
+LABELED = ["provider", "source"]
+READ_BYTES = 1 << 24
+# How long after the listener logs a result to its source its visibility line may still be missing.
+SETTLE_SECONDS = 60
+
+
+def readLines(path, offset, end=None):
+    """
+    Read the "domain,timestamp" lines of a file between two byte offsets.
+    Only complete lines are consumed, since the writer may be halfway through one.
+    :return: a generator of (domains, timestamps, offset) triples, where offset is where the next read should start.
+    """
+    try:
+        f = open(path, 'rb')
+    except FileNotFoundError:
+        return
+    with f:
+        size = os.fstat(f.fileno()).st_size
+        if size < offset:
+            offset = 0 # The file was truncated or replaced, start over.
+        end = size if end is None else min(end, size)
+        f.seek(offset)
+        remainder = b''
+        position = offset
+        while position < end:
+            data = f.read(min(READ_BYTES, end - position))
+            if not data:
+                break
+            position += len(data)
+            chunk = remainder + data
+            complete = chunk.rfind(b'\n') + 1
+            remainder = chunk[complete:]
+            if not complete:
+                continue
+            domains = []
+            timestamps = []
+            for line in chunk[:complete].decode('utf-8', errors='ignore').splitlines():
+                domain, _, timestamp = line.strip().partition(",")
+                if domain and timestamp.isdigit():
+                    domains.append(domain)
+                    timestamps.append(int(timestamp))
+            offset += complete
+            yield domains, timestamps, offset
+
+
+class BucketStore:
+    """
+    The columns of the store, mapped read-only. Call refresh to catch up with the validator.
+    :param directory: where the store is kept.
+    """
+
+    def __init__(self, directory=STORE_DIRECTORY):
+        self.directory = directory
+        self.metaPath = os.path.join(directory, "meta.json")
+        self.heapPath = os.path.join(directory, "domains.txt")
+        self.load()
+
+    def load(self):
+        """
+        Map the rows committed so far.
+        """
+        if os.path.exists(self.metaPath):
+            with open(self.metaPath, 'r') as f:
+                self.meta = json.load(f)
+        else:
+            self.meta = {
+                "numRows": 0, "heapSize": 0, "index": None, "offsets": {},
+                "labels": {column: [UNKNOWN] for column in LABELED},
+            }
+        self._map()
+
+    def _map(self):
+        self.numRows = self.meta["numRows"]
+        self.columns = {}
+        for column, dtype in COLUMNS.items():
+            if self.numRows:
+                self.columns[column] = np.memmap(self.columnPath(column), dtype=dtype, mode='r', shape=(self.numRows,))
+            else:
+                self.columns[column] = np.zeros(0, dtype=dtype)
+        if self.numRows:
+            # (domain hash, row) pairs sorted by hash.
+            self.index = np.load(os.path.join(self.directory, self.meta["index"]), mmap_mode='r')
+            with open(self.heapPath, 'rb') as f:
+                self.heap = mmap.mmap(f.fileno(), self.meta["heapSize"], access=mmap.ACCESS_READ)
+        else:
+            self.index = np.zeros((0, 2), dtype=np.uint64)
+            self.heap = b''
+
+    def columnPath(self, column):
+        return os.path.join(self.directory, column + ".bin")
+
+    def __len__(self):
+        return self.numRows
+
+    def labels(self, column):
+        """
+        :return: the labels of a LABELED column, indexed by the values stored in it.
+        """
+        return self.meta["labels"][column]
+
+    def _codes(self, column, label):
+        # A label ending in "/" selects every label under it, e.g. "generation/".
+        return [
+            code for code, other in enumerate(self.labels(column))
+            if other == label or (label.endswith("/") and other.startswith(label))
+        ]
+
+    def select(self, public=None, provider=None, source=None, after=None, before=None):
+        """
+        Filter the rows on their columns; filters left to None are not applied.
+        :param public: True for the public buckets, False for the private ones.
+        :param provider: a provider, e.g. extract_utils.S3.
+        :param source: a source label, e.g. "generation/pcfg", or a prefix ending with "/".
+        :param after: only the buckets first seen at or after this Unix timestamp.
+        :param before: only the buckets first seen before this Unix timestamp.
+        :return: the matching row numbers, in row order.
+        """
+        mask = np.ones(self.numRows, dtype=bool)
+        if public is not None:
+            mask &= self.columns["public"] == bool(public)
+        if provider is not None:
+            mask &= np.isin(self.columns["provider"], self._codes("provider", provider))
+        if source is not None:
+            mask &= np.isin(self.columns["source"], self._codes("source", source))
+        if after is not None:
+            mask &= self.columns["firstSeen"] >= after
+        if before is not None:
+            mask &= self.columns["firstSeen"] < before
+        return np.flatnonzero(mask)
+
+    def names(self, rows, domains=False):
+        """
+        :param rows: row numbers, e.g. from select.
+        :param domains: True for the full domains, False for the bucket names.
+        :return: a list of strings.
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        starts = self.columns["offset"][rows]
+        lengths = self.columns["length"][rows]
+        if not domains:
+            starts = starts + self.columns["bucketStart"][rows]
+            lengths = self.columns["bucketLength"][rows]
+        heap = self.heap
+        return [
+            heap[start:start + length].decode('utf-8')
+            for start, length in zip(starts.tolist(), lengths.tolist())
+        ]
+
+    def nameBytes(self, rows):
+        """
+        The bucket names of rows as one flat byte array, without decoding them.
+        :param rows: row numbers, e.g. from select.
+        :return: (a uint8 array of the names' bytes one after the other, an array of len(rows) + 1
+            offsets into it where each name starts, the last one being its length).
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        starts = (self.columns["offset"][rows] + self.columns["bucketStart"][rows]).astype(np.int64)
+        lengths = self.columns["bucketLength"][rows].astype(np.int64)
+        offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        positions = np.repeat(starts - offsets[:-1], lengths) + np.arange(offsets[-1])
+        heap = np.frombuffer(self.heap, dtype=np.uint8) if len(self.heap) else np.zeros(0, dtype=np.uint8)
+        return heap[positions], offsets
+
+    def uniqueBuckets(self, rows):
+        """
+        :return: the rows with a distinct bucket name, the same name on two providers counting once.
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        _, first = np.unique(self.columns["bucketHash"][rows], return_index=True)
+        rows = np.sort(rows[first])
+        return rows[self.columns["bucketLength"][rows] > 0]
+
+    def sample(self, k, **filters):
+        """
+        :param k: the number of names to draw.
+        :param filters: the filters of select.
+        :return: up to k distinct bucket names drawn at random from the matching rows.
+        """
+        rows = self.uniqueBuckets(self.select(**filters))
+        return self.names(np.sort(random.sample(rows.tolist(), min(k, len(rows)))))
+
+    def findDomains(self, domains, hashes=None):
+        """
+        :return: the row of each domain, or -1 for the domains not in the store.
+        """
+        rows = np.full(len(domains), -1, dtype=np.int64)
+        if not len(self.index) or not domains:
+            return rows
+        hashes = hashNames(domains)[:, 0] if hashes is None else hashes
+        positions = np.minimum(np.searchsorted(self.index[:, 0], hashes), len(self.index) - 1)
+        candidates = np.flatnonzero(self.index[positions, 0] == hashes)
+        found = self.index[positions[candidates], 1].astype(np.int64)
+        for i, row, name in zip(candidates.tolist(), found.tolist(), self.names(found, domains=True)):
+            if name == domains[i]:
+                rows[i] = row
+        return rows
+
+    def refresh(self):
+        """
+        Add the buckets validated since the last refresh, then attribute them to the sources that
+        submitted them. The store has a single writer; readers only see rows once committed.
+        :return: (the number of new rows, the number of rows attributed to a source).
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        offsets = self.meta["offsets"]
+        settled = int(time.time()) - SETTLE_SECONDS
+        new = {}
+        for fileName, public in VISIBILITIES.items():
+            for path in sorted(glob(os.path.join(VALIDATION_DIRECTORY, "*", fileName))):
+                for domains, timestamps, offsets[path] in readLines(path, offsets.get(path, 0)):
+                    for domain, timestamp in zip(domains, timestamps):
+                        if domain not in new or timestamp < new[domain][0]:
+                            new[domain] = (timestamp, public)
+        numNew = self._append(new)
+
+        # The listener logs a result to its source before the visibility file, so a source line
+        # can belong to a visibility line written after the pass above. Sources are read up to
+        # their size after that pass, and a chunk holding a recent line whose domain is not in the
+        # store yet is read again next time instead of being skipped for good. Domains that do not
+        # exist are logged too and never show up, so they only hold their chunk SETTLE_SECONDS.
+        sourcePaths = sorted(
+            path for directory in SOURCE_DIRECTORIES for path in glob(os.path.join(directory, "**", "*.txt"), recursive=True)
+        )
+        sourceEnds = {path: os.path.getsize(path) for path in sourcePaths}
+        numAttributed = 0
+        if self.numRows:
+            source = np.memmap(self.columnPath("source"), dtype=COLUMNS["source"], mode='r+', shape=(self.numRows,))
+            for path in sourcePaths:
+                label = os.path.relpath(path, "./data")[:-len(".txt")]
+                code = None
+                for domains, timestamps, end in readLines(path, offsets.get(path, 0), sourceEnds[path]):
+                    rows = self.findDomains(domains)
+                    timestamps = np.array(timestamps, dtype=np.int64)
+                    # The job that first found the bucket was logged with the same timestamp.
+                    found = rows >= 0
+                    rows = rows[found]
+                    rows = rows[(self.columns["firstSeen"][rows] == timestamps[found]) & (source[rows] == 0)]
+                    if len(rows):
+                        if code is None:
+                            code = self._labelCode("source", label)
+                        source[rows] = code
+                        numAttributed += len(rows)
+                    if np.any(~found & (timestamps > settled)):
+                        break
+                    offsets[path] = end
+            source.flush()
+        self._commit()
+        return numNew, numAttributed
+
+    def _labelCode(self, column, label):
+        labels = self.meta["labels"][column]
+        if label not in labels:
+            labels.append(label)
+        return labels.index(label)
+
+    def _append(self, new):
+        """
+        Append the rows of new domains to the column files and the heap.
+        :param new: {domain: (first seen, public)}.
+        """
+        domains = [domain for domain in new if len(domain.encode('utf-8')) < 1 << 16]
+        if domains:
+            domains = [domain for domain, row in zip(domains, self.findDomains(domains)) if row < 0]
+        # Rows are kept in the order they were first seen.
+        domains.sort(key=lambda domain: new[domain][0])
+        buckets, providers, starts = bucketSpans(domains)
+        keep = [i for i, bucket in enumerate(buckets) if bucket]
+        if not keep:
+            return 0
+        domains = [domains[i] for i in keep]
+        buckets = [buckets[i] for i in keep]
+        encoded = [domain.encode('utf-8') + b'\n' for domain in domains]
+        lengths = np.array([len(data) - 1 for data in encoded], dtype=np.uint64)
+        columns = {
+            "offset": self.meta["heapSize"] + np.cumsum(lengths + np.uint64(1)) - lengths - np.uint64(1),
+            "length": lengths,
+            "bucketStart": [starts[i] for i in keep],
+            "bucketLength": [len(bucket.encode('utf-8')) for bucket in buckets],
+            "domainHash": hashNames(domains)[:, 0],
+            "bucketHash": hashNames(buckets)[:, 0],
+            "provider": [self._labelCode("provider", providers[i]) for i in keep],
+            "source": np.zeros(len(domains)),
+            "public": [new[domain][1] for domain in domains],
+            "firstSeen": [new[domain][0] for domain in domains],
+        }
+        # A crash may have left rows past the committed ones: drop them before appending.
+        with open(self.heapPath, 'ab') as f:
+            f.truncate(self.meta["heapSize"])
+            f.write(b"".join(encoded))
+        for column, dtype in COLUMNS.items():
+            with open(self.columnPath(column), 'ab') as f:
+                f.truncate(self.numRows * np.dtype(dtype).itemsize)
+                f.write(np.asarray(columns[column]).astype(dtype).tobytes())
+
+        # The index is written under a new name, so readers of the last commit keep theirs.
+        index = np.concatenate([np.asarray(self.index), np.stack([
+            columns["domainHash"], np.arange(self.numRows, self.numRows + len(domains), dtype=np.uint64)
+        ], axis=1)])
+        self.meta["index"] = f"domains.{self.numRows + len(domains)}.npy"
+        np.save(os.path.join(self.directory, self.meta["index"]), index[np.argsort(index[:, 0], kind='stable')])
+        self.meta["numRows"] += len(domains)
+        self.meta["heapSize"] += sum(map(len, encoded))
+        self._map()
+        return len(domains)
+
+    def _commit(self):
+        tmpPath = self.metaPath + ".tmp"
+        with open(tmpPath, 'w') as f:
+            json.dump(self.meta, f)
+        os.replace(tmpPath, self.metaPath)
+        for path in glob(os.path.join(self.directory, "domains.*.npy")):
+            if os.path.basename(path) != self.meta["index"]:
+                os.remove(path)
+
+
+def parseTimestamp(value):
+    """
+    :param value: a Unix timestamp or an ISO date, e.g. 2020-07-20.
+    """
+    if value.isdigit():
+        return int(value)
+    return int(time.mktime(time.strptime(value, "%Y-%m-%d")))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Catch up the bucket store with the validator and query it.')
+    visibility = parser.add_mutually_exclusive_group()
+    visibility.add_argument("--public", dest="public", action="store_true", default=None, help="Only public buckets.")
+    visibility.add_argument("--private", dest="public", action="store_false", help="Only private buckets.")
+    parser.add_argument("--provider", type=str, help="Only buckets of this provider, e.g. s3.")
+    parser.add_argument("--source", type=str, help="Only buckets found by this source, e.g. generation/pcfg, or generation/ for all generators.")
+    parser.add_argument("--after", type=parseTimestamp, help="Only buckets first seen at or after this time (Unix timestamp or YYYY-MM-DD).")
+    parser.add_argument("--before", type=parseTimestamp, help="Only buckets first seen before this time (Unix timestamp or YYYY-MM-DD).")
+    parser.add_argument("--domains", action="store_true", help="Print the full domains instead of the bucket names.")
+    parser.add_argument("--count", action="store_true", help="Only print the number of matching buckets.")
+    parser.add_argument("--no_refresh", action="store_true", help="Query the store as it is, without catching up first.")
+    args = parser.parse_args()
+
+    store = BucketStore()
+    if not args.no_refresh:
+        start = time.time()
+        numNew, numAttributed = store.refresh()
+        print(f"{numNew} new buckets, {numAttributed} attributed to a source, {len(store)} in total ({time.time() - start:.1f}s)")
+    filters = {
+        "public": args.public, "provider": args.provider, "source": args.source,
+        "after": args.after, "before": args.before,
+    }
+    if any(value is not None for value in filters.values()) or args.count or args.domains:
+        rows = store.select(**filters)
+        if args.count:
+            print(len(rows))
+        else:
+            for name in store.names(rows, domains=args.domains):
+                print(name)
@@ -0,0 +1,120 @@
+"""
+Dedup of the names the generators submit to the validator, across every generator on the machine.
+The bloom filters and the per-source BucketIndex live in bucket_extraction.utils.bucket_index,
+since the extractors use them too; they are re-exported here.
+"""
+from contextlib import contextmanager
+import fcntl
+import json
+import os
+
+import numpy as np
+
+from bucket_extraction.utils.bucket_index import BloomFilter, BucketIndex, hashNames, tailBuckets
+
+
+class SharedSubmissions:
+    """
+    Names submitted to the validator by any generator on this machine.
+    A scalable bloom filter shared by every process, guarded by an advisory file lock so that
+    checking and claiming a batch of names is atomic across processes. Like ScalableBloomFilter,
+    a new filter twice as large and with half the error rate is added once the newest one is full,
+    so the error rate stays bounded however many names are submitted. The number of names in each
+    filter lives in a small memory-mapped file, so every process sees the filters others add.
+    State lives in `directory`: meta.json, counts and one bit file per filter.
+    """
+
+    MAX_FILTERS = 32
+
+    def __init__(self, directory, initialCapacity=int(1e7), errorRate=1e-5):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.lockFile = open(os.path.join(directory, "lock"), 'a')
+        metaPath = os.path.join(directory, "meta.json")
+        countsPath = os.path.join(directory, "counts")
+        with self._locked():
+            if not os.path.exists(metaPath):
+                with open(countsPath, 'wb') as f:
+                    f.truncate(self.MAX_FILTERS * 8)
+                with open(metaPath + ".tmp", 'w') as f:
+                    json.dump({"initialCapacity": initialCapacity, "errorRate": errorRate}, f)
+                os.replace(metaPath + ".tmp", metaPath)
+            with open(metaPath, 'r') as f:
+                self.meta = json.load(f)
+        # counts[i] is the number of names in filter i; the filters in use are those up to the last nonzero one.
+        self.counts = np.memmap(countsPath, dtype=np.int64, mode='r+', shape=(self.MAX_FILTERS,))
+        self.filters = []
+
+    @contextmanager
+    def _locked(self):
+        fcntl.flock(self.lockFile, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self.lockFile, fcntl.LOCK_UN)
+
+    def _capacity(self, i):
+        return self.meta["initialCapacity"] * 2 ** i
+
+    def _openFilters(self):
+        # Catch up with the filters other processes added; there is always at least one.
+        numFilters = max(int(np.flatnonzero(self.counts).max(initial=-1)) + 1, 1)
+        while len(self.filters) < numFilters:
+            self._grow()
+
+    def _grow(self):
+        i = len(self.filters)
+        self.filters.append(BloomFilter(
+            os.path.join(self.directory, f"filter{i}.bits"), self._capacity(i), self.meta["errorRate"] / 2 ** (i + 1),
+        ))
+
+    def __len__(self):
+        return int(self.counts.sum())
+
+    def _contains(self, hashes):
+        found = np.zeros(len(hashes), dtype=bool)
+        for bloom in self.filters:
+            missing = np.flatnonzero(~found)
+            if not len(missing):
+                break
+            found[missing] = bloom.contains(hashes[missing])
+        return found
+
+    def __contains__(self, name):
+        with self._locked():
+            self._openFilters()
+            return bool(self._contains(hashNames([name]))[0])
+
+    def claim(self, names):
+        """
+        Mark names as submitted.
+        :param names: an iterable of bucket names about to be submitted.
+        :return: the names that no process had submitted yet, in order and without repeats.
+        """
+        names = list(dict.fromkeys(names))
+        if not names:
+            return []
+        hashes = hashNames(names)
+        with self._locked():
+            self._openFilters()
+            new = np.flatnonzero(~self._contains(hashes))
+            start = 0
+            while start < len(new):
+                i = len(self.filters) - 1
+                room = self._capacity(i) - int(self.counts[i])
+                if room <= 0:
+                    if i + 1 == self.MAX_FILTERS:
+                        raise ValueError(f"{self.directory} is full.")
+                    # Other processes open it once its count is nonzero, i.e. once this claim is done.
+                    self._grow()
+                    continue
+                chunk = new[start:start + room]
+                self.filters[-1].add(hashes[chunk])
+                self.counts[i] += len(chunk)
+                start += len(chunk)
+        return [names[i] for i in new.tolist()]
+
+    def sync(self):
+        for bloom in self.filters:
+            bloom.flush()
+        self.counts.flush()
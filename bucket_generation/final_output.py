@@ -0,0 +1,424 @@
+"""
+The merged lists of every bucket the validator found, in ./final_output:
+all_platforms_{public,private,all}.txt, one "domain,timestamp" line per bucket domain, sorted by
+domain, with the earliest timestamp it was seen at.
+
+Merging is incremental: the read offset of every validation file is remembered, only the lines
+appended since are parsed, and they are spliced into the sorted files by copying the unchanged
+byte ranges around them. Next to the text files, ./final_output/.index holds a binary index of
+each file: per line its offset, timestamp and hashes, plus the domain and bucket hashes in sorted
+order, so that getExistingBuckets and getFullBuckets map them in instead of parsing the text.
+
+    python -m bucket_generation.final_output [--rebuild]
+"""
+import argparse
+import bisect
+from collections.abc import Set
+import json
+import mmap
+import os
+import time
+
+import numpy as np
+
+from bucket_extraction import extractBucketPositions
+from bucket_generation.dedup import hashNames
+
+OUTPUT_DIRECTORY = "./final_output"
+INDEX_DIRECTORY = "./final_output/.index"
+VALIDATION_DIRECTORY = "./data/validation"
+HOSTS = ["s3.amazonaws.com", "storage.googleapis.com", "aliyuncs.com", "bucket_types"]
+PUBLIC = "public"
+PRIVATE = "private"
+ALL = "all"
+KINDS = [PUBLIC, PRIVATE, ALL]
+
+LINE_DTYPE = np.dtype([
+    ("offset", "<u8"),
+    ("timestamp", "<i8"),
+    ("domainHash", "<u8"),
+    ("bucketHash", "<u8"),
+    ("domainLength", "<u2"),
+    ("bucketStart", "<u2"),
+    # 0 if the domain holds no bucket name.
+    ("bucketLength", "<u2"),
+])
+ENTRY_DTYPE = np.dtype([("hash", "<u8"), ("line", "<u8")])
+
+
+def textPath(kind):
+    return os.path.join(OUTPUT_DIRECTORY, f"all_platforms_{kind}.txt")
+
+def indexPath(kind, part):
+    return os.path.join(INDEX_DIRECTORY, f"{kind}.{part}.npy")
+
+def statePath():
+    return os.path.join(INDEX_DIRECTORY, "state.json")
+
+def sourcePaths(kind):
+    """
+    :return: the validation files merged into the final output file of a kind.
+    """
+    if kind == ALL:
+        return sourcePaths(PUBLIC) + sourcePaths(PRIVATE)
+    return [os.path.join(VALIDATION_DIRECTORY, host, f"{kind}.txt") for host in HOSTS]
+
+def loadState():
+    """
+    :return: {"offsets": {kind: {validation file: offset read up to}}, "files": {kind: text file info}}.
+    """
+    if not os.path.exists(statePath()):
+        return {"offsets": {}, "files": {}}
+    with open(statePath(), 'r') as f:
+        return json.load(f)
+
+def saveState(state):
+    tmpPath = statePath() + ".tmp"
+    with open(tmpPath, 'w') as f:
+        json.dump(state, f)
+    os.replace(tmpPath, statePath())
+
+def _mapText(path):
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return b''
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class BucketFile:
+    """
+    A sorted final output file and its index, mapped read-only.
+    :param kind: PUBLIC, PRIVATE or ALL.
+    :param state: the merge state; the index is only used if it matches the text file.
+    """
+
+    def __init__(self, kind, state=None):
+        self.kind = kind
+        self.path = textPath(kind)
+        state = state or loadState()
+        info = state["files"].get(kind)
+        self.valid = (
+            info is not None and os.path.exists(self.path) and os.path.getsize(self.path) == info["textSize"]
+            and all(os.path.exists(indexPath(kind, part)) for part in ("lines", "domains", "buckets"))
+        )
+        if self.valid:
+            self.text = _mapText(self.path)
+            self.lines = np.load(indexPath(kind, "lines"), mmap_mode='r')
+            self.domains = np.load(indexPath(kind, "domains"), mmap_mode='r')
+            self.buckets = np.load(indexPath(kind, "buckets"), mmap_mode='r')
+            # Plain views of the columns read one value at a time, which is slow through a memmap.
+            self.offsets = np.asarray(self.lines["offset"])
+            self.domainLengths = np.asarray(self.lines["domainLength"])
+        else:
+            self.text = b''
+            self.lines = np.zeros(0, dtype=LINE_DTYPE)
+            self.domains = np.zeros(0, dtype=ENTRY_DTYPE)
+            self.buckets = np.zeros(0, dtype=ENTRY_DTYPE)
+            self.offsets = self.lines["offset"]
+            self.domainLengths = self.lines["domainLength"]
+
+    def domainAt(self, line):
+        offset = int(self.offsets[line])
+        return bytes(self.text[offset:offset + int(self.domainLengths[line])]).decode('utf-8')
+
+    def findDomains(self, names, hashes):
+        """
+        :return: the line of each domain in the file, or -1 for the domains it does not hold.
+        """
+        lines = np.full(len(names), -1, dtype=np.int64)
+        if not len(self.domains):
+            return lines
+        positions = np.minimum(np.searchsorted(self.domains["hash"], hashes), len(self.domains) - 1)
+        candidates = np.flatnonzero(self.domains["hash"][positions] == hashes)
+        for i, line in zip(candidates.tolist(), self.domains["line"][positions[candidates]].tolist()):
+            if self.domainAt(line) == names[i]:
+                lines[i] = line
+        return lines
+
+
+class IndexedNames(Set):
+    """
+    A read-only set of the bucket names (or full domains) of a final output file, backed by its
+    mapped index: loading it costs nothing, membership is a binary search over sorted hashes, and
+    names are only decoded from the text when iterated.
+    Operators that build a new set (&, |, -) return a plain set.
+    :param bucketFile: a valid BucketFile.
+    :param domains: True for the full domains, False for the bucket names.
+    """
+
+    def __init__(self, bucketFile, domains=False):
+        self.file = bucketFile
+        self.domains = domains
+        self.entries = bucketFile.domains if domains else bucketFile.buckets
+
+    @classmethod
+    def _from_iterable(cls, iterable):
+        return set(iterable)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _spans(self, lines):
+        rows = self.file.lines[lines]
+        if self.domains:
+            return rows["offset"], rows["domainLength"]
+        return rows["offset"] + rows["bucketStart"], rows["bucketLength"]
+
+    def __iter__(self):
+        # In file order, so the text is read sequentially.
+        starts, lengths = self._spans(np.sort(self.entries["line"]))
+        text = self.file.text
+        for start, length in zip(starts.tolist(), lengths.tolist()):
+            yield bytes(text[start:start + length]).decode('utf-8')
+
+    def contains(self, names):
+        """
+        :param names: a list of strings.
+        :return: a boolean array, True for the names in the set.
+        """
+        found = np.zeros(len(names), dtype=bool)
+        if not names or not len(self.entries):
+            return found
+        hashes = hashNames(names)[:, 0]
+        positions = np.minimum(np.searchsorted(self.entries["hash"], hashes), len(self.entries) - 1)
+        candidates = np.flatnonzero(self.entries["hash"][positions] == hashes)
+        starts, lengths = self._spans(self.entries["line"][positions[candidates]])
+        text = self.file.text
+        for i, start, length in zip(candidates.tolist(), starts.tolist(), lengths.tolist()):
+            found[i] = bytes(text[start:start + length]) == names[i].encode('utf-8')
+        return found
+
+    def __contains__(self, name):
+        return isinstance(name, str) and bool(self.contains([name])[0])
+
+    def __and__(self, other):
+        other = list(other)
+        return set(name for name, isIn in zip(other, self.contains(other)) if isIn)
+
+    __rand__ = __and__
+
+
+def readNames(kind, domains=False):
+    """
+    :param kind: PUBLIC, PRIVATE or ALL.
+    :param domains: True for the full domains, False for the bucket names.
+    :return: an IndexedNames, or None if the file has no up to date index (e.g. it was written
+        by another tool), in which case the caller should parse the text.
+    """
+    bucketFile = BucketFile(kind)
+    if not bucketFile.valid:
+        return None
+    return IndexedNames(bucketFile, domains=domains)
+
+
+def readNewLines(path, offset):
+    """
+    Parse the "domain,timestamp" lines appended to a validation file past an offset.
+    :return: ({domain: earliest timestamp}, the offset after the last complete line).
+    """
+    entries = {}
+    try:
+        f = open(path, 'rb')
+    except FileNotFoundError:
+        return entries, 0
+    with f:
+        if os.fstat(f.fileno()).st_size < offset:
+            offset = 0 # The file was truncated or replaced, start over.
+        f.seek(offset)
+        data = f.read()
+    end = data.rfind(b'\n') + 1
+    for line in data[:end].decode('utf-8', errors='ignore').splitlines():
+        domain, _, timestamp = line.strip().partition(",")
+        if not domain or not timestamp.isdigit():
+            continue
+        timestamp = int(timestamp)
+        if entries.get(domain, timestamp) >= timestamp:
+            entries[domain] = timestamp
+    return entries, offset + end
+
+def bucketSpans(names):
+    """
+    Find the bucket of each domain, scanning them all at once.
+    :param names: a list of domains.
+    :return: (bucket names, providers, byte offsets of the buckets in the domains), with an empty
+        bucket and provider for the domains that hold none.
+    """
+    buckets = [""] * len(names)
+    providers = [""] * len(names)
+    starts = [0] * len(names)
+    if not names:
+        return buckets, providers, starts
+    lineStarts = np.cumsum([0] + [len(name) + 1 for name in names[:-1]])
+    found = extractBucketPositions("\n".join(names))
+    lineOf = np.searchsorted(lineStarts, [position for position, _, _ in found], side='right') - 1
+    # Each line's bucket is the first one found on it.
+    for (position, provider, bucket), line, lineStart in zip(found, lineOf.tolist(), lineStarts[lineOf].tolist()):
+        name = names[line]
+        start = position - lineStart
+        if buckets[line] or name[start:start + len(bucket)].lower() != bucket:
+            continue
+        buckets[line] = bucket
+        providers[line] = provider
+        starts[line] = start if name.isascii() else len(name[:start].encode('utf-8'))
+    return buckets, providers, starts
+
+def newLineRows(names, timestamps):
+    """
+    :return: the LINE_DTYPE rows of new lines, with their offset left at 0.
+    """
+    rows = np.zeros(len(names), dtype=LINE_DTYPE)
+    if not names:
+        return rows
+    buckets, _, starts = bucketSpans(names)
+    rows["bucketStart"] = starts
+    rows["bucketLength"] = [len(bucket.encode('utf-8')) for bucket in buckets]
+    rows["timestamp"] = timestamps
+    rows["domainHash"] = hashNames(names)[:, 0]
+    rows["bucketHash"] = hashNames(buckets)[:, 0]
+    rows["domainLength"] = [len(name.encode('utf-8')) for name in names]
+    return rows
+
+def mergeFile(kind, entries, state):
+    """
+    Splice new domains into a sorted final output file and rewrite its index.
+    Domains it already holds are only rewritten if they were seen earlier than it says.
+    :param entries: {domain: earliest timestamp} of the new validation lines.
+    :return: the number of lines added or changed.
+    """
+    old = BucketFile(kind, state)
+    names = sorted(name for name in entries if len(name.encode('utf-8')) < 1 << 16)
+    hashes = hashNames(names)[:, 0] if names else np.zeros(0, dtype=np.uint64)
+    existing = old.findDomains(names, hashes)
+
+    # (old line to insert before or replace, 0 to insert / 1 to replace, name)
+    events = []
+    lo = 0
+    oldDomains = _DomainList(old)
+    for name, line in zip(names, existing.tolist()):
+        if line < 0:
+            lo = bisect.bisect_left(oldDomains, name, lo)
+            events.append((lo, 0, name))
+        elif entries[name] < int(old.lines["timestamp"][line]):
+            events.append((line, 1, name))
+    if not events and old.valid:
+        return 0
+    events.sort()
+    newNames = [name for _, _, name in events]
+    newText = [f"{name},{entries[name]}\n".encode('utf-8') for name in newNames]
+
+    # The new index: kept old lines and new lines, new ones right before the old line they go at.
+    numOld = len(old.lines)
+    oldLengths = np.diff(old.offsets, append=np.uint64(len(old.text)))
+    kept = np.ones(numOld, dtype=bool)
+    kept[[line for line, replace, _ in events if replace]] = False
+    keptLines = np.flatnonzero(kept)
+    keys = np.concatenate([2 * np.array([line for line, _, _ in events], dtype=np.int64), 2 * keptLines + 1])
+    order = np.argsort(keys, kind='stable')
+    lines = np.concatenate([newLineRows(newNames, [entries[name] for name in newNames]), old.lines[keptLines]])[order]
+    lengths = np.concatenate([np.array([len(data) for data in newText], dtype=np.uint64), oldLengths[keptLines]])[order]
+    lines["offset"] = np.cumsum(lengths) - lengths
+
+    def oldOffset(line):
+        return int(old.offsets[line]) if line < numOld else len(old.text)
+
+    tmpText = textPath(kind) + ".tmp"
+    with open(tmpText, 'wb') as f:
+        current = 0
+        pending = []
+        for (line, replace, _), data in zip(events, newText):
+            if line > current:
+                f.write(b"".join(pending))
+                pending = []
+                f.write(old.text[oldOffset(current):oldOffset(line)])
+            pending.append(data)
+            current = max(current, line + replace)
+        f.write(b"".join(pending))
+        f.write(old.text[oldOffset(current):])
+    writeIndex(kind, lines)
+    os.replace(tmpText, textPath(kind))
+    state["files"][kind] = {"textSize": int(lengths.sum()), "numLines": len(lines)}
+    return len(events)
+
+class _DomainList:
+    """
+    The domains of a BucketFile as a read-only sequence, for bisect.
+    """
+
+    def __init__(self, bucketFile):
+        self.file = bucketFile
+
+    def __len__(self):
+        return len(self.file.lines)
+
+    def __getitem__(self, line):
+        return self.file.domainAt(line)
+
+def writeIndex(kind, lines):
+    domainOrder = np.argsort(lines["domainHash"], kind='stable')
+    domains = np.zeros(len(lines), dtype=ENTRY_DTYPE)
+    domains["hash"] = lines["domainHash"][domainOrder]
+    domains["line"] = domainOrder
+
+    withBucket = np.flatnonzero(lines["bucketLength"] > 0)
+    bucketOrder = withBucket[np.argsort(lines["bucketHash"][withBucket], kind='stable')]
+    sortedHashes = lines["bucketHash"][bucketOrder]
+    first = np.ones(len(sortedHashes), dtype=bool)
+    first[1:] = sortedHashes[1:] != sortedHashes[:-1]
+    buckets = np.zeros(int(first.sum()), dtype=ENTRY_DTYPE)
+    buckets["hash"] = sortedHashes[first]
+    buckets["line"] = bucketOrder[first]
+
+    for part, array in (("lines", lines), ("domains", domains), ("buckets", buckets)):
+        tmpPath = indexPath(kind, part) + ".tmp.npy"
+        np.save(tmpPath, array)
+        os.replace(tmpPath, indexPath(kind, part))
+
+def gatherKind(kind, state):
+    """
+    Merge the lines appended to the validation files of a kind since the last run into its final
+    output file, then save the state along with it.
+    If the file's index does not match it (an index file is missing, the text was edited, or a run
+    stopped between replacing the text and saving the state), the offsets read up to are no longer
+    those of the text, so the file is rebuilt from its own lines and every validation file instead.
+    :return: the number of lines added or changed.
+    """
+    offsets = state["offsets"].setdefault(kind, {})
+    new = {}
+    if not BucketFile(kind, state).valid:
+        offsets.clear()
+        state["files"].pop(kind, None)
+        if os.path.exists(textPath(kind)):
+            new, _ = readNewLines(textPath(kind), 0)
+    for path in sourcePaths(kind):
+        entries, offsets[path] = readNewLines(path, offsets.get(path, 0))
+        for domain, timestamp in entries.items():
+            if new.get(domain, timestamp) >= timestamp:
+                new[domain] = timestamp
+    changed = mergeFile(kind, new, state)
+    saveState(state)
+    return changed
+
+def gatherAllBuckets(rebuild=False):
+    """
+    Merge the lines appended to the validation files since the last run into the final output.
+    :param rebuild: ignore the previous state and merge every validation file from the start.
+    :return: {kind: number of lines added or changed}.
+    """
+    os.makedirs(INDEX_DIRECTORY, exist_ok=True)
+    state = {"offsets": {}, "files": {}} if rebuild else loadState()
+    if rebuild:
+        for kind in KINDS:
+            if os.path.exists(textPath(kind)):
+                os.remove(textPath(kind))
+    return {kind: gatherKind(kind, state) for kind in KINDS}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Merge the validated buckets into ./final_output.')
+    parser.add_argument("--rebuild", action="store_true", help="Merge every validation file from the start.")
+    args = parser.parse_args()
+    start = time.time()
+    changed = gatherAllBuckets(rebuild=args.rebuild)
+    for kind in KINDS:
+        print(f"{textPath(kind)}: {changed[kind]} lines added or changed")
+    print(f"Done in {time.time() - start:.1f}s")
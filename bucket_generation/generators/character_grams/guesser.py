@@ -6,23 +6,25 @@ import argparse
 from collections import Counter, defaultdict
 import string
 
-import numpy as np
-
 from bucket_extraction.utils.extract_utils import getBucketsFromText
 import bucket_generation.utils as gen_utils
+from bucket_generation.sampler import CounterSampler, SamplerCache, groupByKey
 
 def generateLaplaceDistribution():
     return Counter(list(string.ascii_lowercase) + list(string.digits) + ["-",".","_"])
 
-def getCounters(buckets):
+def getCounters(buckets, counters=None, lengthDistribution=None):
     """
     Build distribution from left to right of prev4 chars -> next char.
     We will have some default Laplace smoothing, both to add a little bit of randomness,
     and to make sure that we have at least some distribution if the sequence
     has not been encountered before.
+    Pass in existing counters to add the buckets to them instead of starting from scratch.
     """
-    lengthDistribution = Counter()
-    counters = defaultdict(generateLaplaceDistribution)
+    if counters is None:
+        counters = defaultdict(generateLaplaceDistribution)
+    if lengthDistribution is None:
+        lengthDistribution = Counter()
     for bucket in buckets:
         bucketString = bucket.lower().strip()
         for i in range(len(bucketString)):
@@ -32,42 +34,81 @@ def getCounters(buckets):
         lengthDistribution[len(bucket)] += 1000
     return counters, lengthDistribution
 
-def sampleFromCounter(counter):
-    total = sum(counter.values())
-    return np.random.choice([k for k,v in counter.items()], p=[v/total for k,v in counter.items()])
+class CharacterGramGenerator:
+    """
+    Character-level 4-gram model that generates candidates in batches.
+    """
+
+    def __init__(self, buckets):
+        self.counters, self.lengthDistribution = getCounters(buckets)
+        self.lengthSampler = CounterSampler(self.lengthDistribution)
+        self.contextSamplers = SamplerCache(self.counters, default=generateLaplaceDistribution())
+
+    def update(self, buckets):
+        """
+        Add buckets to the model, only the contexts they touch are rebuilt.
+        """
+        buckets = [bucket.lower().strip() for bucket in buckets]
+        if not buckets:
+            return
+        getCounters(buckets, self.counters, self.lengthDistribution)
+        self.lengthSampler = CounterSampler(self.lengthDistribution)
+        self.contextSamplers.invalidate(
+            {bucket[max(0, i-4): i] for bucket in buckets for i in range(len(bucket))}
+        )
+
+    def generate_batch(self, n):
+        """
+        Generate n candidates position by position: all lengths are drawn at once,
+        then every candidate sharing the same previous 4 characters is extended in one draw.
+        :param n: the number of candidates to generate.
+        :return: a list of n candidate bucket names.
+        """
+        lengths = self.lengthSampler.sample(n)
+        buckets = [""] * n
+        active = list(range(n))
+        position = 0
+        while active:
+            active = [i for i in active if lengths[i] > position]
+            # If we aren't at fourth character yet, the context is just the previous characters.
+            for context, indices in groupByKey(buckets[i][-4:] for i in active).items():
+                chars = self.contextSamplers[context].sample(len(indices))
+                for idx, char in zip(indices, chars):
+                    buckets[active[idx]] += char
+            position += 1
+        return buckets
 
 def generateCandidates(name="c4grams", startingCandidates=None, beanstalkPort=None, numTrials=float("inf"), public=False):
     beanstalkClient = gen_utils.getBeanstalkClient(port=beanstalkPort)
-    previouslySeen = startingCandidates | gen_utils.readBucketsFromFile(f"./data/generation/{name}.txt")
+    previouslySeen = gen_utils.getPreviouslySeen(name, startingCandidates)
+    seedBuckets = startingCandidates or gen_utils.getExistingBuckets(public=public)
+    guessedHits = gen_utils.getGuessedHits(name, public=public, known=seedBuckets)
+    generator = CharacterGramGenerator(seedBuckets)
+    output = gen_utils.getOutput(name)
     
     # Randomly generate template according to distro
     while numTrials > 0:
-        print("Updating character-level 4-grams.")
-        # In intervals of 10,000 guesses, update our PCFG from our successful guesses.
+        output.message("Updating character-level 4-grams.")
+        # In intervals of 10,000 guesses, add our new successful guesses to the 4-grams.
         with gen_utils.Profiler(gen_utils.ProfilerType.TRAIN, name):
-            candidates = startingCandidates | gen_utils.getExistingAlreadyGuessedBuckets(name, public=public)
-            counters, lengthDistribution = getCounters(candidates)
+            generator.update(guessedHits.update())
 
-        
-        for _ in range(int(1e4)):
-            with gen_utils.Profiler(gen_utils.ProfilerType.GENERATE, name) as p:
-                bucket = ""
-                bucketLength = sampleFromCounter(lengthDistribution)
-                while len(bucket) < bucketLength:
-                    bucket += sampleFromCounter(counters[bucket[max(0, len(bucket)-4): len(bucket)]])
-                
-                p.bucket(bucket)
-                if bucket not in previouslySeen:
-                    previouslySeen.add(bucket)
-                    print('CAND:', bucket)
-                    beanstalkClient.put_job(f"generation/{name},{bucket}")
-                    numTrials -= 1
+        with gen_utils.Profiler(gen_utils.ProfilerType.GENERATE, name) as p:
+            batch = generator.generate_batch(int(1e4))
+            p.batch(batch)
+        accepted = gen_utils.claimCandidates(previouslySeen, batch)
+        output.candidates(accepted, generated=len(batch))
+        for bucket in accepted:
+            beanstalkClient.put_job(f"generation/{name},{bucket}")
+        numTrials -= len(accepted)
+    beanstalkClient.flush()
+    previouslySeen.sync()
         
     
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Run the a character level n-grams.')
     gen_utils.addArguments(parser)
-    args = parser.parse_args()
+    args = gen_utils.parseArguments(parser)
     candidates = gen_utils.getStartBucketNames(args)
     generateCandidates(name=args.name, startingCandidates=candidates, public=args.public, numTrials=int(args.num_trials) or float("inf"))
@@ -24,6 +24,7 @@ def generateRandomThreeOrFour(beanstalkPort=None, numTrials=float("inf"), candid
     candidates = random.sample(allPossibleCandidates, min(numTrials, len(allPossibleCandidates)))
     for candidate in candidates:
         beanstalkClient.put_job("generation/{},{}".format(name, candidate))
+    beanstalkClient.flush()
 
 class Mutation(Enum):
 
@@ -38,8 +39,9 @@ def mutateWords(beanstalkPort=None, numTrials=float("inf"), name="continella_dic
             l.strip().lower() for l in f.readlines() 
             if l.strip().isalnum() and all(ord(c) < 128 for c in l.strip()) # alphanumeric ascii characters
         ]
-    prevCandidates = utils.readBucketsFromFile("./data/generation/{}.txt".format(name))
+    prevCandidates = utils.getPreviouslySeen(name)
     beanstalkClient = utils.getBeanstalkClient(port=beanstalkPort)
+    output = utils.getOutput(name)
     
     while numTrials > 0:
         with utils.Profiler(utils.ProfilerType.GENERATE, name) as p:
@@ -62,18 +64,22 @@ def mutateWords(beanstalkPort=None, numTrials=float("inf"), name="continella_dic
                             word = otherWord + word
                 mutation = random.choice([mutation for mutation in Mutation])
             p.bucket(word)
-            if word not in prevCandidates:
-                print(word)
-                prevCandidates.add(word)
+            accepted = utils.claimCandidates(prevCandidates, [word])
+            output.candidates(accepted, generated=1)
+            if accepted:
                 beanstalkClient.put_job("generation/{},{}".format(name, word))
                 numTrials -= 1
+    beanstalkClient.flush()
+    prevCandidates.sync()
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Run the continella experiments.')
     utils.addArguments(parser)
     parser.add_argument("--mutateWords", action="store_true", help="Run the mutateWords experiment.")
     parser.add_argument("--generateRandom34", action="store_true", help="Generate all 3/4 character sequences.")
-    args = parser.parse_args()
+    args = utils.parseArguments(parser)
+    # Only for the metrics: the experiments have no seeds.
+    utils.getGuessedHits(args.name, public=args.public)
     assert args.mutateWords != args.generateRandom34, "One of --mutateWords and --generateRandom34 must be selected."
     
     if args.mutateWords:
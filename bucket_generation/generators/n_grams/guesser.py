@@ -6,17 +6,23 @@ import random
 import re
 import time
 
-import numpy as np
 from pystalk import BeanstalkClient
 
 from bucket_extraction import getBucketsFromText
 import bucket_generation.utils as generation_utils 
+from bucket_generation.sampler import CounterSampler, SamplerCache, groupByKey
 
 
-def generateNGrams(candidates):
-    ngrams = defaultdict(lambda: Counter())
-    lengthDistribution = Counter()
-    delimiterDistribution = Counter()
+def generateNGrams(candidates, ngrams=None, lengthDistribution=None, delimiterDistribution=None):
+    """
+    Count token bigrams, token counts and delimiters, adding to the given counters if any.
+    """
+    if ngrams is None:
+        ngrams = defaultdict(lambda: Counter())
+    if lengthDistribution is None:
+        lengthDistribution = Counter()
+    if delimiterDistribution is None:
+        delimiterDistribution = Counter()
     for bucket in candidates:
         splitBucket = re.split(r'([\.|\-|_])', bucket.lower().strip())
         delimiterDistribution.update(
@@ -32,49 +38,97 @@ def generateNGrams(candidates):
         lengthDistribution[len(tokens)] += 1
     return ngrams, lengthDistribution, delimiterDistribution
 
-def sampleFromCounter(counter):
-    total = sum(counter.values())
-    return np.random.choice([k for k,v in counter.items()], p=[v/total for k,v in counter.items()])
+class NGramGenerator:
+    """
+    Token bigram model that generates candidates in batches.
+    """
+
+    def __init__(self, candidates):
+        self.nGrams, self.lengthDistribution, self.delimiterDistribution = generateNGrams(candidates)
+        self.nGramSamplers = SamplerCache(self.nGrams)
+        self._freezeDistributions()
+
+    def _freezeDistributions(self):
+        self.lengthSampler = CounterSampler(self.lengthDistribution)
+        self.delimiterSampler = CounterSampler(self.delimiterDistribution) if self.delimiterDistribution else None
+
+    def update(self, candidates):
+        """
+        Add candidates to the model, only the bigram contexts they touch are rebuilt.
+        """
+        candidates = list(candidates)
+        if not candidates:
+            return
+        newNGrams = generateNGrams(candidates)[0]
+        generateNGrams(candidates, self.nGrams, self.lengthDistribution, self.delimiterDistribution)
+        self._freezeDistributions()
+        self.nGramSamplers.invalidate(newNGrams.keys())
+
+    def generate_batch(self, n):
+        """
+        Generate n candidates token by token: all lengths are drawn at once, then every
+        candidate sharing the same previous token is extended in one draw.
+        A candidate stops early if its previous token was never followed by another one.
+        :param n: the number of candidates to generate.
+        :return: a list of n candidate bucket names.
+        """
+        lengths = self.lengthSampler.sample(n)
+        tokens = [[] for _ in range(n)]
+        active = [i for i in range(n) if lengths[i] > 0]
+        position = 0
+        while active:
+            for ngramsKey, indices in groupByKey(tuple(tokens[i][-1:]) for i in active).items():
+                if ngramsKey in self.nGramSamplers:
+                    for idx, token in zip(indices, self.nGramSamplers[ngramsKey].sample(len(indices))):
+                        tokens[active[idx]].append(token)
+            position += 1
+            active = [i for i in active if len(tokens[i]) == position and lengths[i] > position]
+
+        # Every candidate with k tokens needs k - 1 delimiters, draw them all at once.
+        numDelimiters = sum(max(len(t) - 1, 0) for t in tokens)
+        delimiters = iter(self.delimiterSampler.sample(numDelimiters) if numDelimiters else [])
+        buckets = []
+        for bucketTokens in tokens:
+            bucket = bucketTokens[:1]
+            for token in bucketTokens[1:]:
+                bucket += [next(delimiters), token]
+            buckets.append("".join(bucket))
+        return buckets
+
 
 def streamNGramCandidates(
     startingCandidates=None, beanstalkPort=None, numTrials=float("inf"), name="ngrams", experiment=False, public=False,
 ):
     candidates = startingCandidates or generation_utils.getExistingBuckets(public=public)
-    previouslySeen = startingCandidates | generation_utils.readBucketsFromFile(f"./data/generation/{name}.txt")
+    previouslySeen = generation_utils.getPreviouslySeen(name, startingCandidates)
     beanstalkClient = generation_utils.getBeanstalkClient(port=beanstalkPort)
+    guessedHits = generation_utils.getGuessedHits(name, public=public, known=candidates)
+    generator = NGramGenerator(candidates)
+    output = generation_utils.getOutput(name)
 
     while numTrials > 0:
         # Update our prior distribution for every 10,000 candidates.
-        print("Initializing bigram distribution.")
+        output.message("Updating bigram distribution.")
         
         with generation_utils.Profiler(generation_utils.ProfilerType.TRAIN, name):
             if experiment:
                 # add all existing buckets that have been guessed by ngrams and are in seed set.
-                candidates |= generation_utils.getExistingAlreadyGuessedBuckets(name, public=public)
-            nGrams, lengthDistribution, delimiterDistribution = generateNGrams(candidates)
-        
-        
-        for _ in range(int(1e4)):
-            with generation_utils.Profiler(generation_utils.ProfilerType.GENERATE, name) as p:
-                bucket = []
-                bucketLength = sampleFromCounter(lengthDistribution)
-                for _ in range(bucketLength):
-                    if len(bucket) > 0:
-                        bucket += [sampleFromCounter(delimiterDistribution)]
-                    ngramsKey = tuple(bucket[-2:-1])
-                    if ngramsKey in nGrams:
-                        bucket += sampleFromCounter(nGrams[ngramsKey])
-                bucket = "".join(bucket)
-                p.bucket(bucket)
-                if len(bucket) < 64 and bucket not in previouslySeen:
-                    previouslySeen.add(bucket)
-                    beanstalkClient.put_job("generation/{},{}".format(name, bucket))
-                    print("Generated: " + bucket)
-                    numTrials -= 1
+                generator.update(guessedHits.update())
+
+        with generation_utils.Profiler(generation_utils.ProfilerType.GENERATE, name) as p:
+            batch = generator.generate_batch(int(1e4))
+            p.batch(batch)
+        accepted = generation_utils.claimCandidates(previouslySeen, batch)
+        output.candidates(accepted, generated=len(batch))
+        for bucket in accepted:
+            beanstalkClient.put_job("generation/{},{}".format(name, bucket))
+        numTrials -= len(accepted)
+    beanstalkClient.flush()
+    previouslySeen.sync()
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Run the ngrams generator.')
     generation_utils.addArguments(parser)
-    args = parser.parse_args()
+    args = generation_utils.parseArguments(parser)
     candidates = generation_utils.getStartBucketNames(args)
     streamNGramCandidates(name=args.name, startingCandidates=candidates, public=args.public, numTrials=int(args.num_trials) or float("inf"))
\ No newline at end of file
@@ -10,12 +10,12 @@ B -> T-T-T
 """
 import argparse
 from collections import Counter
+from functools import lru_cache
 import re
 
-import numpy as np
-
 from bucket_extraction.utils.extract_utils import getBucketsFromText
 import bucket_generation.utils as gen_utils
+from bucket_generation.sampler import CounterSampler, SamplerCache, groupByKey
 
 templates = Counter()
 C = {}
@@ -53,61 +53,97 @@ def updateCounters(bucket):
         template += other
         bucket = bucket[len(other):]
     templates[template] += 1
+    return template
+
+templateTokens = re.compile(r'([CN])([0-9]+)|([^CN0-9]+)')
+
+@lru_cache(maxsize=None)
+def parseTemplate(template):
+    """
+    Split a template such as C12-N4 into its slots.
+    :return: a tuple of (nonterminal, length) pairs, where nonterminal is None for literal delimiters.
+    """
+    return tuple(
+        (nonterminal, length) if nonterminal else (None, other)
+        for nonterminal, length, other in templateTokens.findall(template)
+    )
+
+class PCFGGenerator:
+    """
+    Samples the module-level PCFG counters in batches.
+    """
+
+    def __init__(self):
+        self.templateSampler = CounterSampler(templates)
+        self.samplers = {'C': SamplerCache(C), 'N': SamplerCache(N)}
 
-def sampleFromCounter(counter):
-    total = sum(counter.values())
-    return np.random.choice([k for k,v in counter.items()], p=[v/total for k,v in counter.items()])
+    def update(self, buckets):
+        """
+        Add buckets to the PCFG counters, only the slots they touch are rebuilt.
+        """
+        touched = set()
+        for bucket in buckets:
+            touched.update(parseTemplate(updateCounters(bucket.strip().lower())))
+        if not touched:
+            return
+        self.templateSampler = CounterSampler(templates)
+        for nonterminal, value in touched:
+            if nonterminal is not None:
+                self.samplers[nonterminal].invalidate([value])
+
+    def generate_batch(self, n):
+        """
+        Generate n candidates template by template: all templates are drawn at once,
+        then each slot of a template is filled for every candidate sharing it in one draw.
+        :param n: the number of candidates to generate.
+        :return: a list of n candidate bucket names.
+        """
+        buckets = [""] * n
+        for template, indices in groupByKey(self.templateSampler.sample(n)).items():
+            columns = []
+            for nonterminal, value in parseTemplate(template):
+                if nonterminal is None:
+                    columns.append([value] * len(indices))
+                else:
+                    columns.append(self.samplers[nonterminal][value].sample(len(indices)))
+            for i, parts in zip(indices, zip(*columns)):
+                buckets[i] = "".join(parts)
+        return buckets
 
 def generatePCFGCandidates(name="pcfg", startingCandidates=None, beanstalkPort=None, numTrials=float("inf"), public=False):
     beanstalkClient = gen_utils.getBeanstalkClient(port=beanstalkPort)
-    candidates = startingCandidates or gen_utils.getExistingBuckets(public=public)
-    previouslySeen = startingCandidates | gen_utils.readBucketsFromFile(f"./data/generation/{name}.txt")
+    previouslySeen = gen_utils.getPreviouslySeen(name, startingCandidates)
+    seedBuckets = startingCandidates or gen_utils.getExistingBuckets(public=public)
+    guessedHits = gen_utils.getGuessedHits(name, public=public, known=seedBuckets)
+    for bucket in seedBuckets:
+        updateCounters(bucket.strip().lower())
+    generator = PCFGGenerator()
+    output = gen_utils.getOutput(name)
 
     # Randomly generate template according to distro
     while numTrials > 0:
-        print("Updating PCFG.")
-        # In intervals of 10,000 guesses, update our PCFG from our successful guesses.
+        output.message("Updating PCFG.")
+        # In intervals of 10,000 guesses, add our new successful guesses to the PCFG.
+        # Each bucket is only counted once, however many times we update.
         with gen_utils.Profiler(gen_utils.ProfilerType.TRAIN, name):
-            candidates = startingCandidates | gen_utils.getExistingAlreadyGuessedBuckets(name, public=public)
-            for candidate in candidates:
-                updateCounters(candidate.strip().lower())
-        
-        
-        for _ in range(int(1e4)):
-            with gen_utils.Profiler(gen_utils.ProfilerType.GENERATE, name) as p:
-                template = sampleFromCounter(templates)
-                print(template)
-                bucket = '' 
-                while len(template) > 0:
-                    if template[0] == 'C':
-                        ni = re.search('([0-9]*)', template[1]).group()
-                        i = ni
-                        try:
-                            bucket += sampleFromCounter(C[i])
-                        except KeyError:
-                            import pdb
-                            pdb.set_trace()
-                        template = template[1+len(ni):]
-                    elif template[0] == 'N':
-                        ni = re.search('([0-9]*)', template[1]).group()
-                        i = ni
-                        template = template[1+len(ni):]
-                        bucket += sampleFromCounter(N[i])
-                    else:
-                        bucket += template[0]
-                        template = template[1:]
-                p.bucket(bucket)
-                if bucket not in previouslySeen:
-                    previouslySeen.add(bucket)
-                    print('CAND:', bucket)
-                    beanstalkClient.put_job(f"generation/{name},{bucket}")
-                    numTrials -= 1
+            generator.update(guessedHits.update())
+
+        with gen_utils.Profiler(gen_utils.ProfilerType.GENERATE, name) as p:
+            batch = generator.generate_batch(int(1e4))
+            p.batch(batch)
+        accepted = gen_utils.claimCandidates(previouslySeen, batch)
+        output.candidates(accepted, generated=len(batch))
+        for bucket in accepted:
+            beanstalkClient.put_job(f"generation/{name},{bucket}")
+        numTrials -= len(accepted)
+    beanstalkClient.flush()
+    previouslySeen.sync()
         
     
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Run the PCFG generator.')
     gen_utils.addArguments(parser)
-    args = parser.parse_args()
+    args = gen_utils.parseArguments(parser)
     candidates = gen_utils.getStartBucketNames(args)
     generatePCFGCandidates(name=args.name, startingCandidates=candidates, public=args.public, numTrials=int(args.num_trials) or float("inf"))
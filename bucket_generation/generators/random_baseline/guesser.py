@@ -2,10 +2,11 @@ import argparse
 import random
 import string
 
-from bucket_generation.utils import getBeanstalkClient, addArguments
+from bucket_generation.utils import getBeanstalkClient, getGuessedHits, getOutput, addArguments, parseArguments, validity
 
 def randomlyGuessBucketNames(numCharacters=5, numTrials=float("inf"), name="random"):
     beanstalkClient = getBeanstalkClient()
+    output = getOutput(name)
     while numTrials > 0:
         numTrials -= 1
         randomBucket = "".join(
@@ -14,13 +15,18 @@ def randomlyGuessBucketNames(numCharacters=5, numTrials=float("inf"), name="rand
                 for _ in range(numCharacters)            
             ]
         )
-        print(f"CAND: {randomBucket}")
-        beanstalkClient.put_job(f"generation/{name},{randomBucket}")
+        accepted = validity.filter([randomBucket])
+        output.candidates(accepted, generated=1)
+        for bucket in accepted:
+            beanstalkClient.put_job(f"generation/{name},{bucket}")
+    beanstalkClient.flush()
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Run the PCFG generator.')
     addArguments(parser)
     parser.add_argument("--character_num", type=int, help="The length of characters to generate.")
-    args = parser.parse_args()
+    args = parseArguments(parser)
+    # Only for the metrics: random guesses have no seeds.
+    getGuessedHits(args.name, public=args.public)
     randomlyGuessBucketNames(name=args.name, numTrials=int(args.num_trials), numCharacters=int(args.character_num))
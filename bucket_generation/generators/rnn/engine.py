@@ -0,0 +1,266 @@
+"""
+Batched, step-wise inference of the RNN generator's LSTM in NumPy.
+Keras' predict reruns every timestep of the network for each character of each name. Here the
+LSTM state of a whole batch of names is kept between characters, so each character costs one cell
+step per name, and names are dropped from the batch as soon as they draw the end character.
+
+The trained model flattens the LSTM output of all 64 timesteps into its Dense layer, and the
+timesteps past the end of a name see a zero input. The next-character logits of a name are thus
+the Dense contributions of its prefix, accumulated as it grows, plus those of the zero-input
+timesteps that follow it, which are rolled out from the current state for the whole batch at once.
+A model trained in sequence mode applies its Dense layer to each timestep's output instead, so
+the logits only depend on the last one.
+"""
+import os
+
+import numpy as np
+
+from bucket_generation.generators.rnn.training import TIMESTEPS
+
+BATCH_SIZE = 4096
+# Names never end before this many characters (the generator used to retry on len(sentence) <= 3).
+MIN_LENGTH = 4
+
+
+def sigmoid(x):
+    return 0.5 * (1 + np.tanh(0.5 * x))
+
+def hardSigmoid(x):
+    return np.clip(0.2 * x + 0.5, 0, 1)
+
+RECURRENT_ACTIVATIONS = {"sigmoid": sigmoid, "hard_sigmoid": hardSigmoid}
+# The Dense layer reads the LSTM output of every timestep at once, or of each timestep in turn.
+FLATTEN = "flatten"
+SEQUENCE = "sequence"
+
+
+def modelWeights(model):
+    """
+    :param model: the Keras model built by guesser.buildModel, in either mode.
+    :return: its weights, as the keyword arguments of LSTMEngine.
+    """
+    # The Masking and Flatten layers have no weights.
+    lstm, dense = [layer for layer in model.layers if layer.get_weights()]
+    kernel, recurrentKernel, bias = lstm.get_weights()
+    denseKernel, denseBias = dense.get_weights()
+    return {
+        "kernel": kernel, "recurrentKernel": recurrentKernel, "bias": bias,
+        "denseKernel": denseKernel, "denseBias": denseBias,
+        "recurrentActivation": lstm.get_config().get("recurrent_activation", "sigmoid"),
+        "mode": SEQUENCE if len(denseKernel) == len(recurrentKernel) else FLATTEN,
+    }
+
+def exportModel(model, path):
+    """
+    Write the weights of a Keras model to a .npz file that LSTMEngine.load reads without Keras.
+    The file is replaced atomically, so workers watching it never read half of it.
+    """
+    tmpPath = path + ".tmp.npz"
+    np.savez(tmpPath, **modelWeights(model))
+    os.replace(tmpPath, path)
+
+def enginePath(weightsPath):
+    """
+    :return: where the weights of a Keras checkpoint are exported to.
+    """
+    return os.path.splitext(weightsPath)[0] + ".npz"
+
+
+class LSTMState:
+    """
+    The state of a batch of names: the LSTM's hidden and cell states after the last character,
+    the Dense layer's logits accumulated over the characters so far, and their number.
+    """
+
+    def __init__(self, h, c, logits, length):
+        self.h = h
+        self.c = c
+        self.logits = logits
+        self.length = length
+
+    def select(self, rows):
+        """
+        :param rows: a boolean mask or indices of the names to keep.
+        """
+        return LSTMState(self.h[rows], self.c[rows], self.logits[rows], self.length)
+
+
+class LSTMEngine:
+    """
+    The RNN generator's model: an LSTM over one-hot characters, flattened into a softmax Dense layer
+    or with the Dense layer applied to each timestep.
+    :param kernel: the LSTM's (vocab, 4 * units) input weights, gates in Keras' i, f, c, o order.
+    :param recurrentKernel: the LSTM's (units, 4 * units) recurrent weights.
+    :param bias: the LSTM's (4 * units,) bias.
+    :param denseKernel: the Dense layer's (timesteps * units, vocab) weights, or (units, vocab) in
+        sequence mode.
+    :param denseBias: the Dense layer's (vocab,) bias.
+    :param recurrentActivation: the LSTM's recurrent_activation, "sigmoid" or "hard_sigmoid".
+    :param mode: FLATTEN or SEQUENCE.
+    """
+
+    def __init__(
+        self, kernel, recurrentKernel, bias, denseKernel, denseBias, recurrentActivation="sigmoid", mode=FLATTEN,
+    ):
+        units = np.shape(recurrentKernel)[0]
+        # Gates are reordered to i, f, o, c so that the three recurrent activations are contiguous.
+        # With a sigmoid they are computed as 0.5 * tanh(x / 2) + 0.5, halving their weights here so
+        # that a single tanh covers all four gates.
+        order = np.r_[0:2 * units, 3 * units:4 * units, 2 * units:3 * units]
+        scale = np.ones(4 * units, dtype=np.float32)
+        self.foldedSigmoid = recurrentActivation == "sigmoid"
+        if self.foldedSigmoid:
+            scale[:3 * units] = 0.5
+        else:
+            self.recurrentActivation = RECURRENT_ACTIVATIONS[recurrentActivation]
+        self.kernel = np.asarray(kernel, dtype=np.float32)[:, order] * scale
+        self.recurrentKernel = np.asarray(recurrentKernel, dtype=np.float32)[:, order] * scale
+        self.bias = np.asarray(bias, dtype=np.float32)[order] * scale
+        self.units = units
+        self.vocab = self.kernel.shape[0]
+        self.sequence = mode == SEQUENCE
+        # A sequence model takes names of any length, but they are capped like the training names.
+        self.timesteps = TIMESTEPS if self.sequence else np.shape(denseKernel)[0] // units
+        self.denseBias = np.asarray(denseBias, dtype=np.float32)
+        # The Dense weights applied to each timestep's output, shared by all of them in sequence mode.
+        self.denseKernel = np.asarray(denseKernel, dtype=np.float32).reshape(-1, units, self.denseBias.shape[0])
+
+    @classmethod
+    def fromModel(cls, model):
+        """
+        :param model: the Keras model built by guesser.buildModel.
+        """
+        return cls(**modelWeights(model))
+
+    @classmethod
+    def load(cls, path):
+        """
+        :param path: a .npz file written by exportModel.
+        """
+        with np.load(path) as weights:
+            arguments = {key: weights[key] for key in weights.files}
+        arguments["recurrentActivation"] = str(arguments["recurrentActivation"])
+        # Exports from before sequence mode hold a flatten model.
+        arguments["mode"] = str(arguments.get("mode", FLATTEN))
+        return cls(**arguments)
+
+    def cell(self, inputs, h, c):
+        """
+        One LSTM step.
+        :param inputs: the input's contribution to the gates, e.g. rows of the kernel plus the bias.
+        """
+        gates = h @ self.recurrentKernel
+        gates += inputs
+        units = self.units
+        if self.foldedSigmoid:
+            np.tanh(gates, out=gates)
+            sigmoids = gates[:, :3 * units]
+            sigmoids *= 0.5
+            sigmoids += 0.5
+        else:
+            gates[:, :3 * units] = self.recurrentActivation(gates[:, :3 * units])
+            np.tanh(gates[:, 3 * units:], out=gates[:, 3 * units:])
+        c = gates[:, units:2 * units] * c
+        c += gates[:, :units] * gates[:, 3 * units:]
+        h = np.tanh(c)
+        h *= gates[:, 2 * units:3 * units]
+        return h, c
+
+    def start(self, indices):
+        """
+        :param indices: the first character of each name.
+        :return: the LSTMState after it.
+        """
+        zeros = np.zeros((len(indices), self.units), dtype=np.float32)
+        state = LSTMState(zeros, zeros, np.zeros((len(indices), self.vocab), dtype=np.float32), 0)
+        return self.advance(state, indices)
+
+    def advance(self, state, indices):
+        """
+        :param indices: the next character of each name.
+        :return: the LSTMState after it.
+        """
+        h, c = self.cell(self.kernel[indices] + self.bias, state.h, state.c)
+        if self.sequence:
+            return LSTMState(h, c, h @ self.denseKernel[0], state.length + 1)
+        return LSTMState(h, c, state.logits + h @ self.denseKernel[state.length], state.length + 1)
+
+    def probabilities(self, state):
+        """
+        :return: the (names, vocab) distribution of the next character of each name.
+        """
+        logits = state.logits + self.denseBias
+        # A sequence model's logits are already those of the last timestep.
+        if not self.sequence:
+            h, c = state.h, state.c
+            for t in range(state.length, self.timesteps):
+                h, c = self.cell(self.bias, h, c)
+                logits += h @ self.denseKernel[t]
+        logits -= logits.max(axis=1, keepdims=True)
+        probabilities = np.exp(logits)
+        return probabilities / probabilities.sum(axis=1, keepdims=True)
+
+    def generate(self, startIndices, endIndex, sampleRows, minLength=MIN_LENGTH):
+        """
+        Grow a batch of names one character at a time until each draws the end character or fills
+        every timestep.
+        :param startIndices: the first character of each name.
+        :param endIndex: the index of the end character.
+        :param sampleRows: draws one index per row of a (names, vocab) probability matrix,
+            e.g. sampler.sampleRows.
+        :param minLength: names shorter than this cannot end.
+        :return: a list holding the character indices of each name, without the end character.
+        """
+        numNames = len(startIndices)
+        sequences = np.zeros((numNames, self.timesteps), dtype=np.int64)
+        sequences[:, 0] = startIndices
+        lengths = np.full(numNames, self.timesteps)
+        # The positions in sequences of the names still growing.
+        rows = np.arange(numNames)
+        state = self.start(np.asarray(startIndices))
+        for length in range(1, self.timesteps):
+            probabilities = self.probabilities(state)
+            if length < minLength:
+                probabilities[:, endIndex] = 0
+            nextIndices = sampleRows(probabilities)
+            ended = nextIndices == endIndex
+            lengths[rows[ended]] = length
+            growing = ~ended
+            rows = rows[growing]
+            if not len(rows):
+                break
+            nextIndices = nextIndices[growing]
+            sequences[rows, length] = nextIndices
+            if length + 1 < self.timesteps:
+                state = self.advance(state.select(growing), nextIndices)
+        return [sequence[:length].tolist() for sequence, length in zip(sequences, lengths)]
+
+
+class EngineWatcher:
+    """
+    The engine of an exported model, reloaded when the file is replaced.
+    :param path: the .npz file written by exportModel.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.engine = None
+        self.mtime = None
+
+    def get(self):
+        """
+        :return: the engine of the latest export, or the last one that loaded if the file is
+            gone or unreadable, or None if none ever did.
+        """
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            return self.engine
+        if mtime != self.mtime:
+            try:
+                self.engine = LSTMEngine.load(self.path)
+                self.mtime = mtime
+                print(f"Loaded {self.path}: {self.engine.units} units, {self.engine.timesteps} timesteps")
+            except (OSError, ValueError, KeyError) as e:
+                print("COULDNT LOAD MODEL", self.path, e)
+        return self.engine
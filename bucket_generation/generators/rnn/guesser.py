@@ -11,33 +11,24 @@ Here was a useful answer to why the output dimensions are for multiple sequences
 """
 import argparse
 from datetime import date
+import functools
 import json
 import numpy as np
-import random
 import time
 
-from keras.callbacks import ModelCheckpoint, LambdaCallback
-from keras.layers import Activation, Dense, Flatten, LSTM, Masking
-from keras.models import Sequential, load_model
-from keras.callbacks import ReduceLROnPlateau
-from keras.optimizers import RMSprop
-
+import os
 import bucket_generation.utils as generation_utils
+from bucket_generation.bucket_store import BucketStore
+from bucket_generation.generators.rnn.engine import BATCH_SIZE, EngineWatcher, LSTMEngine, enginePath, exportModel
+from bucket_generation.generators.rnn.training import BATCH_SIZE as TRAINING_BATCH_SIZE, EPOCHS, \
+    SEQUENCE_BATCH_SIZE, Corpus, sequenceBatches, sequenceStepsPerEpoch, stepsPerEpoch, trainingBatches
+from bucket_generation.sampler import CounterSampler, sampleRows
 from bucket_extraction.utils.extract_utils import getBucketsFromText
-from bucket_generation.utils import getExistingAlreadyGuessedBuckets, getExistingBuckets
+from bucket_generation.utils import getExistingAlreadyGuessedBuckets
 
 
 beanstalkClient = None
 
-def sample(preds, temperature=1.0):
-    # helper function to sample an index from a probability array
-    preds = np.asarray(preds).astype('float64')
-    preds = np.log(preds) / temperature
-    exp_preds = np.exp(preds)
-    preds = exp_preds / np.sum(exp_preds)
-    probas = np.random.multinomial(1, preds, 1)
-    return np.argmax(probas)
-
 def standardizeText(line, forward=True):
     """
     Remove whitespace, lowercase,
@@ -46,21 +37,32 @@ def standardizeText(line, forward=True):
     text = line.strip().lower()[:63]
     return (text if forward else text[::-1]) + '\r'
 
-def buildModel(uniqueChars):
-    # This is because we have variable length input sequences and thus different
-    # dimensions, see https://github.com/keras-team/keras/issues/6776
-    
+def buildModel(uniqueChars, sequence=False):
+    # Keras is only needed to train: generation runs on the exported weights.
+    from keras.layers import Dense, Flatten, LSTM, Masking, TimeDistributed
+    from keras.models import Sequential
+    from keras.optimizers import RMSprop
+
     hiddenUnits = 64
     model = Sequential()
-    inShape = (64, uniqueChars) # bucket names need to be between 3-63 chars
-    model.add(
-        LSTM(
-            hiddenUnits, input_shape=inShape,
-            return_sequences=True,
+    if sequence:
+        # Whole names of any length, padded with zero rows per batch. The padding is masked out of
+        # the LSTM and of the loss, and the next character is predicted at every timestep.
+        model.add(Masking(mask_value=0., input_shape=(None, uniqueChars)))
+        model.add(LSTM(hiddenUnits, return_sequences=True))
+        model.add(TimeDistributed(Dense(uniqueChars, activation='softmax')))
+    else:
+        # This is because we have variable length input sequences and thus different
+        # dimensions, see https://github.com/keras-team/keras/issues/6776
+        inShape = (64, uniqueChars) # bucket names need to be between 3-63 chars
+        model.add(
+            LSTM(
+                hiddenUnits, input_shape=inShape,
+                return_sequences=True,
+            )
         )
-    )
-    model.add(Flatten()) # https://github.com/keras-team/keras/issues/6351
-    model.add(Dense(uniqueChars, activation='softmax'))
+        model.add(Flatten()) # https://github.com/keras-team/keras/issues/6351
+        model.add(Dense(uniqueChars, activation='softmax'))
     optimizer = RMSprop(lr=0.01)
     model.compile(loss='categorical_crossentropy', optimizer=optimizer)
     return model
@@ -77,62 +79,58 @@ def addNamesToCorpus(x,y, names, startingCharCounts, forward):
         startingCharCounts[startC] += 1
 
 
-def addNamesToCorpusFromFile(x,y, filename, startingCharCounts, forward):
-    buckets = set(random.sample(generation_utils.readBucketsFromFile(filename), k=int(1e4)))
-    addNamesToCorpus(x,y, buckets, startingCharCounts, forward)
-
-
-def generateText(startingCounts, model, indicesChar, charIndices, forward):
-    startingChar = startingCounts[
-        sample([c[1] for c in startingCounts])
-    ][0]
-    sentence = startingChar
-    for _ in range(63):
-        x_pred = np.zeros((1, 64, 40))
-        for t, char in enumerate(sentence):
-            x_pred[0, t, charIndices[char]] = 1.
-        preds = model.predict(x_pred, verbose=0)[0]
-        nextIndex = sample(preds)
-        if nextIndex == charIndices['\r']:
-            if len(sentence) <= 3:
-                continue
-            else:
-                break
-        sentence += indicesChar[str(nextIndex)]
-    return sentence if forward else sentence[::-1]
+def generateNames(
+    engine, startingCounts, charIndices, indicesChar, forward, n, temperature=1.0, topK=None, topP=None,
+):
+    """
+    Generate n names at once with the batched LSTM engine.
+    :param engine: an LSTMEngine of the model.
+    :param startingCounts: (character, count) pairs the first characters are drawn from.
+    :param temperature, topK, topP: how each next character is drawn, see sampler.shapeRows.
+    :return: a list of n names.
+    """
+    starts = CounterSampler({charIndices[char]: count for char, count in startingCounts})
+    draw = functools.partial(sampleRows, temperature=temperature, topK=topK, topP=topP)
+    sequences = engine.generate(starts.sample(n), charIndices['\r'], draw)
+    names = ["".join(indicesChar[str(index)] for index in sequence) for sequence in sequences]
+    return names if forward else [name[::-1] for name in names]
 
 def onEpochEnd(epoch, logs, startingCounts, model, indicesChar, charIndices, forward):
     print('FINISHED EPOCH', epoch)
-    for _ in range(10):
-        print(generateText(startingCounts, model, indicesChar, charIndices, forward))
+    for name in generateNames(LSTMEngine.fromModel(model), startingCounts, charIndices, indicesChar, forward, 10):
+        print(name)
+
 
+def getCorpus(charIndices, forward, candidates=None, name=None, public=False):
+    """
+    The names to train on: every existing bucket, or the given candidates and the buckets this
+    generator already found.
+    """
+    if candidates:
+        candidates = set(candidates) | getExistingAlreadyGuessedBuckets(name, public=public)
+        return Corpus.fromNames(candidates, charIndices, forward)
+    store = BucketStore()
+    if len(store):
+        # The existing buckets already include the ones this generator guessed.
+        return Corpus.fromStore(store, charIndices, forward, public=True if public else None)
+    return Corpus.fromNames(generation_utils.getExistingBuckets(public=public), charIndices, forward)
 
 def trainModel(
     startingCharCounts, model, filepath, charIndices, indicesChar, forward, 
-    candidates=None, name=None, public=False):
-    
-    # Collect all bucket names and starting character distribution
-    sentences = []
-    nextChars = []
-    candidates = candidates or getExistingBuckets(public=public)
-    candidates |= getExistingAlreadyGuessedBuckets(name, public=public)
-
-    # This many candidates wouldn't fit in memory, so let's grab 10,000 buckets at random.
-    sampledBucketNames = random.sample(
-        candidates,
-        int(1e4)
-    )
-    addNamesToCorpus(sentences, nextChars, sampledBucketNames, startingCharCounts, forward)
-  
-    
-    x = np.zeros((len(sentences), 64, 40), dtype=np.bool)
-    y = np.zeros((len(sentences), 40), dtype=np.bool)
+    candidates=None, name=None, public=False, epochs=EPOCHS, batchSize=None, sequence=False):
+    from keras.callbacks import LambdaCallback, ModelCheckpoint, ReduceLROnPlateau
 
-    for i, sentence in enumerate(sentences):
-        for t, char in enumerate(sentence):
-            x[i, t, charIndices[char]] = 1
-        y[i, charIndices[nextChars[i]]] = 1
-    print('NUM SENTENCES', len(sentences))
+    # Stream batches over every name rather than one-hot encoding a sample of them up front.
+    corpus = getCorpus(charIndices, forward, candidates=candidates, name=name, public=public)
+    print('NUM NAMES', len(corpus), 'NUM PREFIXES', corpus.numPrefixes)
+    if not corpus.numPrefixes:
+        print("NO NAMES TO TRAIN ON, WAITING A MINUTE")
+        time.sleep(60)
+        return model
+    startingCharCounts.clear()
+    for index, count in enumerate(corpus.startCounts(len(charIndices)).tolist()):
+        if count:
+            startingCharCounts[indicesChar[str(index)]] = count
     startingCounts = list(startingCharCounts.items())
 
     checkpoint = ModelCheckpoint(filepath, monitor='loss',
@@ -147,42 +145,75 @@ def trainModel(
     print_callback = LambdaCallback(on_epoch_end=lambda x,y: onEpochEnd(
         x, y,startingCounts, model, indicesChar, charIndices, forward
     ))
-    callbacks = [print_callback, checkpoint, checkpoint_backup, reduce_lr]
+    export_callback = LambdaCallback(on_epoch_end=lambda x,y: exportCheckpoint(model, filepath))
+    callbacks = [print_callback, checkpoint, checkpoint_backup, export_callback, reduce_lr]
+    if sequence:
+        batchSize = batchSize or SEQUENCE_BATCH_SIZE
+        batches = sequenceBatches(corpus, len(charIndices), batchSize)
+        steps = sequenceStepsPerEpoch(corpus, batchSize)
+    else:
+        batchSize = batchSize or TRAINING_BATCH_SIZE
+        batches = trainingBatches(corpus, len(charIndices), batchSize)
+        steps = stepsPerEpoch(corpus, batchSize)
     print('FITTING')
-    print(len(x),len(y))
     while True:
         try:
-            model.fit(x, y, batch_size=1000, epochs=10, callbacks=callbacks, use_multiprocessing=True)
+            model.fit(batches, steps_per_epoch=steps, epochs=epochs, callbacks=callbacks)
             break
         except OSError as e:
             # Just retry, after waiting some time.
             time.sleep(17)
     return model
 
-def makeGuesses(model, startingCharCounts, charIndices, indicesChar, forward, name="name", previous=None):
-    candidates = previous or set()
+exportedMtimes = {}
+
+def exportCheckpoint(model, filepath):
+    """
+    Export the model's weights for the generation workers whenever the checkpoint was rewritten,
+    i.e. when the loss improved.
+    """
+    try:
+        mtime = os.stat(filepath).st_mtime_ns
+    except OSError:
+        return
+    if exportedMtimes.get(filepath) != mtime:
+        exportModel(model, enginePath(filepath))
+        exportedMtimes[filepath] = mtime
+
+def makeGuesses(
+    engine, startingCharCounts, charIndices, indicesChar, forward, name="name", previous=None, numGuesses=10000,
+    temperature=1.0, topK=None, topP=None,
+):
+    candidates = previous if previous is not None else generation_utils.getPreviouslySeen(name)
+    output = generation_utils.getOutput(name)
     startingCounts = list(startingCharCounts.items())
-    for _ in range(10000):
+    for start in range(0, numGuesses, BATCH_SIZE):
         with generation_utils.Profiler(generation_utils.ProfilerType.GENERATE, name) as p:
-            cand = generateText(startingCounts, model, indicesChar, charIndices, forward)
-            p.bucket(cand)
-            print(len(candidates))
-            if cand not in candidates:
-                print('CAND', cand)
-                beanstalkClient.put_job(f"generation/{name},{cand}")
-                candidates.add(cand)
-            else:
-                print("ALREADY GUESSED")
+            batch = generateNames(
+                engine, startingCounts, charIndices, indicesChar, forward, min(BATCH_SIZE, numGuesses - start),
+                temperature=temperature, topK=topK, topP=topP,
+            )
+            p.batch(batch)
+        accepted = generation_utils.claimCandidates(candidates, batch)
+        output.candidates(accepted, generated=len(batch))
+        for cand in accepted:
+            beanstalkClient.put_job(f"generation/{name},{cand}")
+
 
+def runTraining(
+    name="rnn", forward=True, filepath=None, candidates=None, public=False, epochs=EPOCHS, batchSize=None,
+    sequence=False,
+):
+    from keras.models import load_model
 
-def runTraining(name="rnn", forward=True, filepath=None, candidates=None, public=False):
     chars = 40
     assert filepath, "No weights filepath provided."
     try:
         model = load_model(filepath)
+        exportCheckpoint(model, filepath)
     except Exception as e:
         print("COULDNT LOAD MODEL", e)
-        model = buildModel(chars)
+        model = buildModel(chars, sequence=sequence)
     model.summary()
     charIndices = {}
     with open('./data/generation/rnn/charIndices.json') as f:
@@ -196,11 +227,12 @@ def runTraining(name="rnn", forward=True, filepath=None, candidates=None, public
             model = trainModel(
                 startingCharCounts, model, filepath, charIndices, indicesChar,forward, 
                 candidates=candidates,
-                name=name, public=public
+                name=name, public=public, epochs=epochs, batchSize=batchSize, sequence=sequence,
             )
 
 def streamRNNGuesses(
-    forward=True, beanstalkPort=None, name="rnn", numTrials=None, weights_path=None, seedSet=None
+    forward=True, beanstalkPort=None, name="rnn", numTrials=None, weights_path=None, seedSet=None,
+    temperature=1.0, topK=None, topP=None,
 ):
 
     if not numTrials:
@@ -220,21 +252,25 @@ def streamRNNGuesses(
     sentences = []
     nextChars = []
     numTrials /= 1e4
-    previouslySeen = generation_utils.readBucketsFromFile(f"data/generation/{name}.txt") | (seedSet or set())
+    previouslySeen = generation_utils.getPreviouslySeen(name, seedSet)
     # This is just to load up the startingCharCounts.
-    addNamesToCorpusFromFile(sentences, nextChars, './final_output/all_platforms_all.txt', startingCharCounts, forward)
+    addNamesToCorpus(sentences, nextChars, generation_utils.sampleExistingBuckets(int(1e4)), startingCharCounts, forward)
     sentences = []
     nextChars = []
+    watcher = EngineWatcher(enginePath(filepath))
     while numTrials > 0:
-        try:
-            model = load_model(filepath)
-        except Exception as e:
-            print("COULDNT LOAD MODEL, WAITING A MINUTE", e)
+        engine = watcher.get()
+        if engine is None:
+            print("COULDNT LOAD MODEL, WAITING A MINUTE", watcher.path)
             time.sleep(60)
             continue
-        model.summary()
-        makeGuesses(model, startingCharCounts, charIndices, indicesChar, forward, name=name, previous=previouslySeen)
+        makeGuesses(
+            engine, startingCharCounts, charIndices, indicesChar, forward, name=name, previous=previouslySeen,
+            temperature=temperature, topK=topK, topP=topP,
+        )
         numTrials -= 1
+    beanstalkClient.flush()
+    previouslySeen.sync()
 
 
 if __name__ == "__main__":
@@ -243,16 +279,35 @@ if __name__ == "__main__":
     parser.add_argument("--train", action="store_true", help="Train rnn instead of stream guesses.")
     parser.add_argument("--forward", action="store_true", help="Run the rnn in forward vs. backward mode.")
     parser.add_argument("--stream", action="store_true", help="Stream guesses based off of the model.")
+    parser.add_argument("--export", action="store_true", help="Export the weights of the checkpoint for --stream, which runs without Keras.")
+    parser.add_argument("--temperature", type=float, default=1.0, help="Sampling temperature: below 1 generates likelier names, above 1 more novel ones.")
+    parser.add_argument("--top_k", type=int, help="Only draw each character among its k likeliest.")
+    parser.add_argument("--top_p", type=float, help="Only draw each character among the likeliest ones holding this share of the probability.")
+    parser.add_argument("--epochs", type=int, default=EPOCHS, help="Epochs over every existing bucket per training round.")
+    parser.add_argument("--batch_size", type=int, help=f"Training samples per batch (default {TRAINING_BATCH_SIZE} prefixes, or {SEQUENCE_BATCH_SIZE} names with --sequence).")
+    parser.add_argument("--sequence", action="store_true", help="Use the model that predicts the next character at every position of a whole name.")
 
-    args = parser.parse_args()
+    args = generation_utils.parseArguments(parser)
     name = args.name or "rnn"
-    assert args.train or args.stream, "Must have one of --stream or --train."
-    weights_path = "data/generation/rnn/{}_weights_{}.hdf5".format(
+    assert args.train or args.stream or args.export, "Must have one of --stream, --train or --export."
+    assert args.temperature > 0, "--temperature must be positive."
+    assert args.top_k is None or args.top_k > 0, "--top_k must be positive."
+    assert args.top_p is None or 0 < args.top_p <= 1, "--top_p must be in (0, 1]."
+    weights_path = "data/generation/rnn/{}_weights_{}{}.hdf5".format(
         name,
         "forward" if args.forward else "backward",
+        "_sequence" if args.sequence else "",
     )
-    if args.stream:
+    if args.export:
+        from keras.models import load_model
+        exportModel(load_model(weights_path), enginePath(weights_path))
+        print("Exported", weights_path, "to", enginePath(weights_path))
+    elif args.stream:
         extractedCandidates = generation_utils.getStartBucketNames(args) if args.experiment else None
+        # Only for the metrics: the model was trained on these.
+        generation_utils.getGuessedHits(
+            name, public=args.public, known=extractedCandidates or generation_utils.getExistingBuckets(public=args.public),
+        )
         streamRNNGuesses(
             beanstalkPort=args.port,
             forward=args.forward,
@@ -260,6 +315,9 @@ if __name__ == "__main__":
             numTrials=int(args.num_trials) or float("inf"),
             weights_path=weights_path,
             seedSet=extractedCandidates,
+            temperature=args.temperature,
+            topK=args.top_k,
+            topP=args.top_p,
         )
     elif args.train:
         
@@ -270,4 +328,7 @@ if __name__ == "__main__":
             filepath=weights_path,
             candidates=extractedCandidates,
             public=args.public,
+            epochs=args.epochs,
+            batchSize=args.batch_size,
+            sequence=args.sequence,
         )
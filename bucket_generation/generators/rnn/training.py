@@ -0,0 +1,185 @@
+"""
+Streaming training data for the RNN generator.
+The corpus is every known bucket name, encoded as character indices in one flat uint8 array, so
+millions of names take a few bytes each. Training samples (a prefix of a name and the character
+that follows it) are only expanded and one-hot encoded a batch at a time, so memory stays bounded
+whatever the size of the corpus.
+In sequence mode a sample is a whole name instead, and the model predicts the character that
+follows each of its prefixes at once.
+"""
+import numpy as np
+
+TIMESTEPS = 64
+BATCH_SIZE = 1000
+# Whole names per batch in sequence mode, about as many characters as BATCH_SIZE prefixes.
+SEQUENCE_BATCH_SIZE = 128
+EPOCHS = 10
+# Names are shuffled once per epoch, and the samples of this many names at a time.
+CHUNK_NAMES = 1 << 16
+UNKNOWN = 255
+
+
+class Corpus:
+    """
+    Names as character indices, one after the other, each followed by the end character.
+    :param indices: a flat uint8 array of character indices.
+    :param offsets: an array of len(names) + 1 offsets into indices where each name starts.
+    """
+
+    def __init__(self, indices, offsets):
+        self.indices = indices
+        self.offsets = offsets
+        # Including the end character.
+        self.lengths = np.diff(offsets)
+
+    @classmethod
+    def fromBytes(cls, data, offsets, charIndices, forward=True):
+        """
+        Encode names the way guesser.standardizeText does: lowercase, at most TIMESTEPS - 1
+        characters, reversed unless forward, then the end character. Names holding a character
+        outside charIndices are dropped.
+        :param data: a flat uint8 array of the names' bytes.
+        :param offsets: an array of len(names) + 1 offsets into data where each name starts.
+        :param charIndices: the model's character -> index mapping.
+        """
+        table = np.full(256, UNKNOWN, dtype=np.uint8)
+        for char, index in charIndices.items():
+            if len(char.encode('utf-8')) == 1 and char != '\r':
+                table[ord(char)] = index
+                table[ord(char.upper())] = index
+        offsets = np.asarray(offsets, dtype=np.int64)
+        numNames = len(offsets) - 1
+        kept = np.minimum(np.diff(offsets), TIMESTEPS - 1)
+        names = np.repeat(np.arange(numNames), kept)
+        keptStarts = np.cumsum(kept) - kept
+        positions = np.arange(int(kept.sum())) - np.repeat(keptStarts, kept)
+        source = positions if forward else np.repeat(kept, kept) - 1 - positions
+        chars = table[np.asarray(data)[np.repeat(offsets[:-1], kept) + source]]
+        valid = (kept > 0) & (np.bincount(names, weights=chars == UNKNOWN, minlength=numNames) == 0)
+
+        kept = kept[valid]
+        newOffsets = np.zeros(len(kept) + 1, dtype=np.int64)
+        np.cumsum(kept + 1, out=newOffsets[1:])
+        newNames = np.cumsum(valid) - 1
+        indices = np.full(newOffsets[-1], charIndices['\r'], dtype=np.uint8)
+        validChars = valid[names]
+        indices[newOffsets[newNames[names[validChars]]] + positions[validChars]] = chars[validChars]
+        return cls(indices, newOffsets)
+
+    @classmethod
+    def fromNames(cls, names, charIndices, forward=True):
+        """
+        :param names: an iterable of strings.
+        """
+        encoded = [name.strip().encode('utf-8') for name in names]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(name) for name in encoded], out=offsets[1:])
+        return cls.fromBytes(np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets, charIndices, forward)
+
+    @classmethod
+    def fromStore(cls, store, charIndices, forward=True, **filters):
+        """
+        :param store: a BucketStore; each distinct bucket name of the rows matching filters is used once.
+        """
+        data, offsets = store.nameBytes(store.uniqueBuckets(store.select(**filters)))
+        return cls.fromBytes(data, offsets, charIndices, forward)
+
+    def __len__(self):
+        return len(self.lengths)
+
+    @property
+    def numPrefixes(self):
+        """
+        The number of training samples: every prefix of every name, followed by its next character.
+        """
+        return int(self.lengths.sum()) - len(self)
+
+    def startCounts(self, vocab):
+        """
+        :return: how many names start with each character index.
+        """
+        return np.bincount(self.indices[self.offsets[:-1]], minlength=vocab)
+
+    def encodeBatch(self, names, prefixLengths, vocab):
+        """
+        One-hot encode training samples the way the model takes them: the prefix padded with zero
+        rows to TIMESTEPS, and the character that follows it.
+        :param names: the index of the name of each sample.
+        :param prefixLengths: the number of characters of its prefix.
+        :return: (a (samples, TIMESTEPS, vocab) input array, a (samples, vocab) target array).
+        """
+        starts = self.offsets[names]
+        inPrefix = np.arange(TIMESTEPS) < prefixLengths[:, None]
+        samples, steps = np.nonzero(inPrefix)
+        x = np.zeros((len(names), TIMESTEPS, vocab), dtype=np.float32)
+        x[samples, steps, self.indices[starts[samples] + steps]] = 1
+        y = np.zeros((len(names), vocab), dtype=np.float32)
+        y[np.arange(len(names)), self.indices[starts + prefixLengths]] = 1
+        return x, y
+
+    def encodeSequences(self, names, vocab):
+        """
+        One-hot encode whole names for the sequence model: every character but the end character as
+        input, and every character but the first as the target at the same step. Names shorter than
+        the longest one are padded with zero rows, which the model masks.
+        :param names: the index of each name.
+        :return: (a (names, steps, vocab) input array, a (names, steps, vocab) target array).
+        """
+        starts = self.offsets[names]
+        steps = self.lengths[names] - 1
+        inName = np.arange(steps.max()) < steps[:, None]
+        rows, positions = np.nonzero(inName)
+        x = np.zeros(inName.shape + (vocab,), dtype=np.float32)
+        x[rows, positions, self.indices[starts[rows] + positions]] = 1
+        y = np.zeros(inName.shape + (vocab,), dtype=np.float32)
+        y[rows, positions, self.indices[starts[rows] + positions + 1]] = 1
+        return x, y
+
+
+def trainingBatches(corpus, vocab, batchSize=BATCH_SIZE, chunkNames=CHUNK_NAMES):
+    """
+    Stream shuffled training batches over the corpus, epoch after epoch.
+    Names are shuffled every epoch; the samples of a chunk of names are expanded and shuffled
+    together, so memory only depends on the chunk size.
+    :return: a generator of (x, y) batches of batchSize samples, for Keras' fit.
+    """
+    leftoverNames = np.zeros(0, dtype=np.int64)
+    leftoverLengths = np.zeros(0, dtype=np.int64)
+    while True:
+        order = np.random.permutation(len(corpus))
+        for start in range(0, len(order), chunkNames):
+            chunk = order[start:start + chunkNames]
+            counts = corpus.lengths[chunk] - 1
+            names = np.repeat(chunk, counts)
+            prefixLengths = np.arange(len(names)) - np.repeat(np.cumsum(counts) - counts, counts) + 1
+            shuffle = np.random.permutation(len(names))
+            names = np.concatenate([leftoverNames, names[shuffle]])
+            prefixLengths = np.concatenate([leftoverLengths, prefixLengths[shuffle]])
+            end = len(names) - len(names) % batchSize
+            for batchStart in range(0, end, batchSize):
+                batch = slice(batchStart, batchStart + batchSize)
+                yield corpus.encodeBatch(names[batch], prefixLengths[batch], vocab)
+            leftoverNames, leftoverLengths = names[end:], prefixLengths[end:]
+
+def stepsPerEpoch(corpus, batchSize=BATCH_SIZE):
+    return max(1, corpus.numPrefixes // batchSize)
+
+def sequenceBatches(corpus, vocab, batchSize=SEQUENCE_BATCH_SIZE, chunkNames=CHUNK_NAMES):
+    """
+    Stream shuffled batches of whole names over the corpus, epoch after epoch, for the sequence model.
+    Each chunk of shuffled names is sorted by length before it is cut into batches, so that names
+    of a batch need little padding, and its batches are then yielded in a random order.
+    :return: a generator of (x, y) batches of at most batchSize names, for Keras' fit.
+    """
+    while True:
+        order = np.random.permutation(len(corpus))
+        for start in range(0, len(order), chunkNames):
+            chunk = order[start:start + chunkNames]
+            chunk = chunk[np.argsort(corpus.lengths[chunk], kind="stable")]
+            batchStarts = np.arange(0, len(chunk), batchSize)
+            for batchStart in np.random.permutation(batchStarts):
+                yield corpus.encodeSequences(chunk[batchStart:batchStart + batchSize], vocab)
+
+def sequenceStepsPerEpoch(corpus, batchSize=SEQUENCE_BATCH_SIZE, chunkNames=CHUNK_NAMES):
+    fullChunks, remainder = divmod(len(corpus), chunkNames)
+    return max(1, fullChunks * -(-chunkNames // batchSize) + -(-remainder // batchSize))
@@ -13,10 +13,9 @@ from collections import Counter
 from enum import Enum, auto
 import re
 
-import numpy as np
-
 from bucket_extraction.utils.extract_utils import getBucketsFromText
 import bucket_generation.utils as gen_utils
+from bucket_generation.sampler import SamplerCache, groupByKey
 
 class Type(Enum):
     """
@@ -86,13 +85,14 @@ def loadTypeSets():
     return techTerms, suffixes, files, domains, words
 
 
-def updateCounters(buckets):
+def updateCounters(buckets, typeSets=None):
     """
     Generate distributions for each CFG node
+    :param typeSets: the output of loadTypeSets, loaded if not given.
     :return: a counter for templates, dictionary words, tech words, files, domains, compound words, TLDS, and numbers
     """
 
-    techTerms, suffixes, files, domains, words = loadTypeSets()
+    techTerms, suffixes, files, domains, words = typeSets or loadTypeSets()
 
     counters = { key: Counter() for key in Type }
     delimiters = re.compile('[-._]')
@@ -113,46 +113,78 @@ def updateCounters(buckets):
     return counters  
 
 
-def sampleFromCounter(counter):
-    total = sum(counter.values())
-    return np.random.choice([k for k,v in counter.items()], p=[v/total for k,v in counter.items()])
+class TokenPCFGGenerator:
+    """
+    Token PCFG model that generates candidates in batches.
+    """
+
+    delimiters = re.compile('([-._])')
+
+    def __init__(self, buckets):
+        self.typeSets = loadTypeSets()
+        self.counters = updateCounters(buckets, typeSets=self.typeSets)
+        self.samplers = SamplerCache(self.counters)
+
+    def update(self, buckets):
+        """
+        Add buckets to the counters, only the types they touch are rebuilt.
+        """
+        newCounters = updateCounters(buckets, typeSets=self.typeSets)
+        touched = [key for key, counter in newCounters.items() if counter]
+        for key in touched:
+            self.counters[key].update(newCounters[key])
+        self.samplers.invalidate(touched)
+
+    def generate_batch(self, n):
+        """
+        Generate n candidates template by template: all templates are drawn at once,
+        then each token type of a template is filled for every candidate sharing it in one draw.
+        :param n: the number of candidates to generate.
+        :return: a list of n candidate bucket names.
+        """
+        buckets = [""] * n
+        for template, indices in groupByKey(self.samplers[Type.TEMPLATE].sample(n)).items():
+            columns = []
+            # The split keeps the delimiters, so odd positions are delimiters and even positions are types.
+            for idx, token in enumerate(self.delimiters.split(template)):
+                if idx % 2 == 1:
+                    columns.append([token] * len(indices))
+                elif token != '':
+                    columns.append(self.samplers[Type[token]].sample(len(indices)))
+            for i, parts in zip(indices, zip(*columns)):
+                buckets[i] = "".join(parts)
+        return buckets
 
 def generatePCFGCandidates(startingCandidates=None, beanstalkPort=None, name="token_pcfg", numTrials=float("inf"), public=False):
     beanstalkClient = gen_utils.getBeanstalkClient(port=beanstalkPort)
-    previouslySeen = startingCandidates | gen_utils.readBucketsFromFile(f"./data/generation/{name}.txt")
+    previouslySeen = gen_utils.getPreviouslySeen(name, startingCandidates)
+    seedBuckets = startingCandidates or gen_utils.getExistingBuckets(public=public)
+    guessedHits = gen_utils.getGuessedHits(name, public=public, known=seedBuckets)
+    generator = TokenPCFGGenerator(seedBuckets)
+    output = gen_utils.getOutput(name)
 
-    # Randomly generate template according to distro
-    delimiters = re.compile('[-._]')
     while numTrials > 0:
          
-        # Every 10,000 guesses, update the PCFG.
-        print("Updating PCFG.")
+        # Every 10,000 guesses, add our new successful guesses to the PCFG.
+        output.message("Updating PCFG.")
         with gen_utils.Profiler(gen_utils.ProfilerType.TRAIN, name):
-            candidates = startingCandidates | gen_utils.getExistingAlreadyGuessedBuckets(name, public=public)
-            counters = updateCounters(candidates)
-
-        for i in range(int(1e4)):
-            with gen_utils.Profiler(gen_utils.ProfilerType.GENERATE, name) as p:
-                template = sampleFromCounter(counters[Type.TEMPLATE])        
-                tokens = delimiters.split(template)
-                templateDelimiters = list(delimiters.finditer(template))
-                bucket = ''
-                for idx, token in enumerate(tokens):
-                    if token != '':
-                        bucket += sampleFromCounter(counters[Type[token]])
-                    if idx != len(tokens) - 1:
-                        bucket += templateDelimiters[idx].group()
-                p.bucket(bucket)
-                if bucket not in previouslySeen:
-                    numTrials -= 1
-                    previouslySeen.add(bucket)
-                    print('CAND:', bucket)
-                    beanstalkClient.put_job(f"generation/{name},{bucket}")
+            generator.update(guessedHits.update())
+
+        with gen_utils.Profiler(gen_utils.ProfilerType.GENERATE, name) as p:
+            batch = generator.generate_batch(int(1e4))
+            p.batch(batch)
+        accepted = gen_utils.claimCandidates(previouslySeen, batch)
+        output.candidates(accepted, generated=len(batch))
+        for bucket in accepted:
+            beanstalkClient.put_job(f"generation/{name},{bucket}")
+        numTrials -= len(accepted)
+    beanstalkClient.flush()
+    previouslySeen.sync()
     
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Run the Token PCFG generator.')
     gen_utils.addArguments(parser)
-    args = parser.parse_args()
+    args = gen_utils.parseArguments(parser)
     candidates = gen_utils.getStartBucketNames(args)    
     generatePCFGCandidates(name=args.name, startingCandidates=candidates, public=args.public, numTrials=int(args.num_trials) or float("inf"))
 
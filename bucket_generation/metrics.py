@@ -0,0 +1,182 @@
+"""
+Live metrics of a running generator, in the Prometheus text format.
+Enabled with --metrics_port (serves http://127.0.0.1:<port>/metrics) and/or --metrics_file
+(rewritten every --metrics_interval seconds, e.g. for node_exporter's textfile collector).
+
+Counters are cumulative for the process; the *_per_second gauges cover the last interval.
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import os
+import threading
+import time
+
+from bucket_generation.profiling import ProfilerType, recorders
+
+PREFIX = "bucket_generator"
+
+
+class GeneratorMetrics:
+    """
+    Collects the throughput of one generator process.
+    :param name: the generator name, used as the `generator` label.
+    :param guessedHits: the generator's GuessedHits, refreshed to count validated hits. See watchHits.
+    :param interval: seconds between two snapshots.
+    """
+
+    def __init__(self, name, guessedHits=None, interval=10.0):
+        self.name = name
+        self.guessedHits = guessedHits
+        self.interval = interval
+        self.generated = 0
+        self.accepted = 0
+        self.client = None
+        self.validity = None
+        self.lastSnapshot = None
+        self.text = ""
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+
+    def countCandidates(self, generated, accepted):
+        """
+        :param generated: the number of candidates that were generated.
+        :param accepted: how many of them were left to submit after dedup.
+        """
+        self.generated += generated
+        self.accepted += accepted
+
+    def watchClient(self, client):
+        """
+        :param client: the generator's BeanstalkProducer (or SubmissionPipeline around one).
+        """
+        self.client = client
+
+    def watchHits(self, guessedHits):
+        """
+        :param guessedHits: the generator's GuessedHits, once it knows the seeds of the model:
+            refreshing it before would count the seeds as hits.
+        """
+        self.guessedHits = guessedHits
+
+    def watchValidity(self, validity):
+        """
+        :param validity: the ValidityFilter the generator's candidates go through.
+        """
+        self.validity = validity
+
+    def snapshot(self):
+        """
+        :return: a dict of metric name -> value.
+        """
+        values = {
+            "generated_total": self.generated,
+            "accepted_total": self.accepted,
+            "cpu_seconds_total": time.process_time(),
+        }
+        if self.client is not None:
+            values["jobs_sent_total"] = self.client.jobsSent
+            values["put_seconds_total"] = self.client.putTime
+            values["throttle_seconds_total"] = self.client.throttleTime
+            values["beanstalk_ready_jobs"] = self.client.jobsReady
+            if hasattr(self.client, "queue"):
+                values["submission_queue_jobs"] = self.client.queue.qsize()
+                values["dropped_total"] = self.client.dropped
+        if self.validity is not None:
+            # Candidates no provider accepts, and the first rule each provider saw them break.
+            values["invalid_total"] = self.validity.invalid
+            for provider, counts in self.validity.rejected.items():
+                for rule, count in counts.items():
+                    values[f"invalid_{provider}_{rule}_total"] = count
+        train = recorders.get((ProfilerType.TRAIN, self.name))
+        if train is not None:
+            values["retrains_total"] = train.numCalls
+            values["retrain_seconds_total"] = train.runSeconds
+            values["last_retrain_seconds"] = train.lastSeconds
+        if self.guessedHits is not None:
+            self.guessedHits.refresh()
+            # Guesses the validator has answered, those that were known seeds, and how many of the
+            # others turned out to exist. The hit rate is over the guesses that were not seeds.
+            values["validated_total"] = self.guessedHits.numGuessed
+            values["validated_known_total"] = self.guessedHits.numKnownGuessed
+            values["validated_hits_total"] = self.guessedHits.numHits
+            values["hit_rate"] = self.guessedHits.numHits / max(
+                self.guessedHits.numGuessed - self.guessedHits.numKnownGuessed, 1
+            )
+        return values
+
+    def update(self):
+        """
+        Take a snapshot, derive the rates since the previous one and render the text.
+        """
+        now = time.monotonic()
+        values = self.snapshot()
+        if self.lastSnapshot is not None:
+            then, previous = self.lastSnapshot
+            elapsed = max(now - then, 1e-9)
+            # Some metrics only show up once their source exists, count those from zero.
+            delta = lambda metric: values[metric] - previous.get(metric, 0)
+            values["generated_per_second"] = delta("generated_total") / elapsed
+            values["accepted_per_second"] = delta("accepted_total") / elapsed
+            if "invalid_total" in values:
+                values["invalid_per_second"] = delta("invalid_total") / elapsed
+            if "jobs_sent_total" in values:
+                sent = delta("jobs_sent_total")
+                values["put_seconds_per_job"] = delta("put_seconds_total") / sent if sent else 0.0
+                values["throttle_seconds_per_second"] = delta("throttle_seconds_total") / elapsed
+            if "validated_hits_total" in values:
+                cpuSeconds = delta("cpu_seconds_total")
+                values["hits_per_cpu_second"] = delta("validated_hits_total") / cpuSeconds if cpuSeconds else 0.0
+        self.lastSnapshot = (now, values)
+        text = "".join(
+            f'{PREFIX}_{metric}{{generator="{self.name}"}} {value}\n'
+            for metric, value in values.items()
+        )
+        with self.lock:
+            self.text = text
+        return text
+
+    def start(self, port=None, path=None):
+        """
+        Refresh the metrics every interval on a background thread.
+        :param port: serve the metrics over HTTP on this local port.
+        :param path: rewrite this file with the metrics after every refresh.
+        """
+        self._publish(path)
+        if port:
+            metrics = self
+
+            class Handler(BaseHTTPRequestHandler):
+                def do_GET(self):
+                    with metrics.lock:
+                        body = metrics.text.encode("utf-8")
+                    self.send_response(200)
+                    self.send_header("Content-Type", "text/plain; version=0.0.4")
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, *args):
+                    pass
+
+            server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+            threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+        threading.Thread(target=self._run, args=(path,), name="metrics", daemon=True).start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def _run(self, path):
+        while not self.stopped.wait(self.interval):
+            try:
+                self._publish(path)
+            except Exception as e:
+                # Metrics must never take the generator down.
+                print("COULDNT UPDATE METRICS", e)
+
+    def _publish(self, path):
+        text = self.update()
+        if path:
+            # Write to a temporary file first so that a scraper never sees a half-written file.
+            tmpPath = path + ".tmp"
+            with open(tmpPath, "w") as f:
+                f.write(text)
+            os.replace(tmpPath, path)
@@ -0,0 +1,100 @@
+"""
+Console and log output of the generators, kept off the hot path.
+Levels:
+    silent: print nothing.
+    summary: print a line with the candidate counts every few seconds.
+    every: print every candidate, written once per batch.
+Independently of the level, every candidate can be appended to a block-buffered JSONL log.
+"""
+import atexit
+import json
+import sys
+import time
+
+SILENT = "silent"
+SUMMARY = "summary"
+EVERY = "every"
+LEVELS = [SILENT, SUMMARY, EVERY]
+
+
+class CandidateOutput:
+    """
+    :param name: the generator name, shown in summaries.
+    :param level: one of SILENT, SUMMARY or EVERY.
+    :param logPath: if set, append a {"bucket": ..., "time": ...} line per candidate to this file.
+    :param summaryInterval: seconds between two summary lines.
+    """
+
+    def __init__(self, name, level=SUMMARY, logPath=None, summaryInterval=10.0):
+        assert level in LEVELS, f"Output level must be one of {'/'.join(LEVELS)}."
+        self.name = name
+        self.level = level
+        self.summaryInterval = summaryInterval
+        self.log = open(logPath, "a", buffering=1 << 20) if logPath else None
+        self.generated = 0
+        self.accepted = 0
+        self.start = self.lastSummary = time.monotonic()
+        self.acceptedAtLastSummary = 0
+
+    def candidates(self, accepted, generated=None):
+        """
+        Report a batch of candidates.
+        :param accepted: the candidates that are submitted.
+        :param generated: how many candidates were generated to get them, if more than were accepted.
+        """
+        self.accepted += len(accepted)
+        self.generated += len(accepted) if generated is None else generated
+        if self.log is not None and accepted:
+            now = int(time.time())
+            self.log.write("".join(
+                f'{{"bucket": {json.dumps(bucket)}, "time": {now}}}\n' for bucket in accepted
+            ))
+        if self.level == EVERY:
+            if accepted:
+                sys.stdout.write("".join(f"CAND: {bucket}\n" for bucket in accepted))
+        elif self.level == SUMMARY and time.monotonic() - self.lastSummary > self.summaryInterval:
+            self.summary()
+
+    def summary(self):
+        now = time.monotonic()
+        rate = (self.accepted - self.acceptedAtLastSummary) / max(now - self.lastSummary, 1e-9)
+        dropped = 1 - self.accepted / self.generated if self.generated else 0
+        print(
+            f"{self.name}: {self.accepted} candidates submitted ({rate:.0f}/s), "
+            f"{self.generated} generated ({dropped:.1%} duplicate or invalid), {now - self.start:.0f}s elapsed",
+            flush=True,
+        )
+        self.lastSummary = now
+        self.acceptedAtLastSummary = self.accepted
+
+    def message(self, text):
+        """
+        Print a status message, unless silent.
+        """
+        if self.level != SILENT:
+            print(text, flush=True)
+
+    def close(self):
+        if self.level == SUMMARY and self.generated:
+            self.summary()
+        sys.stdout.flush()
+        if self.log is not None:
+            self.log.close()
+            self.log = None
+
+
+outputs = {}
+
+def getCandidateOutput(name, level=SUMMARY, logPath=None):
+    """
+    The process-wide output of a generator, created with the given options on first use.
+    """
+    output = outputs.get(name)
+    if output is None:
+        output = outputs[name] = CandidateOutput(name, level=level, logPath=logPath)
+    return output
+
+@atexit.register
+def closeAll():
+    for output in outputs.values():
+        output.close()
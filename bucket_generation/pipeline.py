@@ -0,0 +1,117 @@
+"""
+Producer/consumer split between candidate generation and queue submission.
+Generation keeps running on the calling thread while a background thread drains a bounded
+queue into the beanstalk producer, so neither side stalls on the other.
+"""
+import queue
+import threading
+
+BLOCK = "block"
+DROP = "drop"
+
+_FLUSH = object()
+_STOP = object()
+
+
+class SubmissionPipeline:
+    """
+    Stands in for the beanstalk client: put_job only enqueues, and a submitter thread
+    forwards jobs to the wrapped client.
+    :param client: the client that actually submits jobs, e.g. a BeanstalkProducer.
+    :param depth: the maximum number of jobs waiting to be submitted.
+    :param policy: BLOCK to make generation wait when the queue is full, DROP to discard the job.
+        Callers that record what they submit should check room() first, see utils.claimCandidates.
+    """
+
+    def __init__(self, client, depth=100000, policy=BLOCK):
+        assert policy in (BLOCK, DROP), "Queue policy must be one of block/drop."
+        self.client = client
+        self.policy = policy
+        self.queue = queue.Queue(maxsize=depth)
+        self.dropped = 0
+        self.error = None
+        self.flushed = threading.Event()
+        self.thread = threading.Thread(target=self._submit, name="submitter", daemon=True)
+        self.thread.start()
+
+    def put_job(self, data, **kwargs):
+        self._raiseSubmitterError()
+        if self.policy == BLOCK:
+            while True:
+                try:
+                    self.queue.put((data, kwargs), timeout=1)
+                    break
+                except queue.Full:
+                    self._raiseSubmitterError()
+        else:
+            try:
+                self.queue.put_nowait((data, kwargs))
+            except queue.Full:
+                self.dropped += 1
+
+    def room(self):
+        """
+        :return: how many jobs can be enqueued right now without dropping any, or None under BLOCK.
+            The submitter only ever frees room, so the answer holds until this thread enqueues.
+        """
+        if self.policy == BLOCK:
+            return None
+        return max(self.queue.maxsize - self.queue.qsize(), 0)
+
+    def drop(self, numJobs):
+        """
+        Count jobs that were discarded before put_job, e.g. by claimCandidates.
+        """
+        self.dropped += numJobs
+
+    def flush(self):
+        """
+        Wait until every job enqueued so far has been submitted.
+        """
+        self._raiseSubmitterError()
+        self.flushed.clear()
+        self.queue.put(_FLUSH)
+        while not self.flushed.wait(timeout=1):
+            self._raiseSubmitterError()
+        self._raiseSubmitterError()
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(_STOP)
+            self.thread.join()
+        self._raiseSubmitterError()
+        self.client.close()
+
+    def __getattr__(self, attr):
+        # Anything else (stats, queueDepth, counters) is answered by the wrapped client.
+        return getattr(self.client, attr)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.close()
+
+    def _raiseSubmitterError(self):
+        if self.error is not None:
+            raise self.error
+
+    def _submit(self):
+        try:
+            while True:
+                item = self.queue.get()
+                if item is _STOP:
+                    self.client.flush()
+                    return
+                if item is _FLUSH:
+                    self.client.flush()
+                    self.flushed.set()
+                    continue
+                data, kwargs = item
+                self.client.put_job(data, **kwargs)
+                if self.queue.empty():
+                    # Generation is the bottleneck right now, don't let jobs sit in the buffer.
+                    self.client.flush()
+        except Exception as e:
+            self.error = e
+            self.flushed.set()
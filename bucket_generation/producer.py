@@ -0,0 +1,170 @@
+"""
+Pipelined beanstalk producer shared by the generators and the feeders.
+Jobs are buffered and written with many put commands per socket write, and the queue
+depth is probed on a timer instead of before every put.
+Pipelining reuses pystalk's connection handling (BeanstalkClient._sock_ctx), which is not public
+API, so requirements.txt pins the pystalk version it was written against.
+"""
+import threading
+import time
+
+from pystalk import BeanstalkClient, BeanstalkError
+
+
+class BeanstalkProducer(BeanstalkClient):
+    """
+    Drop-in replacement for BeanstalkClient.put_job that buffers and pipelines jobs.
+
+    Backpressure is a smooth rate controller on the ready queue depth: below lowWater jobs are
+    sent as fast as possible, between the marks each job is delayed proportionally up to
+    maxJobDelay, and once the queue reaches highWater the producer pauses until it drains back
+    below lowWater.
+
+    A background thread also flushes the buffer once it is flushInterval old, so jobs never wait
+    for the next put_job, e.g. while the generator retrains.
+    """
+
+    def __init__(
+        self, address, port, batchSize=500, flushInterval=1.0,
+        probeInterval=5.0, probeEvery=10000,
+        lowWater=1e5, highWater=1e7, maxJobDelay=0.01,
+    ):
+        super().__init__(address, int(port))
+        self.batchSize = batchSize
+        self.flushInterval = flushInterval
+        self.probeInterval = probeInterval
+        self.probeEvery = probeEvery
+        self.lowWater = lowWater
+        self.highWater = highWater
+        self.maxJobDelay = maxJobDelay
+        self.pending = []
+        self.lastFlush = time.time()
+        # Guards the buffer and the connection, shared with the flush thread.
+        self.lock = threading.RLock()
+        self.flushError = None
+        self.closed = threading.Event()
+        self.lastProbe = 0
+        self.jobsSinceProbe = 0
+        self.jobsReady = 0
+        self.paused = False
+        # Running totals, useful to see where time goes.
+        self.jobsSent = 0
+        self.putTime = 0
+        self.throttleTime = 0
+        self.flushThread = threading.Thread(target=self._flushPeriodically, name="producer-flush", daemon=True)
+        self.flushThread.start()
+
+    def put_job(self, data, pri=65536, delay=0, ttr=120):
+        """
+        Buffer a job. It is sent once the buffer fills up or flushInterval has elapsed.
+        """
+        self._raiseFlushError()
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        with self.lock:
+            self.pending.append(
+                b'put %d %d %d %d\r\n%s\r\n' % (pri, delay, ttr, len(data), data)
+            )
+            if len(self.pending) >= self.batchSize or time.time() - self.lastFlush > self.flushInterval:
+                self.flush()
+
+    def _flushPeriodically(self):
+        while not self.closed.wait(self.flushInterval):
+            try:
+                with self.lock:
+                    if self.pending and time.time() - self.lastFlush >= self.flushInterval:
+                        self.flush()
+            except Exception as e:
+                # Raised by the next put_job or flush on the producing thread.
+                self.flushError = e
+
+    def _raiseFlushError(self):
+        if self.flushError is not None:
+            error, self.flushError = self.flushError, None
+            raise error
+
+    def flush(self):
+        """
+        Send every buffered job in one pipelined write, after applying backpressure.
+        :return: the ids of the inserted jobs.
+        """
+        with self.lock:
+            return self._flush()
+
+    def _flush(self):
+        self.lastFlush = time.time()
+        if not self.pending:
+            return []
+        messages, self.pending = self.pending, []
+        self.throttle(len(messages))
+
+        start = time.time()
+        with self._sock_ctx() as sock:
+            sock.sendall(b''.join(messages))
+            responses = self._receiveLines(sock, len(messages))
+        self.putTime += time.time() - start
+        self.jobsSent += len(messages)
+        self.jobsSinceProbe += len(messages)
+
+        # Read every response before raising so the connection stays in sync.
+        jobIds = []
+        error = None
+        for response in responses:
+            status, _, jobId = response.partition(b' ')
+            if status == b'INSERTED':
+                jobIds.append(int(jobId))
+            elif error is None:
+                error = response
+        if error is not None:
+            raise BeanstalkError(error)
+        return jobIds
+
+    def _receiveLines(self, sock, count):
+        buf = b''
+        while buf.count(b'\r\n') < count:
+            message = sock.recv(65536)
+            if not message:
+                raise BeanstalkError('Connection closed by beanstalkd')
+            buf += message
+        return buf.split(b'\r\n')[:count]
+
+    def queueDepth(self, refresh=False):
+        """
+        The number of ready jobs, probed at most every probeInterval seconds or probeEvery jobs.
+        """
+        if refresh or self.jobsSinceProbe >= self.probeEvery or time.time() - self.lastProbe > self.probeInterval:
+            self.jobsReady = self.stats()["current-jobs-ready"]
+            self.lastProbe = time.time()
+            self.jobsSinceProbe = 0
+        return self.jobsReady
+
+    def throttle(self, numJobs):
+        """
+        Sleep in proportion to the queue depth before sending numJobs jobs.
+        """
+        start = time.time()
+        jobsReady = self.queueDepth()
+        if jobsReady >= self.highWater:
+            self.paused = True
+        while self.paused:
+            time.sleep(self.probeInterval)
+            if self.queueDepth(refresh=True) <= self.lowWater:
+                self.paused = False
+                jobsReady = self.jobsReady
+        if jobsReady > self.lowWater:
+            fill = (jobsReady - self.lowWater) / (self.highWater - self.lowWater)
+            time.sleep(numJobs * self.maxJobDelay * min(fill, 1))
+        self.throttleTime += time.time() - start
+
+    def close(self):
+        self.closed.set()
+        self.flushThread.join()
+        self.flush()
+        self._raiseFlushError()
+        super().close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.close()
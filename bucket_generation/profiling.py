@@ -0,0 +1,196 @@
+"""
+Low-overhead profiling of the train and generate phases of the generators.
+Every profiled block lands in an in-memory log-scale histogram, and 1 in SAMPLE_EVERY blocks
+is also kept as a detailed record. Both are flushed to ./data/timing/{type}/ periodically and
+at exit, so profiling a fast generator costs a few clock reads per candidate instead of
+a file append.
+
+Summarize the results with:
+    python -m bucket_generation.profiling [generator names]
+"""
+import argparse
+import atexit
+from enum import Enum
+import glob
+import math
+import os
+import time
+
+import numpy as np
+
+TIMING_DIRECTORY = "./data/timing"
+SAMPLE_EVERY = 100
+FLUSH_INTERVAL = 30 # seconds
+
+# Histogram bins grow geometrically, 16 per doubling (about 4% apart), from 100ns to about a day.
+MIN_SECONDS = 1e-7
+BINS_PER_OCTAVE = 16
+NUM_BINS = 40 * BINS_PER_OCTAVE
+
+RECORD_DTYPE = np.dtype([("timestamp", "<f8"), ("seconds", "<f8"), ("bucket", "S64")])
+
+
+class ProfilerType(Enum):
+    TRAIN = "train"
+    GENERATE = "generate"
+
+
+class Recorder:
+    """
+    Histogram and sampled records of one (profiler type, generator name) pair.
+    The histogram at {name}.hist.npy accumulates across runs, records are appended to {name}.records.
+    """
+
+    def __init__(self, profilerType, name):
+        directory = os.path.join(TIMING_DIRECTORY, profilerType.value)
+        self.histogramPath = os.path.join(directory, f"{name}.hist.npy")
+        self.recordsPath = os.path.join(directory, f"{name}.records")
+        self.counts = [0] * NUM_BINS
+        self.totalSeconds = 0.0
+        self.numCalls = 0
+        # Totals of this process only, for live metrics.
+        self.runSeconds = 0.0
+        self.lastSeconds = 0.0
+        self.records = []
+        self.lastFlush = time.monotonic()
+        self.persisted = loadHistogram(self.histogramPath)
+
+    def record(self, seconds, bucket):
+        self.counts[binIndex(seconds)] += 1
+        self.totalSeconds += seconds
+        self.runSeconds += seconds
+        self.lastSeconds = seconds
+        self.numCalls += 1
+        if self.numCalls % SAMPLE_EVERY == 0:
+            self.records.append((time.time(), seconds, bucket.encode("utf-8")[:64]))
+        # Checked on every call: train and batched generate blocks are too rare to wait for a sampled one.
+        if time.monotonic() - self.lastFlush > FLUSH_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        self.lastFlush = time.monotonic()
+        if self.numCalls == 0:
+            return
+        os.makedirs(os.path.dirname(self.histogramPath), exist_ok=True)
+        histogram = self.persisted + np.array(self.counts + [self.totalSeconds], dtype=np.float64)
+        # Write to a temporary file first so that a reader never sees a half-written histogram.
+        tmpPath = self.histogramPath + ".tmp.npy"
+        np.save(tmpPath, histogram)
+        os.replace(tmpPath, self.histogramPath)
+        if self.records:
+            with open(self.recordsPath, "ab") as f:
+                f.write(np.array(self.records, dtype=RECORD_DTYPE).tobytes())
+            self.records = []
+        self.persisted = histogram
+        self.counts = [0] * NUM_BINS
+        self.totalSeconds = 0.0
+
+
+recorders = {}
+
+def getRecorder(profilerType, name):
+    recorder = recorders.get((profilerType, name))
+    if recorder is None:
+        recorder = recorders[(profilerType, name)] = Recorder(profilerType, name)
+    return recorder
+
+@atexit.register
+def flushAll():
+    for recorder in recorders.values():
+        recorder.flush()
+
+
+class Profiler:
+    """
+    Times a train or generate block in CPU seconds.
+    with Profiler(ProfilerType.GENERATE, name) as p:
+        ...
+        p.bucket(candidate)
+    """
+
+    def __init__(self, profilerType, name):
+        assert isinstance(profilerType, ProfilerType), "Don't know where to write these profiled results."
+        assert isinstance(name, str), "Name must be a string corresponding to the profiler."
+        self.type = profilerType
+        self.name = name
+        self.bucket_name = ""
+        self.recorder = getRecorder(profilerType, name)
+
+    def __enter__(self):
+        self.start = time.process_time()
+        return self
+
+    def bucket(self, bucket):
+        self.bucket_name = bucket
+
+    def batch(self, buckets):
+        self.bucket_name = f"batch:{len(buckets)}"
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.recorder.record(time.process_time() - self.start, self.bucket_name)
+
+
+def binIndex(seconds):
+    if seconds <= MIN_SECONDS:
+        return 0
+    return min(int(math.log2(seconds * (1 / MIN_SECONDS)) * BINS_PER_OCTAVE), NUM_BINS - 1)
+
+def loadHistogram(path):
+    """
+    :return: the NUM_BINS bin counts followed by the total seconds, zeros if nothing was written yet.
+    """
+    try:
+        return np.load(path)
+    except (FileNotFoundError, ValueError):
+        return np.zeros(NUM_BINS + 1, dtype=np.float64)
+
+def loadRecords(path):
+    """
+    :return: a structured array of the sampled (timestamp, seconds, bucket) records.
+    """
+    try:
+        return np.fromfile(path, dtype=RECORD_DTYPE)
+    except FileNotFoundError:
+        return np.zeros(0, dtype=RECORD_DTYPE)
+
+def summarize(profilerType, name):
+    """
+    Summarize the flushed timings of a generator phase.
+    :return: a dict of the number of calls, total and mean CPU seconds, and the p50/p95/p99 in seconds.
+    """
+    histogram = loadHistogram(os.path.join(TIMING_DIRECTORY, profilerType.value, f"{name}.hist.npy"))
+    counts, totalSeconds = histogram[:NUM_BINS], histogram[NUM_BINS]
+    numCalls = int(counts.sum())
+    summary = {"calls": numCalls, "total": totalSeconds, "mean": totalSeconds / numCalls if numCalls else 0.0}
+    cumulative = np.cumsum(counts)
+    for percentile in (50, 95, 99):
+        if numCalls == 0:
+            summary[f"p{percentile}"] = 0.0
+            continue
+        index = int(np.searchsorted(cumulative, numCalls * percentile / 100))
+        # Report the geometric middle of the bin.
+        summary[f"p{percentile}"] = MIN_SECONDS * 2 ** ((index + 0.5) / BINS_PER_OCTAVE)
+    return summary
+
+def printSummaries(names=None):
+    print(f"{'phase':<9}{'generator':<24}{'calls':>10}{'total(s)':>12}{'mean':>11}{'p50':>11}{'p95':>11}{'p99':>11}")
+    for profilerType in ProfilerType:
+        found = sorted(
+            os.path.basename(path)[:-len(".hist.npy")]
+            for path in glob.glob(os.path.join(TIMING_DIRECTORY, profilerType.value, "*.hist.npy"))
+        )
+        for name in found:
+            if names and name not in names:
+                continue
+            s = summarize(profilerType, name)
+            print(
+                f"{profilerType.value:<9}{name:<24}{s['calls']:>10}{s['total']:>12.2f}"
+                f"{s['mean']:>11.2e}{s['p50']:>11.2e}{s['p95']:>11.2e}{s['p99']:>11.2e}"
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Summarize the generator timings.')
+    parser.add_argument("names", nargs="*", help="Only summarize these generators.")
+    args = parser.parse_args()
+    printSummaries(args.names)
@@ -1,15 +1,19 @@
-from pystalk import BeanstalkClient
-import time
 from bucket_extraction import getBucketsFromText
+from bucket_generation.output import getCandidateOutput
+from bucket_generation.producer import BeanstalkProducer
+from bucket_generation.validity import ValidityFilter
 
-beanstalk_client = BeanstalkClient('127.0.0.1', 11301)
+beanstalk_client = BeanstalkProducer('127.0.0.1', 11301)
 
 def replayExisting(file, label):
+    output = getCandidateOutput(label)
+    validity = ValidityFilter()
     with open(file, 'r') as f:
         for line in f:
-            buckets = list(getBucketsFromText(line))
+            found = list(getBucketsFromText(line))
+            buckets = validity.filter(found)
+            output.candidates(buckets, generated=len(found))
             for bucket in buckets:
-                print('CAND:', bucket)
                 beanstalk_client.put_job("generation/" + label + "," + bucket)
-                time.sleep(1/200)
-
+    beanstalk_client.flush()
+    output.message(validity.summary())
@@ -0,0 +1,191 @@
+"""
+Shared sampling utilities for the generators.
+A Counter is frozen once per retrain into a Walker/Vose alias table, after which
+every draw is O(1) and thousands of draws can be taken in a single vectorized call.
+"""
+import numpy as np
+
+
+class CounterSampler:
+    """
+    Alias table built from a Counter (or any key -> weight mapping).
+    """
+
+    MIN_BUFFER = 16
+    MAX_BUFFER = 4096
+    # Below this many draws, the per-call overhead of numpy outweighs vectorizing.
+    SMALL_BATCH = 64
+
+    def __init__(self, counter):
+        assert len(counter) > 0, "Cannot sample from an empty counter."
+        self.keys = list(counter.keys())
+        weights = np.fromiter(counter.values(), dtype=np.float64, count=len(self.keys))
+        self.prob, self.alias = buildAliasTable(weights)
+        self._keyArray = None
+        self._buffer = []
+        self._bufferSize = self.MIN_BUFFER
+
+    def __len__(self):
+        return len(self.keys)
+
+    def sampleIndices(self, n):
+        """
+        Draw n key indices in one vectorized call.
+        :param n: the number of draws.
+        :return: an integer array of indices into self.keys.
+        """
+        columns = np.random.randint(0, len(self.keys), size=n)
+        coins = np.random.random_sample(n)
+        return np.where(coins < self.prob[columns], columns, self.alias[columns])
+
+    def sample(self, n=None):
+        """
+        Draw keys from the frozen distribution.
+        :param n: the number of draws, or None for a single key.
+        :return: a single key, or a list of n keys.
+        """
+        if n is None:
+            return self.keys[self._bufferedIndices(1)[0]]
+        if n <= self.SMALL_BATCH:
+            return [self.keys[i] for i in self._bufferedIndices(n)]
+        if self._keyArray is None:
+            self._keyArray = np.empty(len(self.keys), dtype=object)
+            self._keyArray[:] = self.keys
+        return self._keyArray[self.sampleIndices(n)].tolist()
+
+    def _bufferedIndices(self, n):
+        # Small draws come out of a buffer of pre-drawn indices. The buffer grows
+        # for samplers that are hit often so hot contexts refill rarely.
+        if len(self._buffer) < n:
+            self._buffer += self.sampleIndices(max(self._bufferSize, n)).tolist()
+            self._bufferSize = min(self._bufferSize * 2, self.MAX_BUFFER)
+        indices = self._buffer[-n:]
+        del self._buffer[-n:]
+        return indices
+
+
+def buildAliasTable(weights):
+    """
+    Vose's alias method.
+    :param weights: non-negative array of weights, not necessarily normalized.
+    :return: (prob, alias) arrays for O(1) sampling.
+    """
+    k = len(weights)
+    scaled = (weights * (k / weights.sum())).tolist()
+    prob = np.ones(k, dtype=np.float64)
+    alias = np.arange(k, dtype=np.int64)
+    small = [i for i, p in enumerate(scaled) if p < 1.0]
+    large = [i for i, p in enumerate(scaled) if p >= 1.0]
+    while small and large:
+        s = small.pop()
+        l = large.pop()
+        prob[s] = scaled[s]
+        alias[s] = l
+        scaled[l] = scaled[l] + scaled[s] - 1.0
+        if scaled[l] < 1.0:
+            small.append(l)
+        else:
+            large.append(l)
+    # Whatever remains is 1 up to floating point error.
+    return prob, alias
+
+
+class SamplerCache:
+    """
+    Lazily freezes a mapping of key -> Counter into CounterSamplers.
+    Keys missing from the mapping share a single sampler built from `default`,
+    which keeps defaultdicts of smoothing distributions from growing on lookups.
+    """
+
+    def __init__(self, counters, default=None):
+        self.counters = counters
+        self.samplers = {}
+        self.defaultSampler = CounterSampler(default) if default else None
+
+    def __getitem__(self, key):
+        sampler = self.samplers.get(key)
+        if sampler is None:
+            if key in self.counters:
+                sampler = CounterSampler(self.counters[key])
+            elif self.defaultSampler is not None:
+                sampler = self.defaultSampler
+            else:
+                raise KeyError(key)
+            self.samplers[key] = sampler
+        return sampler
+
+    def __contains__(self, key):
+        return key in self.counters or self.defaultSampler is not None
+
+    def invalidate(self, keys=None):
+        """
+        Drop frozen samplers so they are rebuilt from the (updated) counters.
+        :param keys: the keys whose counters changed, or None for all of them.
+        """
+        if keys is None:
+            self.samplers = {}
+        else:
+            for key in keys:
+                self.samplers.pop(key, None)
+
+
+def groupByKey(keys):
+    """
+    Group positions by key so that each distinct key can be sampled in one call.
+    :param keys: an iterable of hashable keys.
+    :return: a dict of key -> list of positions holding that key.
+    """
+    groups = {}
+    for i, key in enumerate(keys):
+        positions = groups.get(key)
+        if positions is None:
+            groups[key] = [i]
+        else:
+            positions.append(i)
+    return groups
+
+
+def shapeRows(probabilities, temperature=1.0, topK=None, topP=None):
+    """
+    Reshape each row of a weight matrix the way language model samplers do, in that order:
+    sharpen or flatten it with a temperature, then keep only its topK largest weights, then only
+    the smallest set of its largest weights that holds topP of its mass.
+    :param probabilities: a (n, k) array of non-negative weights; rows need not be normalized.
+    :param temperature: below 1 favors likely columns, above 1 unlikely ones.
+    :param topK: the number of columns to keep per row, or None for all of them.
+    :param topP: the share of each row's mass to keep, in (0, 1], or None for all of it.
+    :return: a (n, k) array of weights, or probabilities itself if there is nothing to do.
+    """
+    if temperature != 1.0:
+        # Scaled by the row maximum first, so that low temperatures cannot underflow whole rows.
+        probabilities = probabilities / probabilities.max(axis=1, keepdims=True)
+        probabilities **= 1.0 / temperature
+    numColumns = probabilities.shape[1]
+    if topK is not None and topK < numColumns:
+        dropped = np.argpartition(probabilities, numColumns - topK, axis=1)[:, :numColumns - topK]
+        probabilities = probabilities.copy()
+        np.put_along_axis(probabilities, dropped, 0, axis=1)
+    if topP is not None and topP < 1.0:
+        order = np.argsort(-probabilities, axis=1)
+        ordered = np.take_along_axis(probabilities, order, axis=1)
+        cumulative = np.cumsum(ordered, axis=1)
+        # A column is kept if the mass of the larger ones is short of topP, so the largest always is.
+        dropped = cumulative - ordered >= topP * cumulative[:, -1:]
+        ordered[dropped] = 0
+        probabilities = np.empty_like(ordered)
+        np.put_along_axis(probabilities, order, ordered, axis=1)
+    return probabilities
+
+def sampleRows(probabilities, temperature=1.0, topK=None, topP=None):
+    """
+    Draw one column per row of a weight matrix in a single vectorized call,
+    by searching each row's cumulative sum for a uniform threshold.
+    :param probabilities: a (n, k) array of non-negative weights; rows need not be normalized.
+    :param temperature, topK, topP: see shapeRows.
+    :return: an integer array of n column indices.
+    """
+    probabilities = shapeRows(probabilities, temperature, topK, topP)
+    cumulative = np.cumsum(probabilities, axis=1)
+    thresholds = np.random.random_sample(len(cumulative)) * cumulative[:, -1]
+    indices = (cumulative <= thresholds[:, None]).sum(axis=1)
+    return np.minimum(indices, cumulative.shape[1] - 1)
@@ -1,9 +1,23 @@
 from argparse import Action
+from collections.abc import Set
 from enum import Enum, auto
+from glob import glob
+import os
 import random
-import time
+import tempfile
+import threading
+import numpy as np
 from utils import getBucketsFromText
-from pystalk import BeanstalkClient
+from bucket_extraction import extractFromFile
+from bucket_generation.dedup import BucketIndex, SharedSubmissions, hashNames, tailBuckets
+from bucket_generation import final_output
+from bucket_generation.bucket_store import BucketStore
+from bucket_generation.metrics import GeneratorMetrics
+from bucket_generation.output import getCandidateOutput, LEVELS, SUMMARY
+from bucket_generation.pipeline import SubmissionPipeline, BLOCK, DROP
+from bucket_generation.producer import BeanstalkProducer
+from bucket_generation.profiling import Profiler, ProfilerType
+from bucket_generation.validity import ValidityFilter
 import json
 import argparse
 
@@ -60,23 +74,11 @@ def getFullBuckets(bucketType):
     assert (
         bucketType == BucketType.PUBLIC or bucketType == BucketType.PRIVATE
     ), "Bucket type must be one of PUBLIC/PRIVATE"
-    if bucketType == BucketType.PUBLIC:
-        return readFullBucketNamesFromFile("./final_output/all_platforms_public.txt")
-    if bucketType == BucketType.PRIVATE:
-        return readFullBucketNamesFromFile("./final_output/all_platforms_private.txt")
-
-class GeneratorBeanstalkClient(BeanstalkClient):
-
-    def __init__(self, address, port):
-        super().__init__(address, port)
-
-    def put_job(self, string, **kwargs):
-        # first, check if the job queue isn't too big.
-        # if so, sleep proportional to size so that we should slow down at around 10M queue size.        
-        jobsReady = super().stats()["current-jobs-ready"]
-        time.sleep(jobsReady/1e5)
-        super().put_job(string, **kwargs)
-
+    kind = final_output.PUBLIC if bucketType == BucketType.PUBLIC else final_output.PRIVATE
+    indexed = final_output.readNames(kind, domains=True)
+    if indexed is not None:
+        return indexed
+    return readFullBucketNamesFromFile(final_output.textPath(kind))
 
 def getExistingAlreadyGuessedBuckets(name, public=False):
     """
@@ -87,16 +89,227 @@ def getExistingAlreadyGuessedBuckets(name, public=False):
     return getExistingBuckets(public=public) & \
         readBucketsFromFile(f"./data/generation/{name}.txt")
 
+class GuessedHits:
+    """
+    Incremental version of getExistingAlreadyGuessedBuckets.
+    Follows the generator's guesses the validator answered (./data/generation/{name}.txt) and the
+    validator's hits (./data/validation/<host>/{public,private}.txt) by byte offset, so each refresh
+    only parses what the listener appended since the last one.
+    Both histories are kept in BucketIndexes in a temporary directory rather than in memory: a name
+    is a hit when it is new to one of them and already in the other. They are rebuilt from the start
+    of the files in each process, so the first update returns every hit found so far, e.g. to rebuild
+    a model from its seeds after a restart.
+    Use getGuessedHits to share one instance between a generator's model and its metrics.
+    :param known: buckets the model already contains, which are never reported as hits. Sets
+        (e.g. the IndexedNames of getExistingBuckets) are checked in place, not copied.
+    """
+
+    def __init__(self, name, public=False, known=()):
+        self.guessedPath = f"./data/generation/{name}.txt"
+        self.validatedFiles = ["public.txt"] if public else ["public.txt", "private.txt"]
+        # Removed with the instance, or when the process exits.
+        self.directory = tempfile.TemporaryDirectory(prefix=f"{name}.hits.")
+        self.guessed = BucketIndex(os.path.join(self.directory.name, "guessed"), initialCapacity=int(1e6))
+        self.existing = BucketIndex(os.path.join(self.directory.name, "existing"), initialCapacity=int(1e6))
+        # Like the indexes, the counts cover every guess the generator ever had answered.
+        self.guessed.meta.setdefault("numKnownGuessed", 0)
+        self.guessed.meta.setdefault("numHits", 0)
+        self.known = []
+        self.addKnown(known)
+        self.pending = set()
+        self.lock = threading.Lock()
+
+    @property
+    def numGuessed(self):
+        """
+        The number of distinct guesses the validator answered.
+        """
+        return len(self.guessed)
+
+    @property
+    def numKnownGuessed(self):
+        """
+        How many of them were known when they were answered.
+        """
+        return self.guessed.meta["numKnownGuessed"]
+
+    @property
+    def numHits(self):
+        """
+        How many of the others turned out to exist.
+        """
+        return self.guessed.meta["numHits"]
+
+    def addKnown(self, known):
+        if not isinstance(known, Set):
+            known = set(known)
+        if known:
+            self.known.append(known)
+
+    def isKnown(self, names):
+        """
+        :param names: a list of bucket names.
+        :return: a boolean array, True for the names of a known set.
+        """
+        found = np.zeros(len(names), dtype=bool)
+        for known in self.known:
+            if isinstance(known, final_output.IndexedNames):
+                found |= known.contains(names)
+            else:
+                found |= np.fromiter((name in known for name in names), dtype=bool, count=len(names))
+        return found
+
+    def _tail(self, index, paths):
+        """
+        :return: the names appended to the files that were not in the index yet, now added to it.
+        """
+        new = []
+        for path in paths:
+            for names, offset in tailBuckets(path, index.meta["sources"].get(path, 0)):
+                new += index.addNew(names)
+                index.meta["sources"][path] = offset
+        return new
+
+    def refresh(self):
+        """
+        Catch up with the files, keeping new hits until the next update.
+        :return: the number of new hits.
+        """
+        with self.lock:
+            # Each name is new to each index once, so it is only ever reported by one of the two checks:
+            # new guesses that already exist, then new buckets guessed before or just now.
+            newGuessed = self._tail(self.guessed, [self.guessedPath])
+            hits = []
+            if newGuessed:
+                hits += [name for name, isIn in zip(newGuessed, self.existing.containsHashes(hashNames(newGuessed))) if isIn]
+            newExisting = self._tail(
+                self.existing, sorted(path for f in self.validatedFiles for path in glob(f"./data/validation/*/{f}"))
+            )
+            if newExisting:
+                hits += [name for name, isIn in zip(newExisting, self.guessed.containsHashes(hashNames(newExisting))) if isIn]
+            hits = [name for name, isKnown in zip(hits, self.isKnown(hits)) if not isKnown]
+            self.guessed.meta["numKnownGuessed"] += int(self.isKnown(newGuessed).sum())
+            self.guessed.meta["numHits"] += len(hits)
+            self.guessed.sync()
+            self.existing.sync()
+            self.pending.update(hits)
+            return len(hits)
+
+    def update(self):
+        """
+        :return: the set of guessed buckets found to exist since the last update.
+        """
+        self.refresh()
+        with self.lock:
+            hits, self.pending = self.pending, set()
+        return hits
+
+guessedHitsByName = {}
+
+def getGuessedHits(name, public=False, known=()):
+    """
+    The process-wide GuessedHits of a generator. The metrics start counting its hits from here, so
+    call it with the buckets the model already contains before anything else refreshes it.
+    :param known: buckets the model already contains, added to the instance if it already exists.
+    """
+    guessedHits = guessedHitsByName.get(name)
+    if guessedHits is None:
+        guessedHits = guessedHitsByName[name] = GuessedHits(name, public=public, known=known)
+    else:
+        with guessedHits.lock:
+            guessedHits.addKnown(known)
+            pending = list(guessedHits.pending)
+            guessedHits.pending = set(
+                hit for hit, isKnown in zip(pending, guessedHits.isKnown(pending)) if not isKnown
+            )
+    if metrics is not None:
+        metrics.watchHits(guessedHits)
+    return guessedHits
+
+def getPreviouslySeen(name, startingCandidates=None):
+    """
+    Load the persistent dedup index of the generator's guesses. It is caught up with
+    ./data/generation/{name}.txt and seeded with the starting candidates.
+    :param name: the generator name.
+    :param startingCandidates: an optional iterable of names that should never be guessed.
+    """
+    previouslySeen = BucketIndex(
+        f"./data/generation/{name}.seen", sources=[f"./data/generation/{name}.txt"],
+    )
+    previouslySeen.update(startingCandidates or ())
+    return previouslySeen
+
+def getSharedSubmissions():
+    """
+    The machine-wide index of names any generator has submitted, or None if global dedup is off.
+    """
+    global sharedSubmissions
+    if sharedSubmissions is None and submissionOptions["globalDedup"]:
+        sharedSubmissions = SharedSubmissions("./data/generation/submitted")
+    return sharedSubmissions
+
+def claimCandidates(previouslySeen, candidates):
+    """
+    Drop candidates that break every provider's naming rules, then dedup them against the
+    generator's own guesses, then against the names every other generator has already
+    submitted to the validator.
+    :param previouslySeen: the generator's index from getPreviouslySeen.
+    Once claimed, a name is never generated or submitted again, so under the drop policy only
+    as many are claimed as the submission queue has room for; the others are dropped unclaimed.
+    :param candidates: an iterable of candidate names.
+    :return: the candidates to submit, in order and without repeats.
+    """
+    candidates = list(candidates)
+    room = submissionPipeline.room() if submissionPipeline is not None else None
+    if room is None:
+        accepted = _claim(previouslySeen, candidates)
+    else:
+        accepted = []
+        start = 0
+        while start < len(candidates) and len(accepted) < room:
+            chunk = candidates[start:start + room - len(accepted)]
+            accepted += _claim(previouslySeen, chunk)
+            start += len(chunk)
+        submissionPipeline.drop(len(candidates) - start)
+    if metrics is not None:
+        metrics.countCandidates(len(candidates), len(accepted))
+    return accepted
+
+def _claim(previouslySeen, candidates):
+    accepted = previouslySeen.addNew(validity.filter(candidates))
+    submitted = getSharedSubmissions()
+    if submitted:
+        accepted = submitted.claim(accepted)
+    return accepted
+
 def getExistingBuckets(public=False):
-    filePath = './final_output/all_platforms_all.txt'
-    if public:
-        filePath = "./final_output/all_platforms_public.txt"
-    return readBucketsFromFile(filePath)
+    """
+    The names of the buckets found so far, from the files of bucket_generation.final_output.
+    If they are indexed, this is a read-only set mapped from the index, which costs nothing
+    to load; use set(...) to get a mutable copy.
+    :param public: only the public buckets.
+    """
+    kind = final_output.PUBLIC if public else final_output.ALL
+    indexed = final_output.readNames(kind)
+    if indexed is not None:
+        return indexed
+    return readBucketsFromFile(final_output.textPath(kind))
+
+def sampleExistingBuckets(k, public=False):
+    """
+    Up to k distinct names of buckets found so far, drawn at random from the bucket store
+    without loading the others. Falls back to getExistingBuckets if the store was not built.
+    :param public: only the public buckets.
+    """
+    store = BucketStore()
+    if len(store):
+        return store.sample(k, public=True if public else None)
+    existing = list(getExistingBuckets(public=public))
+    return random.sample(existing, min(k, len(existing)))
 
 def readBucketsFromFile(path):
     try:
-        with open(path, "r") as f:
-            return set([bucket for line in f.readlines() for bucket in getBucketsFromText(line)])
+        return set(bucket for _, bucket in extractFromFile(path))
     except FileNotFoundError:
         return set()
 
@@ -110,42 +323,51 @@ def getStartBucketNames(args):
         return candidates
     return None
 
-class ProfilerType(Enum):
-    TRAIN = "train"
-    GENERATE = "generate"
-
-class Profiler:
-    
-    def __init__(self, profilerType, name):
-        assert profilerType in ProfilerType, "Don't know where to write these profiled results."
-        assert type(name) == str, "Name must be a string corresponding to the profiler."
-        self.type = profilerType
-        self.name = name
-        self.bucket_name = ""
-
-    def __enter__(self):
-        self.start = time.process_time()
-        return self
-    
-    def bucket(self, bucket):
-        self.bucket_name = bucket
-
-    def __exit__(self, exc_type, exc_vlaue, exc_tb):
-        self.end = time.process_time()
-        with open(f"./data/timing/{self.type.value}/{self.name}", "a+") as f:
-            f.write(f"{self.bucket_name},{self.end - self.start},{time.time()}\n")
-    
+# Process-wide submission and output settings, set from the command line by parseArguments.
+submissionOptions = {
+    "queueDepth": None,
+    "queuePolicy": BLOCK,
+    "globalDedup": True,
+}
+outputOptions = {
+    "level": SUMMARY,
+    "candidateLog": None,
+}
+sharedSubmissions = None
+# The generator's submission queue, if any, whose room claimCandidates checks under the drop policy.
+submissionPipeline = None
+# Counts the candidates dropped for breaking the naming rules, see claimCandidates.
+validity = ValidityFilter()
+# The live metrics of this generator, if enabled with --metrics_port or --metrics_file.
+metrics = None
+
+def getOutput(name):
+    """
+    The generator's console output and candidate log, as configured on the command line.
+    Report candidates with output.candidates(batch) rather than printing them one by one.
+    """
+    return getCandidateOutput(name, level=outputOptions["level"], logPath=outputOptions["candidateLog"])
 
 def getBeanstalkClient(port=None):
     """
-    Start up a beanstalkclient.
+    Start up a pipelined beanstalk producer.
+    If a submission queue depth is configured, the producer runs on its own thread behind a bounded queue.
+    Jobs are buffered, so call flush() (or close()) once done generating.
     """
     config = {}
     if not port:
         with open('./bucket_validation/listener-config.json', 'r') as f:
             config = json.load(f)
         port = config["BeanstalkHost"].split(":")[1]
-    return GeneratorBeanstalkClient("127.0.0.1", port)
+    global submissionPipeline
+    client = BeanstalkProducer("127.0.0.1", port)
+    if submissionOptions["queueDepth"]:
+        client = submissionPipeline = SubmissionPipeline(
+            client, depth=submissionOptions["queueDepth"], policy=submissionOptions["queuePolicy"],
+        )
+    if metrics is not None:
+        metrics.watchClient(client)
+    return client
 
 
 def getPreviousCandidates():
@@ -164,4 +386,30 @@ def addArguments(parser):
     parser.add_argument("name", type=str, help="generator identifier")
     parser.add_argument("--num_trials", type=str, help="Number of trials to run generator.")
     parser.add_argument("--port", type=int, help="The beanstalk job queue port.")
-    parser.add_argument("--public", action="store_true", help="Only load the public buckets in our models.")
\ No newline at end of file
+    parser.add_argument("--public", action="store_true", help="Only load the public buckets in our models.")
+    parser.add_argument("--queue_depth", type=int, help="Submit candidates from a separate thread through a queue of this size.")
+    parser.add_argument("--queue_policy", choices=[BLOCK, DROP], default=BLOCK, help="Whether to block or drop candidates when the submission queue is full.")
+    parser.add_argument("--no_global_dedup", action="store_true", help="Also submit names that other generators have already submitted.")
+    parser.add_argument("--output", choices=LEVELS, default=SUMMARY, help="Print nothing, a periodic summary, or every candidate.")
+    parser.add_argument("--candidate_log", type=str, help="Append every submitted candidate to this JSONL file.")
+    parser.add_argument("--metrics_port", type=int, help="Serve live Prometheus-style metrics on this local port.")
+    parser.add_argument("--metrics_file", type=str, help="Periodically write live Prometheus-style metrics to this file.")
+    parser.add_argument("--metrics_interval", type=float, default=10.0, help="Seconds between two metrics updates.")
+
+def parseArguments(parser):
+    """
+    Parse the generator arguments and apply the process-wide options among them.
+    :param parser: a parser set up with addArguments.
+    """
+    args = parser.parse_args()
+    submissionOptions["queueDepth"] = args.queue_depth
+    submissionOptions["queuePolicy"] = args.queue_policy
+    submissionOptions["globalDedup"] = not args.no_global_dedup
+    outputOptions["level"] = args.output
+    outputOptions["candidateLog"] = args.candidate_log
+    if args.metrics_port or args.metrics_file:
+        global metrics
+        metrics = GeneratorMetrics(args.name, interval=args.metrics_interval)
+        metrics.watchValidity(validity)
+        metrics.start(port=args.metrics_port, path=args.metrics_file)
+    return args
@@ -0,0 +1,239 @@
+"""
+Bucket naming rules of each provider, checked on whole batches of names at once.
+Names are packed into a byte matrix and every rule is a vectorized test over it, so that
+candidates that can never exist are dropped before they cost a validator round trip.
+The validator tries a bare name on every provider, so a name is kept if any provider allows it.
+"""
+import numpy as np
+
+from bucket_extraction.utils.extract_utils import GCS, OSS, S3
+
+LENGTH = "length"
+CHARACTERS = "characters"
+START_END = "start_end"
+ADJACENT_PERIODS = "adjacent_periods"
+DASH_PERIOD = "dash_period"
+IP_ADDRESS = "ip_address"
+RESERVED = "reserved"
+# In the order they are checked: a name is counted under the first rule it breaks.
+RULES = [LENGTH, CHARACTERS, START_END, ADJACENT_PERIODS, DASH_PERIOD, IP_ADDRESS, RESERVED]
+
+# Names are packed at most this wide, longer ones break the length rule anyway.
+MAX_WIDTH = 256
+
+# Every byte falls in one character class; a name's classes are OR-ed into one bitmask.
+PADDING = 0
+LETTER = 1
+DIGIT = 2
+PERIOD = 4
+DASH = 8
+UNDERSCORE = 16
+OTHER = 32
+CLASSES = np.full(256, OTHER, dtype=np.uint8)
+CLASSES[0] = PADDING
+CLASSES[np.frombuffer(b"abcdefghijklmnopqrstuvwxyz", dtype=np.uint8)] = LETTER
+CLASSES[np.frombuffer(b"0123456789", dtype=np.uint8)] = DIGIT
+CLASSES[ord(".")] = PERIOD
+CLASSES[ord("-")] = DASH
+CLASSES[ord("_")] = UNDERSCORE
+ALPHANUMERIC = LETTER | DIGIT
+_CLASSES = CLASSES.tolist()
+
+# Per provider: the allowed character classes, the length bounds, and the reserved prefixes,
+# suffixes and substrings.
+# S3: https://docs.aws.amazon.com/AmazonS3/latest/userguide/bucketnamingrules.html
+# GCS: https://cloud.google.com/storage/docs/buckets#naming (up to 222 characters with dots,
+#     63 per dot-separated component)
+# OSS: https://www.alibabacloud.com/help/en/oss/user-guide/bucket-naming-conventions
+PROVIDER_RULES = {
+    S3: {
+        "characters": ALPHANUMERIC | PERIOD | DASH,
+        "maxLength": 63,
+        "maxComponent": 63,
+        "dashPeriod": True,
+        "prefixes": [b"xn--", b"sthree-"],
+        "suffixes": [b"-s3alias", b"--ol-s3"],
+        "substrings": [],
+    },
+    GCS: {
+        "characters": ALPHANUMERIC | PERIOD | DASH | UNDERSCORE,
+        "maxLength": 222,
+        "maxComponent": 63,
+        "dashPeriod": False,
+        "prefixes": [b"goog"],
+        "suffixes": [],
+        "substrings": [b"google"],
+    },
+    OSS: {
+        "characters": ALPHANUMERIC | DASH,
+        "maxLength": 63,
+        "maxComponent": 63,
+        "dashPeriod": False,
+        "prefixes": [],
+        "suffixes": [],
+        "substrings": [],
+    },
+}
+PROVIDERS = list(PROVIDER_RULES)
+# Below this many names, checking them one by one is faster than numpy's per-call overhead.
+SMALL_BATCH = 16
+
+
+class NameBatch:
+    """
+    A batch of names packed into a zero-padded byte matrix, with the features every
+    provider's rules are computed from.
+    :param names: a list of strings.
+    """
+
+    def __init__(self, names):
+        encoded = [name.encode('utf-8') for name in names]
+        self.lengths = np.fromiter(map(len, encoded), dtype=np.int64, count=len(encoded))
+        width = int(min(self.lengths.max(initial=1), MAX_WIDTH)) or 1
+        self.packed = np.array(encoded, dtype=f'S{width}')
+        self.matrix = self.packed.view(np.uint8).reshape(len(encoded), width)
+        self.classes = np.bitwise_or.reduce(CLASSES[self.matrix], axis=1)
+        lastBytes = self.matrix[np.arange(len(encoded)), np.clip(self.lengths - 1, 0, width - 1)]
+        self.alphanumericEnds = (CLASSES[self.matrix[:, 0]] & ALPHANUMERIC).astype(bool) & \
+            (CLASSES[lastBytes] & ALPHANUMERIC).astype(bool)
+        # Pairs of neighbouring characters only matter for names with a period.
+        withPeriod = np.flatnonzero(self.classes & PERIOD)
+        periods = self.matrix[withPeriod] == ord(".")
+        dashes = self.matrix[withPeriod] == ord("-")
+        self.adjacentPeriods = np.zeros(len(encoded), dtype=bool)
+        self.adjacentPeriods[withPeriod] = (periods[:, :-1] & periods[:, 1:]).any(axis=1)
+        self.dashPeriod = np.zeros(len(encoded), dtype=bool)
+        self.dashPeriod[withPeriod] = ((periods[:, :-1] & dashes[:, 1:]) | (dashes[:, :-1] & periods[:, 1:])).any(axis=1)
+        ipLike = withPeriod[(self.classes[withPeriod] & (~(DIGIT | PERIOD) & 0xff)) == 0]
+        self.ipAddress = np.zeros(len(encoded), dtype=bool)
+        self.ipAddress[ipLike] = (self.matrix[ipLike] == ord(".")).sum(axis=1) == 3
+        self.componentLength = self.lengths
+        if len(withPeriod) and self.lengths.max() > 63:
+            positions = np.arange(width)
+            lastPeriod = np.maximum.accumulate(np.where(self.matrix == ord("."), positions, -1), axis=1)
+            inName = positions < self.lengths[:, None]
+            self.componentLength = np.where(inName, positions - lastPeriod, 0).max(axis=1)
+
+    def brokenRules(self, provider):
+        """
+        :return: an int8 array holding, for each name, the index in RULES of the first rule of
+            the provider it breaks, or -1 if it is valid.
+        """
+        rules = PROVIDER_RULES[provider]
+        broken = {
+            LENGTH: (self.lengths < 3) | (self.lengths > rules["maxLength"]) |
+                (self.componentLength > rules["maxComponent"]),
+            CHARACTERS: (self.classes & (~rules["characters"] & 0xff)) != 0,
+            START_END: ~self.alphanumericEnds,
+            ADJACENT_PERIODS: self.adjacentPeriods,
+            DASH_PERIOD: self.dashPeriod if rules["dashPeriod"] else None,
+            IP_ADDRESS: self.ipAddress,
+            RESERVED: None,
+        }
+        reserved = np.zeros(len(self.lengths), dtype=bool)
+        for prefix in rules["prefixes"]:
+            reserved |= np.char.startswith(self.packed, prefix)
+        for suffix in rules["suffixes"]:
+            reserved |= np.char.endswith(self.packed, suffix)
+        for substring in rules["substrings"]:
+            reserved |= np.char.find(self.packed, substring) >= 0
+        broken[RESERVED] = reserved
+        reasons = np.full(len(self.lengths), -1, dtype=np.int8)
+        for index in range(len(RULES) - 1, -1, -1):
+            if broken[RULES[index]] is not None:
+                reasons[broken[RULES[index]]] = index
+        return reasons
+
+def firstBrokenRule(name, provider):
+    """
+    The rules of NameBatch.brokenRules, for a single name.
+    :return: the index in RULES of the first rule of the provider the name breaks, or -1.
+    """
+    rules = PROVIDER_RULES[provider]
+    raw = name.encode('utf-8')
+    if len(raw) < 3 or len(raw) > rules["maxLength"] or max(map(len, raw.split(b"."))) > rules["maxComponent"]:
+        return 0
+    classes = 0
+    for byte in raw:
+        classes |= _CLASSES[byte]
+    if classes & ~rules["characters"]:
+        return 1
+    if not (_CLASSES[raw[0]] & ALPHANUMERIC and _CLASSES[raw[-1]] & ALPHANUMERIC):
+        return 2
+    if b".." in raw:
+        return 3
+    if rules["dashPeriod"] and (b".-" in raw or b"-." in raw):
+        return 4
+    if not classes & ~(DIGIT | PERIOD) and raw.count(b".") == 3:
+        return 5
+    if raw.startswith(tuple(rules["prefixes"])) or raw.endswith(tuple(rules["suffixes"])) or \
+            any(substring in raw for substring in rules["substrings"]):
+        return 6
+    return -1
+
+
+class ValidityFilter:
+    """
+    Drops names that no provider accepts, and counts them.
+    :param providers: the providers a name may be valid for.
+    """
+
+    def __init__(self, providers=PROVIDERS):
+        self.providers = list(providers)
+        self.checked = 0
+        self.invalid = 0
+        # For the dropped names: provider -> rule -> how many broke that rule first.
+        self.rejected = {provider: dict.fromkeys(RULES, 0) for provider in self.providers}
+
+    def check(self, names):
+        """
+        :param names: a list of strings.
+        :return: a sequence of booleans, True for the names that at least one provider accepts.
+        """
+        self.checked += len(names)
+        if len(names) < SMALL_BATCH:
+            return [self._checkName(name) for name in names]
+        batch = NameBatch(names)
+        reasons = [batch.brokenRules(provider) for provider in self.providers]
+        valid = np.zeros(len(names), dtype=bool)
+        for providerReasons in reasons:
+            valid |= providerReasons < 0
+        numInvalid = len(names) - int(valid.sum())
+        if numInvalid:
+            self.invalid += numInvalid
+            for provider, providerReasons in zip(self.providers, reasons):
+                counts = np.bincount(providerReasons[~valid], minlength=len(RULES))
+                for rule, count in zip(RULES, counts):
+                    self.rejected[provider][rule] += int(count)
+        return valid
+
+    def _checkName(self, name):
+        reasons = []
+        for provider in self.providers:
+            reason = firstBrokenRule(name, provider)
+            if reason < 0:
+                return True
+            reasons.append(reason)
+        self.invalid += 1
+        for provider, reason in zip(self.providers, reasons):
+            self.rejected[provider][RULES[reason]] += 1
+        return False
+
+    def filter(self, names):
+        """
+        :param names: an iterable of strings.
+        :return: the names that at least one provider accepts, in order.
+        """
+        names = list(names)
+        valid = self.check(names)
+        return [name for name, isValid in zip(names, valid) if isValid]
+
+    def summary(self):
+        """
+        :return: a line describing how many names were dropped and why.
+        """
+        reasons = ", ".join(
+            f"{provider} {rule}: {count}"
+            for provider, counts in self.rejected.items() for rule, count in counts.items() if count
+        )
+        return f"{self.invalid}/{self.checked} invalid names dropped" + (f" ({reasons})" if reasons else "")
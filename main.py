@@ -22,6 +22,7 @@ parser.add_argument('--fetch', help='Load dataset of JUST extracted bucket names
 parser.add_argument('--lookup', help='Checks all IPs against VirusTotal', action='store_true')
 parser.add_argument('--ips', help='Fetch S3 IPs for Zmap', action='store_true')
 parser.add_argument('-n', help='Number of requests to make', type=int,)
+parser.add_argument('--threads', help='Number of concurrent requests for Bing and GrayHat Warfare', type=int)
 parser.add_argument('-i', help='Network interface for zgrab to use')
 parser.add_argument('--label', help='Output filename label')
 parser.add_argument('--ngrams', help='Generate candidates using NGrams', action='store_true')
@@ -46,9 +47,9 @@ parser.add_argument('--domain', help='Root domain to look up', type=str)
 
 args = parser.parse_args()
 if args.bing:
-	getBucketsFromBing()
+	getBucketsFromBing(numThreads=args.threads)
 elif args.grayhatwarfare:
-	getGrayhatWarfare()
+	getGrayhatWarfare(numThreads=args.threads)
 elif args.virustotal:
 	if args.ips:
 		getS3IPs()
@@ -0,0 +1,68 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from bucket_generation import final_output
+
+
+class GatherAllBucketsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.cwd = os.getcwd()
+        os.chdir(self.directory)
+        self.addCleanup(os.chdir, self.cwd)
+        os.makedirs("./data/validation/s3.amazonaws.com")
+        os.makedirs("./final_output")
+
+    def validate(self, kind, *domains):
+        with open(f"./data/validation/s3.amazonaws.com/{kind}.txt", 'a') as f:
+            for i, domain in enumerate(domains):
+                f.write(f"{domain},{1600000000 + i}\n")
+
+    def readLines(self, kind):
+        with open(final_output.textPath(kind)) as f:
+            return [line.split(",")[0] for line in f]
+
+    def testIncrementalMerge(self):
+        self.validate(final_output.PUBLIC, "b.s3.amazonaws.com", "a.s3.amazonaws.com")
+        self.validate(final_output.PRIVATE, "c.s3.amazonaws.com")
+        final_output.gatherAllBuckets()
+        self.validate(final_output.PUBLIC, "d.s3.amazonaws.com")
+        self.assertEqual(final_output.gatherAllBuckets()[final_output.PUBLIC], 1)
+        self.assertEqual(
+            self.readLines(final_output.ALL),
+            ["a.s3.amazonaws.com", "b.s3.amazonaws.com", "c.s3.amazonaws.com", "d.s3.amazonaws.com"],
+        )
+        self.assertEqual(set(final_output.readNames(final_output.PUBLIC)), {"a", "b", "d"})
+
+    def testMissingIndexKeepsExistingLines(self):
+        domains = [f"bucket{i}.s3.amazonaws.com" for i in range(5)]
+        self.validate(final_output.PUBLIC, *domains)
+        final_output.gatherAllBuckets()
+        os.remove(final_output.indexPath(final_output.PUBLIC, "lines"))
+        self.validate(final_output.PUBLIC, "new.s3.amazonaws.com")
+        final_output.gatherAllBuckets()
+        self.assertEqual(self.readLines(final_output.PUBLIC), sorted(domains + ["new.s3.amazonaws.com"]))
+        self.assertEqual(len(final_output.readNames(final_output.PUBLIC)), 6)
+
+    def testInterruptedRunKeepsExistingLines(self):
+        # The text was replaced, but the run stopped before saving the state.
+        self.validate(final_output.PUBLIC, "a.s3.amazonaws.com", "b.s3.amazonaws.com")
+        final_output.gatherAllBuckets()
+        state = final_output.loadState()
+        self.validate(final_output.PUBLIC, "c.s3.amazonaws.com")
+        final_output.gatherAllBuckets()
+        final_output.saveState(state)
+        self.validate(final_output.PUBLIC, "d.s3.amazonaws.com")
+        final_output.gatherAllBuckets()
+        self.assertEqual(
+            self.readLines(final_output.PUBLIC),
+            ["a.s3.amazonaws.com", "b.s3.amazonaws.com", "c.s3.amazonaws.com", "d.s3.amazonaws.com"],
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,4 +1,4 @@
-from bucket_extraction import getBucketsFromText
+from bucket_extraction import getBucketsFromText, extractFromFile
 
 def initializeSetFromTextFile(path, setType):
     """
@@ -11,9 +11,8 @@ def initializeSetFromTextFile(path, setType):
             setType.add(line.strip())
 
 def getBucketsFromTextFile(path):
-    buckets = set()
-    with open(path, 'r') as f:
-        lines = f.readlines()
-        for line in lines:
-            buckets = buckets.union(getBucketsFromText(line))
-    return buckets
+    """
+    Read every bucket name in a text file. For files of several GB, use
+    bucket_extraction.utils.bulk_extract.extractFiles, which uses all cores.
+    """
+    return set(bucket for _, bucket in extractFromFile(path))